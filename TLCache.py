@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Least recently used cache bounded by the total size of its values
+#
+####################################################################################
+
+import threading
+import logging
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class TLCache:
+	'''
+		LRU cache holding at most capacity bytes worth of values
+
+		The caller tells put() how big a value is. Values bigger than the
+		whole cache are not kept. Hit and miss counters are kept to help
+		sizing the cache.
+	'''
+
+	def __init__(self, name, capacity):
+		self.name = name
+		self.capacity = capacity
+		self.size = 0
+		self.entries = OrderedDict()	# key -> (value, size), least recently used first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.entries[key] = entry
+			self.hits += 1
+			return entry[0]
+
+	def put(self, key, value, size):
+		if size > self.capacity:
+			return
+
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= old[1]
+			self.entries[key] = (value, size)
+			self.size += size
+
+			while self.size > self.capacity:
+				k, (v, s) = self.entries.popitem(last=False)
+				self.size -= s
+				self.evictions += 1
+
+	def remove(self, key):
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= old[1]
+
+	def stats(self):
+		with self.lock:
+			return {
+				'name': self.name,
+				'capacity': self.capacity,
+				'size': self.size,
+				'entries': len(self.entries),
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			}
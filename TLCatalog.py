@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Catalog of the snapshots under a data root
+#
+# One SQLite database, TL_DATA_DIR/.catalog.db, holds the next index of every
+# (namespace,source), and for every snapshot its collection time, hostname and
+# sizes, and the state of each of its stages: the pipeline stages run by
+# timeline.py (raw, time, diff, index, ...), plus tag and noise as recorded by
+# lasertag.py and noisemachine.py. Tools look snapshots up in it instead of
+# probing for their files, and resume where they left off with one query.
+#
+# Indexes are allocated in a transaction, so server processes and tools share
+# it safely. The .metafile of a source ingested before the catalog existed is
+# imported the first time the source is looked up, along with the stages its
+# files show to be done.
+#
+####################################################################################
+
+import os
+import re
+import threading
+import traceback
+import logging
+import TLData
+import TLHistory
+import TLPipeline
+import TLReader
+
+from collections import OrderedDict
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_DATA_DIR	=	'./data'
+
+# stages of a snapshot imported from .metafile, and the artifact showing each is done
+IMPORTED	=	(('diff', '.diff'), ('index', '.json'), ('tag', '.tag.json'))
+
+logger = logging.getLogger(__name__)
+
+def makeDirs(dirName):
+	if os.path.isdir(dirName):
+		return
+	try:
+		logger.info("Creating directory {0}".format(dirName))
+		os.makedirs(dirName)
+	except OSError:
+		# another process may have created it in the meantime
+		if not os.path.isdir(dirName):
+			logger.error("Cannot create directory {0}".format(dirName))
+			raise
+
+class TLCatalog:
+	'''
+		Snapshot indexes, metadata and stage states of every source under
+		TL_DATA_DIR
+
+		Each thread keeps its own connection to the database open, it is
+		written to for every stage of every snapshot.
+	'''
+
+	schema = [
+		'PRAGMA journal_mode = WAL',
+		'''CREATE TABLE IF NOT EXISTS sources (
+			namespace TEXT NOT NULL,
+			source TEXT NOT NULL,
+			next INTEGER NOT NULL,
+			PRIMARY KEY (namespace, source)
+		) WITHOUT ROWID''',
+		# collection time in seconds, size in bytes as stored at ingest
+		'''CREATE TABLE IF NOT EXISTS snapshots (
+			namespace TEXT NOT NULL,
+			source TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			collection INTEGER,
+			hostname TEXT,
+			files INTEGER,
+			size INTEGER,
+			PRIMARY KEY (namespace, source, idx)
+		) WITHOUT ROWID''',
+		'CREATE INDEX IF NOT EXISTS snapshots_collection ON snapshots (namespace, source, collection)',
+		'''CREATE TABLE IF NOT EXISTS stages (
+			namespace TEXT NOT NULL,
+			source TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			stage TEXT NOT NULL,
+			state TEXT NOT NULL,
+			PRIMARY KEY (namespace, source, idx, stage)
+		) WITHOUT ROWID''',
+		'CREATE INDEX IF NOT EXISTS stages_stage ON stages (namespace, source, stage, idx)',
+	]
+
+	local = threading.local()
+
+	def connect(self):
+		''' the connection of this thread to the catalog '''
+
+		databaseName = TL_DATA_DIR + '/.catalog.db'
+		db = getattr(TLCatalog.local, 'db', None)
+		if db is None or TLCatalog.local.databaseName != databaseName:
+			makeDirs(TL_DATA_DIR)
+			db = TLHistory.connect(databaseName, self.schema)
+			# committed stage states may be lost on power failure, see allocate()
+			db.execute('PRAGMA synchronous = NORMAL')
+			TLCatalog.local.db = db
+			TLCatalog.local.databaseName = databaseName
+		return db
+
+	def allocate(self, namespace, source):
+		''' reserve the next snapshot index of a source, recording its raw data as being written '''
+
+		makeDirs(TL_DATA_DIR + '/' + namespace + '/' + source)
+
+		db = self.connect()
+		# an index handed out twice would overwrite a snapshot, so this one is
+		# on disk before the raw data is written
+		db.execute('PRAGMA synchronous = FULL')
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			try:
+				index = self.getSource(db, namespace, source)
+				db.execute('UPDATE sources SET next = ? WHERE namespace = ? AND source = ?', (index + 1, namespace, source))
+				db.execute('INSERT OR REPLACE INTO snapshots (namespace, source, idx) VALUES (?, ?, ?)', (namespace, source, index))
+				db.execute('DELETE FROM stages WHERE namespace = ? AND source = ? AND idx = ?', (namespace, source, index))
+				db.execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?)', (namespace, source, index, 'raw', TLPipeline.RUNNING))
+				db.execute('COMMIT')
+			except:
+				db.execute('ROLLBACK')
+				raise
+		finally:
+			db.execute('PRAGMA synchronous = NORMAL')
+
+		return index
+
+	def getNext(self, namespace, source):
+		''' index the next snapshot of a source will get '''
+
+		db = self.connect()
+		row = db.execute('SELECT next FROM sources WHERE namespace = ? AND source = ?', (namespace, source)).fetchone()
+		if row is not None:
+			return row[0]
+		if not os.path.isdir(TL_DATA_DIR + '/' + namespace + '/' + source):
+			# nothing uploaded yet, see allocate()
+			return 0
+
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			index = self.getSource(db, namespace, source)
+			db.execute('COMMIT')
+		except:
+			db.execute('ROLLBACK')
+			raise
+		return index
+
+	def getSource(self, db, namespace, source):
+		'''
+			Next index of a source, imported from its .metafile if the catalog
+			does not know it yet, must be called in a transaction
+		'''
+
+		row = db.execute('SELECT next FROM sources WHERE namespace = ? AND source = ?', (namespace, source)).fetchone()
+		if row is not None:
+			return row[0]
+
+		baseDirName = TL_DATA_DIR + '/' + namespace + '/' + source
+		index = 0
+		try:
+			f = open(baseDirName + '/.metafile', 'r')
+			try:
+				index = int(f.read())
+			finally:
+				f.close()
+		except (IOError, ValueError):
+			pass
+
+		if index > 0:
+			tlti = TLData.TLTimeIndex()
+			with TLData.TLTimeIndex.cacheLock:
+				times = dict((i, t) for t, i in tlti.load(namespace, source))
+
+			count = 0
+			for i in range(index):
+				baseDatafileName = baseDirName + '/' + str(i)
+				if not TLData.snapshotExists(baseDatafileName):
+					continue
+				db.execute('INSERT OR IGNORE INTO snapshots (namespace, source, idx, collection) VALUES (?, ?, ?, ?)',
+					(namespace, source, i, times.get(i)))
+				stages = ['raw'] + [stage for stage, suffix in IMPORTED if TLData.artifactExists(baseDatafileName + suffix)]
+				db.executemany('INSERT OR IGNORE INTO stages VALUES (?, ?, ?, ?, ?)',
+					[(namespace, source, i, stage, TLPipeline.DONE) for stage in stages])
+				count += 1
+			logger.info("Imported {0} snapshots of {1} into the catalog".format(count, baseDirName))
+
+		db.execute('INSERT INTO sources VALUES (?, ?, ?)', (namespace, source, index))
+		return index
+
+	def write(self, baseDatafileName):
+		''' record the collection time, hostname and sizes of a snapshot '''
+
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		namespace = m.group(2)
+		source = m.group(3)
+		index = int(m.group(4))
+
+		try:
+			# counted a line at a time, see TLReader
+			reader = TLReader.TLSnapshotReader(TLData.openSnapshot(baseDatafileName))
+			try:
+				files = sum(1 for line in reader)
+			finally:
+				reader.close()
+			collectionTime = None
+			if reader.collectionTime is not None:
+				collectionTime = TLData.parseTime(reader.collectionTime)
+			size = TLData.statSnapshot(baseDatafileName).st_size
+
+			self.connect().execute('UPDATE snapshots SET collection = ?, hostname = ?, files = ?, size = ? WHERE namespace = ? AND source = ? AND idx = ?',
+				(collectionTime, reader.hostname, files, size, namespace, source, index))
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def setStage(self, namespace, source, index, stage, state):
+		self.connect().execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', (namespace, source, index, stage, state))
+
+	def getStages(self, namespace, source, index):
+		''' stage -> state of a snapshot, empty if the catalog does not know it '''
+
+		self.getNext(namespace, source)
+		rows = self.connect().execute('SELECT stage, state FROM stages WHERE namespace = ? AND source = ? AND idx = ?',
+			(namespace, source, index)).fetchall()
+		return dict(rows)
+
+	def find(self, namespace, source, stage, states=(TLPipeline.DONE,), start=0, end=None, reverse=False, limit=None):
+		'''
+			indexes from start up to end (excluded) of the snapshots whose stage
+			is in one of states, only the first limit of them if given
+		'''
+
+		self.getNext(namespace, source)
+		query = 'SELECT idx FROM stages WHERE namespace = ? AND source = ? AND stage = ? AND idx >= ?'
+		args = [namespace, source, stage, start]
+		if end is not None:
+			query += ' AND idx < ?'
+			args.append(end)
+		query += ' AND state IN ({0}) ORDER BY idx{1}'.format(', '.join('?' * len(states)), ' DESC' if reverse else '')
+		args.extend(states)
+		if limit is not None:
+			query += ' LIMIT ?'
+			args.append(limit)
+
+		return [row[0] for row in self.connect().execute(query, args)]
+
+	def clearStage(self, namespace, source, indexes, stage):
+		''' forget that stage was done for the snapshots indexes, for it to be done again '''
+
+		db = self.connect()
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			db.executemany('DELETE FROM stages WHERE namespace = ? AND source = ? AND idx = ? AND stage = ?',
+				[(namespace, source, i, stage) for i in indexes])
+			db.execute('COMMIT')
+		except:
+			db.execute('ROLLBACK')
+			raise
+
+	def remove(self, namespace, source, indexes):
+		''' forget the snapshots indexes, e.g. dropped by TLRetention '''
+
+		db = self.connect()
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			for table in ('snapshots', 'stages'):
+				db.executemany('DELETE FROM {0} WHERE namespace = ? AND source = ? AND idx = ?'.format(table),
+					[(namespace, source, i) for i in indexes])
+			db.execute('COMMIT')
+		except:
+			db.execute('ROLLBACK')
+			raise
+
+	def snapshots(self, namespace, source, start=None, end=None):
+		'''
+			Yield the snapshots of a source with their stages, oldest first,
+			optionally limited to those collected between start and end (in
+			seconds)
+		'''
+
+		query = 'SELECT idx, collection, hostname, files, size FROM snapshots WHERE namespace = ? AND source = ?'
+		args = [namespace, source]
+		if start is not None:
+			query += ' AND collection >= ?'
+			args.append(start)
+		if end is not None:
+			query += ' AND collection <= ?'
+			args.append(end)
+		query += ' ORDER BY collection, idx'
+
+		self.getNext(namespace, source)
+		db = self.connect()
+		rows = db.execute(query, args).fetchall()
+		if len(rows) == 0:
+			return
+
+		# stages of every snapshot in the range at once
+		indexes = [row[0] for row in rows]
+		stages = {}
+		for i, stage, state in db.execute('SELECT idx, stage, state FROM stages WHERE namespace = ? AND source = ? AND idx BETWEEN ? AND ?',
+			(namespace, source, min(indexes), max(indexes))):
+			stages.setdefault(i, OrderedDict())[stage] = state
+
+		for index, collection, hostname, files, size in rows:
+			yield {
+				'index': index,
+				'collection_dt': TLData.formatTime(collection) if collection is not None else None,
+				'hostname_s': hostname,
+				'files': files,
+				'size': size,
+				'stages': stages.get(index, {}),
+			}
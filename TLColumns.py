@@ -0,0 +1,406 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Columnar binary form of a snapshot
+#
+# Next to its raw data, a snapshot can be written to <n>.col: the file entries
+# sorted by the id of their name in the path dictionary of the namespace (see
+# TLPaths), one column per field (name id, modification time and size as
+# int64, packed permission and type codes), so readers mmap the file and look
+# at the fields they need instead of parsing every line of the raw data. Two
+# snapshots are compared a block of rows at a time, comparing the bytes of
+# each column, narrowing down on the rows that differ.
+#
+####################################################################################
+
+import os
+import re
+import mmap
+import struct
+import bisect
+import operator
+import traceback
+import logging
+import TLData
+import TLPaths
+
+try: import simplejson as json
+except ImportError: import json
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_COLUMNS_BLOCK	=	256	# most rows compared at once when diffing two snapshots
+
+MAGIC		=	'TLCOL002'
+SECTIONS	=	('meta', 'id', 'mtime', 'size', 'permission', 'type')
+HEADER		=	struct.Struct('<8sQ' + 'QQ' * len(SECTIONS))
+
+# entry lines as written by agent.sh, stripped of whitespace and trailing ','
+LINE		=	'{{"name_s": "{0}", "lastmodifiedtime_dt": "{1}", "size_i": "{2}", "permission_s": "{3}", "type_s": "{4}"}}'
+linepattern	=	re.compile(r'^\{"name_s": "([^"\n]*)", "lastmodifiedtime_dt": "([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z)", "size_i": "(0|[1-9][0-9]*)", "permission_s": "(.{10})", "type_s": "(.)"\}$')
+
+# first character of find's %M
+KINDS		=	'-dlcbpsD'
+
+# fixed width columns and the bytes of each row
+COLUMNS		=	(('id', 4), ('mtime', 8), ('size', 8), ('permission', 2), ('type', 1))
+
+logger = logging.getLogger(__name__)
+
+def encodePermission(permission):
+	''' pack a permission string like -rwsr-xr-x into 16 bits, None if it is not one '''
+
+	kind = KINDS.find(permission[0])
+	if kind < 0:
+		return None
+
+	bits = 0
+	for i, c in enumerate(permission[1:]):
+		if c == '-':
+			continue
+		# r w x of user, group and other, x may be s/S (setuid, setgid) or t/T (sticky)
+		if c == 'rwx'[i % 3]:
+			bits |= 1 << (8 - i)
+		elif i % 3 == 2 and c == ('s' if i < 8 else 't'):
+			bits |= 1 << (8 - i) | 1 << (11 - i / 3)
+		elif i % 3 == 2 and c == ('S' if i < 8 else 'T'):
+			bits |= 1 << (11 - i / 3)
+		else:
+			return None
+	return kind << 12 | bits
+
+def decodePermission(code):
+	result = [KINDS[code >> 12]]
+	for i in range(9):
+		x = code & 1 << (8 - i)
+		if i % 3 == 2 and code & 1 << (11 - i / 3):
+			c = 's' if i < 8 else 't'
+			result.append(c if x else c.upper())
+		else:
+			result.append('rwx'[i % 3] if x else '-')
+	return ''.join(result)
+
+class TLColumnsWriter:
+	'''
+		Writes the columnar form of a snapshot to <n>.col
+
+		Layout, little-endian, every section starting on an 8 byte boundary:
+			header		magic, row count, (offset, length) of each section
+			meta		JSON: hostname_s, collection_dt, and the entry lines
+					that cannot be rebuilt from the columns, by row
+			id		uint32 id of the file name per row, ascending
+			mtime, size	int64 per row
+			permission	uint16 per row, see encodePermission()
+			type		uint8 per row, the type_s character
+
+		Kept uncompressed so it can be mapped into memory.
+	'''
+
+	def write(self, baseDatafileName):
+		''' write the columnar form of a snapshot '''
+
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		namespaceDirName = m.group(1) + '/' + m.group(2)
+		columnsfileName = baseDatafileName + '.col'
+
+		try:
+			snapshot = TLData.readSnapshot(baseDatafileName)
+			names = sorted(snapshot.names)
+			rows = sorted(zip(TLPaths.getDictionary(namespaceDirName).ids(names, add=True), names), key=operator.itemgetter(0))
+			del names
+
+			lines = {}
+			ids = []
+			mtimes = []
+			sizes = []
+			permissions = []
+			types = []
+			times = {}	# lastmodifiedtime_dt -> seconds, agent.sh writes few distinct ones
+			codes = {}	# permission_s -> encodePermission()
+
+			for row, (id, name) in enumerate(rows):
+				line = snapshot.names[name]
+				ids.append(id)
+
+				fields = self.parse(line, times, codes)
+				if fields is None:
+					# only its name can be used
+					lines[row] = line
+					fields = (-1, -1, 0, 0)
+				mtimes.append(fields[0])
+				sizes.append(fields[1])
+				permissions.append(fields[2])
+				types.append(fields[3])
+
+			# raw data may not be UTF-8, latin-1 maps every byte to a character and back
+			meta = json.dumps({'hostname_s': snapshot.hostname, 'collection_dt': snapshot.collectionTime, 'lines': lines}, encoding='latin-1')
+			sections = [meta,
+				struct.pack('<{0}I'.format(len(ids)), *ids),
+				struct.pack('<{0}q'.format(len(mtimes)), *mtimes),
+				struct.pack('<{0}q'.format(len(sizes)), *sizes),
+				struct.pack('<{0}H'.format(len(permissions)), *permissions),
+				struct.pack('<{0}B'.format(len(types)), *types)]
+
+			f = open(columnsfileName + '.tmp', 'wb')
+			try:
+				f.write('\0' * HEADER.size)
+				table = []
+				for section in sections:
+					f.write('\0' * (-f.tell() % 8))
+					start = f.tell()
+					f.write(section)
+					table.extend([start, f.tell() - start])
+				f.seek(0)
+				f.write(HEADER.pack(MAGIC, len(rows), *table))
+				f.close()
+			except:
+				f.close()
+				os.remove(columnsfileName + '.tmp')
+				raise
+			os.rename(columnsfileName + '.tmp', columnsfileName)
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		logger.info("Creating columns file {0}".format(columnsfileName))
+		return True
+
+	def parse(self, line, times, codes):
+		''' (mtime, size, permission, type) of an entry line, None if the line could not be rebuilt from them '''
+
+		m = linepattern.match(line)
+		if m is None:
+			return None
+
+		modified = m.group(2)
+		mtime = times.get(modified)
+		if mtime is None:
+			try:
+				mtime = TLData.parseTime(modified)
+			except ValueError:
+				return None
+			if TLData.formatTime(mtime) != modified:
+				return None
+			times[modified] = mtime
+
+		permission = codes.get(m.group(4))
+		if permission is None:
+			permission = encodePermission(m.group(4))
+			if permission is None:
+				return None
+			codes[m.group(4)] = permission
+
+		return (mtime, int(m.group(3)), permission, ord(m.group(5)))
+
+class TLColumnarSnapshot:
+	'''
+		Read-only view of a <n>.col file mapped into memory
+
+		Fields of a row are read from the mapping when asked for, nothing is
+		kept per row. File names are looked up in paths, the TLPaths
+		dictionary of the namespace.
+	'''
+
+	def __init__(self, columnsfileName, paths):
+		self.paths = paths
+
+		f = open(columnsfileName, 'rb')
+		try:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+		header = HEADER.unpack_from(self.map, 0)
+		if header[0] != MAGIC:
+			self.map.close()
+			raise IOError('Malformed columns file {0}'.format(columnsfileName))
+		self.count = header[1]
+		self.sections = {}
+		for i, name in enumerate(SECTIONS):
+			self.sections[name] = (header[2 + 2 * i], header[3 + 2 * i])
+
+		start, length = self.sections['meta']
+		meta = json.loads(self.map[start:start + length])
+		self.hostname = meta['hostname_s'].encode('latin-1') if meta['hostname_s'] is not None else None
+		self.collectionTime = meta['collection_dt'].encode('latin-1') if meta['collection_dt'] is not None else None
+		# rows kept as entry lines, sorted
+		self.lines = dict((int(row), line.encode('latin-1')) for row, line in meta['lines'].items())
+		self.rows = sorted(self.lines)
+
+		self.ids = self.sections['id'][0]
+		# (start, bytes per row) of each column compared by same()
+		self.columns = [(self.sections[column][0], width) for column, width in COLUMNS]
+		self.mtimes = self.sections['mtime'][0]
+		self.sizes = self.sections['size'][0]
+		self.permissions = self.sections['permission'][0]
+		self.types = self.sections['type'][0]
+
+	def close(self):
+		self.map.close()
+
+	def id(self, row):
+		return struct.unpack_from('<I', self.map, self.ids + 4 * row)[0]
+
+	def name(self, row):
+		return self.paths.path(self.id(row))
+
+	def mtime(self, row):
+		return struct.unpack_from('<q', self.map, self.mtimes + 8 * row)[0]
+
+	def size(self, row):
+		return struct.unpack_from('<q', self.map, self.sizes + 8 * row)[0]
+
+	def permission(self, row):
+		return decodePermission(struct.unpack_from('<H', self.map, self.permissions + 2 * row)[0])
+
+	def type(self, row):
+		return self.map[self.types + row]
+
+	def line(self, row):
+		''' the entry line of a row, as TLData.TLSnapshot has it '''
+
+		line = self.lines.get(row)
+		if line is not None:
+			return line
+		return LINE.format(self.name(row), TLData.formatTime(self.mtime(row)), self.size(row), self.permission(row), self.type(row))
+
+	def findId(self, id):
+		''' row of a file name id, None if the snapshot has no such file '''
+
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) / 2
+			if self.id(mid) < id:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < self.count and self.id(lo) == id:
+			return lo
+		return None
+
+	def find(self, name):
+		''' row of a file name, None if the snapshot has no such file '''
+
+		id = self.paths.ids([name])[0]
+		if id is None:
+			return None
+		return self.findId(id)
+
+	def iterEntries(self):
+		''' yield (file name, entry line) in order of file name id '''
+
+		for row in range(self.count):
+			yield (self.name(row), self.line(row))
+
+	def hasLines(self, row, count):
+		''' True if any of count rows from row is kept as an entry line '''
+
+		if len(self.rows) == 0:
+			return False
+		i = bisect.bisect_left(self.rows, row)
+		return i < len(self.rows) and self.rows[i] < row + count
+
+	def same(self, other, row, otherRow, count):
+		''' True if count rows from row hold the same entries as count rows from otherRow of other '''
+
+		if self.hasLines(row, count) or other.hasLines(otherRow, count):
+			return False
+
+		for (start, width), (otherStart, otherWidth) in zip(self.columns, other.columns):
+			start += width * row
+			otherStart += width * otherRow
+			if self.map[start:start + width * count] != other.map[otherStart:otherStart + width * count]:
+				return False
+		return True
+
+	def iterChanges(self, other, prefix=None):
+		'''
+			Yield (file name, entry line here, entry line in other) of every
+			file that differs between this snapshot and other, a line is None
+			if the file is missing from that snapshot. With prefix, only
+			files whose name starts with it are looked at.
+		'''
+
+		if prefix is not None:
+			for change in self.iterPrefixChanges(other, prefix):
+				yield change
+			return
+
+		i, j = 0, 0
+		count = TL_COLUMNS_BLOCK
+		while i < self.count and j < other.count:
+			count = min(count, self.count - i, other.count - j)
+			if self.same(other, i, j, count):
+				i += count
+				j += count
+				# back up to whole blocks while rows keep matching
+				count = min(2 * count, TL_COLUMNS_BLOCK)
+				continue
+			if count > 1:
+				# narrow down on the first row that differs
+				count /= 2
+				continue
+
+			id, otherId = self.id(i), other.id(j)
+			if id == otherId:
+				change = self.change(other, i, j)
+				if change is not None:
+					yield change
+				i += 1
+				j += 1
+			elif id < otherId:
+				yield (self.name(i), self.line(i), None)
+				i += 1
+			else:
+				yield (other.name(j), None, other.line(j))
+				j += 1
+
+		for row in range(i, self.count):
+			yield (self.name(row), self.line(row), None)
+		for row in range(j, other.count):
+			yield (other.name(row), None, other.line(row))
+
+	def iterPrefixChanges(self, other, prefix):
+		''' iterChanges() of the files under prefix, looked up by id '''
+
+		for name, id in self.paths.find(prefix):
+			row, otherRow = self.findId(id), other.findId(id)
+			if row is None and otherRow is None:
+				continue
+			if otherRow is None:
+				yield (name, self.line(row), None)
+			elif row is None:
+				yield (name, None, other.line(otherRow))
+			else:
+				change = self.change(other, row, otherRow)
+				if change is not None:
+					yield change
+
+	def change(self, other, row, otherRow):
+		''' (file name, entry line here, entry line in other) of a file in both, None if it has not changed '''
+
+		if row in self.lines or otherRow in other.lines:
+			line, otherLine = self.line(row), other.line(otherRow)
+			if line == otherLine:
+				return None
+			return (self.name(row), line, otherLine)
+		if self.same(other, row, otherRow, 1):
+			return None
+		return (self.name(row), self.line(row), other.line(otherRow))
+
+def openColumns(baseDatafileName):
+	''' return the TLColumnarSnapshot of a snapshot, None if it has no columnar form '''
+
+	m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+	paths = TLPaths.getDictionary(m.group(1) + '/' + m.group(2))
+	try:
+		return TLColumnarSnapshot(baseDatafileName + '.col', paths)
+	except (IOError, OSError):
+		# not written, or in a format of an older version
+		return None
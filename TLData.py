@@ -8,93 +8,833 @@ import multiprocessing
 import bottle
 import re
 import subprocess
-import gzip
 import StringIO
+import zlib
+import io
+import errno
+import fcntl
+import threading
+import hashlib
+import struct
+import bisect
+import calendar
+import time
+import _strptime	# imported by time.strptime() on first use, which threads can race
+import TLCatalog
+import TLReader
+
+from collections import OrderedDict
 
 try: import simplejson as json
 except ImportError: import json
 
 TL_DATA_DIR	=	'./data'
+TL_CHUNK_SIZE	=	64 * 1024	# bytes read from the request body at a time
+TL_HASH_DEPTH	=	1	# path components naming a subtree hashed on its own
+TL_KEYFRAME_INTERVAL	=	32	# with delta storage, every snapshot whose index is a multiple of this is kept in full
+TL_BASE_MISMATCH	=	0.5	# with shared storage, a snapshot with more of its lines missing from every base becomes a new base
+TL_BASE_CANDIDATES	=	4	# most recently used bases of a namespace a snapshot is matched against
+TL_COMPRESS_LEVEL	=	6	# gzip level of the artifacts written, 0 writes them as plain text
+TL_SEGMENT_SIZE	=	256	# snapshots of a source packed into one segment file, not to be changed once segments are written
+TL_SEGMENT_GARBAGE	=	0.5	# share of the data of a segment replaced or removed after which it is rewritten
+TL_SEGMENT_BUFFER	=	1024 * 1024	# bytes read from a segment at a time when scanning it
+TL_SEGMENT_CACHE	=	256	# segments whose records are kept in memory
+
+# artifacts packed into segments; .col files are memory-mapped, so stay apart
+PACKED		=	('', '.delta', '.diff', '.json', '.tag.json', '.index', '.hash')
 
 logger = logging.getLogger(__name__)
 
+# TLCache of parsed snapshots keyed by (namespace,source,index), set up by the
+# server process; without it every readSnapshot() parses the file again. The
+# diff stage keeps the lines of the snapshots it diffed there too, see
+# TLDiff.TLDiffData.writeDiff()
+snapshotCache = None
+
 class TLIndex:
 	'''
+		Allocates snapshot indexes of a (namespace,source), kept in the catalog
+		of the data root (see TLCatalog)
 	'''
 
 	def __init__(self, namespace, source):
 		self.namespace = namespace
 		self.source = source
+		self.baseDirName = TL_DATA_DIR + '/' + self.namespace + '/' + self.source
 
-		baseDirName = TL_DATA_DIR + '/' + self.namespace + '/' + self.source
-		metafileName = baseDirName + '/' + '.metafile'
+	def allocate(self):
+		''' reserve the next snapshot index, return its base data file name '''
 
-		if not os.path.isdir(baseDirName):
-			try:
-				logger.info("Creating directory {0}".format(baseDirName))
-				os.makedirs(baseDirName)
-			except:
-				logger.error("Cannot create directory {0}".format(baseDirName))
-
-		if not os.path.isfile(metafileName):
-			try:
-				logger.info("Creating metafile {0}".format(metafileName))
-				metafile = open(metafileName, 'w')
-				metafile.write('0')
-				metafile.close
-			except:
-				logger.error("Cannot create metafile {0}".format(metafileName))
+		try:
+			index = TLCatalog.TLCatalog().allocate(self.namespace, self.source)
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return None
+		return self.baseDirName + '/' + str(index)
 
 	def getBaseDatafileName(self):
+		''' base data file name the next snapshot will get '''
+
 		try:
-			baseDirName = TL_DATA_DIR + '/' + self.namespace + '/' + self.source
-			metafileName = baseDirName + '/' + '.metafile'
-			metafile = open(metafileName, 'r')
-			index = int(metafile.read())
-			baseDatafileName = baseDirName + '/' + str(index)
-			metafile.close()
-			return baseDatafileName
+			index = TLCatalog.TLCatalog().getNext(self.namespace, self.source)
 		except:
 			logger.error(traceback.format_exc().split('\n'))
+			return None
+		return self.baseDirName + '/' + str(index)
+
+
+class TLArtifactWriter:
+	'''
+		Writes an artifact (raw data, .diff, .json, ...) gzip compressed as
+		<name>.gz, or as plain <name> if TL_COMPRESS_LEVEL is 0
+
+		Data goes to a .tmp file first, which close() moves into place, so
+		readers never see a partly written artifact. An artifact of a snapshot
+		already packed into a segment (see TLSegment) is added to it instead.
+	'''
+
+	def __init__(self, fileName, sync=False):
+		if TL_COMPRESS_LEVEL > 0:
+			self.fileName = fileName + '.gz'
+			self.otherFileName = fileName
+			# 16 + MAX_WBITS writes a gzip header, so gzip and zcat can read it
+			self.compressor = zlib.compressobj(TL_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		else:
+			self.fileName = fileName
+			self.otherFileName = fileName + '.gz'
+			self.compressor = None
+		self.sync = sync
+		self.f = open(self.fileName + '.tmp', 'w')
+
+	def write(self, data):
+		if self.compressor is not None:
+			data = self.compressor.compress(data)
+		self.f.write(data)
+
+	def close(self, mtime=None):
+		''' move the artifact into place, with mtime as its modification time if given '''
+
+		if self.compressor is not None:
+			self.f.write(self.compressor.flush())
+		if self.sync:
+			self.f.flush()
+			os.fsync(self.f.fileno())
+		self.f.close()
+		if mtime is not None:
+			os.utime(self.fileName + '.tmp', (mtime, mtime))
+
+		if not addPacked(self.fileName + '.tmp', self.fileName):
+			os.rename(self.fileName + '.tmp', self.fileName)
+
+		# a copy written with the other setting would shadow this one
+		if os.path.isfile(self.otherFileName):
+			os.remove(self.otherFileName)
+		removePacked(self.otherFileName)
+
+	def abort(self):
+		self.f.close()
+		if os.path.isfile(self.fileName + '.tmp'):
+			os.remove(self.fileName + '.tmp')
+
+class TLArtifactReader:
+	'''
+		Reads a gzip compressed artifact like a plain file, decompressing
+		TL_CHUNK_SIZE bytes of it at a time
+	'''
+
+	def __init__(self, f):
+		self.f = f
+		self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		self.buffer = ''
+		self.pos = 0		# start of the data not read yet in self.buffer
+		self.eof = False
+
+	def fill(self):
+		''' add the next chunk of decompressed data to the buffer '''
+
+		data = []
+		chunk = self.f.read(TL_CHUNK_SIZE)
+		if not chunk:
+			data.append(self.decompressor.flush())
+			self.eof = True
+		while chunk:
+			data.append(self.decompressor.decompress(chunk))
+			# gzip allows several members back to back
+			chunk = self.decompressor.unused_data
+			if chunk:
+				data.append(self.decompressor.flush())
+				self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+		self.buffer = self.buffer[self.pos:] + ''.join(data)
+		self.pos = 0
+
+	def read(self, size=-1):
+		while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+			self.fill()
+		if size < 0:
+			size = len(self.buffer) - self.pos
+		data = self.buffer[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def readline(self):
+		while True:
+			i = self.buffer.find('\n', self.pos)
+			if i >= 0 or self.eof:
+				break
+			self.fill()
+
+		end = i + 1 if i >= 0 else len(self.buffer)
+		line = self.buffer[self.pos:end]
+		self.pos = end
+		return line
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+	def close(self):
+		self.f.close()
+
+class TLSegmentReader:
+	'''
+		Reads an artifact packed into a segment like a plain file, length
+		bytes of an open segment file from offset on
+	'''
+
+	def __init__(self, f, offset, length, shared=False):
+		self.f = f
+		self.length = length
+		self.remaining = length
+		self.shared = shared	# f is read on by iterArtifacts(), close() leaves it open
+		f.seek(offset)
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.f.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def readline(self):
+		line = self.f.readline(self.remaining)
+		self.remaining -= len(line)
+		return line
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+	def close(self):
+		if not self.shared:
+			self.f.close()
+
+class TLSegmentStat:
+	''' the part of os.stat() of an artifact packed into a segment that is kept '''
+
+	def __init__(self, length, mtime):
+		self.st_size = length
+		self.st_mtime = mtime
+		self.st_atime = mtime
+
+def createArtifact(fileName, sync=False):
+	''' return a TLArtifactWriter for an artifact, fsync'ed before it is moved into place if sync is set '''
+
+	return TLArtifactWriter(fileName, sync)
+
+def openArtifact(fileName, decompress=True):
+	'''
+		Return a file object reading an artifact, plain or compressed, IOError
+		if there is neither. Without decompress, a compressed artifact is read
+		as it is stored.
+	'''
+
+	try:
+		return open(fileName, 'r')
+	except IOError:
+		pass
+	try:
+		f = open(fileName + '.gz', 'rb')
+	except IOError:
+		f = openPacked(fileName)
+		if f is None:
+			raise IOError(errno.ENOENT, 'No such artifact', fileName)
+		if not f.compressed:
+			return f
+	if not decompress:
+		return f
+	return TLArtifactReader(f)
+
+def artifactExists(fileName):
+	return os.path.isfile(fileName) or os.path.isfile(fileName + '.gz') or findPacked(fileName) is not None
+
+def artifactCompressed(fileName):
+	''' True if an artifact is stored gzip compressed '''
+
+	if os.path.isfile(fileName):
+		return False
+	if os.path.isfile(fileName + '.gz'):
+		return True
+	found = findPacked(fileName)
+	return found is not None and found[2].endswith('.gz')
+
+def statArtifact(fileName):
+	''' os.stat() of an artifact, plain or compressed '''
+
+	try:
+		return os.stat(fileName)
+	except OSError:
+		pass
+	try:
+		return os.stat(fileName + '.gz')
+	except OSError:
+		pass
+	found = findPacked(fileName)
+	if found is None:
+		raise OSError(errno.ENOENT, 'No such artifact', fileName)
+	segment, index, suffix, (offset, length, mtime) = found
+	return TLSegmentStat(length, mtime)
+
+def artifactFileName(fileName):
+	''' name of the file holding an artifact, plain or compressed '''
+
+	if os.path.isfile(fileName):
+		return fileName
+	return fileName + '.gz'
+
+def removeArtifact(fileName):
+	for name in (fileName, fileName + '.gz'):
+		if os.path.isfile(name):
+			os.remove(name)
+	removePacked(fileName)
+	removePacked(fileName + '.gz')
+
+class TLSegment:
+	'''
+		Artifacts of TL_SEGMENT_SIZE consecutive snapshots of a source packed
+		into one file, so they take two inodes instead of one each
+
+		<source>/.segments/<first index>.idx starts with a generation number
+		and holds a fixed size (index, suffix, offset, length, mtime) record
+		per artifact, appended whenever an artifact is added, replaced or
+		removed (length -1); the last record of an artifact wins. The data
+		lives in <first index>.<generation>.seg, back to back, those of one
+		suffix sorted by index, so scanning e.g. all .json of a segment reads
+		it in order. Each process keeps the records in a dict and only reads
+		those appended since it last looked, like TLTimeIndex does, so finding
+		an artifact is a lookup.
+
+		A segment with more than TL_SEGMENT_GARBAGE of its data replaced or
+		removed is rewritten as the next generation, and its .idx replaced.
+		Writers of a source serialize on an flock of .segments/.lock.
+	'''
+
+	MAGIC = 'TLSEG001'
+	header = struct.Struct('<8sQ')			# magic, generation
+	record = struct.Struct('<I16sqqd')		# index, suffix, offset, length, mtime
+
+	def __init__(self, baseDirName, first):
+		self.dirName = baseDirName + '/.segments'
+		self.first = first
+		self.indexfileName = self.dirName + '/' + str(first) + '.idx'
+		self.lock = threading.Lock()
+		self.reset(None)
+
+	def reset(self, inode):
+		self.entries = {}	# (index, suffix) -> (offset, length, mtime)
+		self.size = 0		# bytes of .idx loaded
+		self.inode = inode	# of the .idx loaded
+		self.generation = None
+		self.live = 0		# bytes of data still used
+
+	def datafileName(self, generation=None):
+		if generation is None:
+			generation = self.generation
+		return '{0}/{1}.{2}.seg'.format(self.dirName, self.first, generation)
+
+	def load(self):
+		''' pick up what other processes have written, must hold self.lock '''
+
+		try:
+			f = open(self.indexfileName, 'rb')
+		except IOError:
+			self.reset(None)
+			return
+
+		try:
+			st = os.fstat(f.fileno())
+			if st.st_ino != self.inode or st.st_size < self.size:
+				# rewritten, start over
+				self.reset(st.st_ino)
+			if st.st_size == self.size:
+				return
+			f.seek(self.size)
+			data = f.read()
+		finally:
+			f.close()
+
+		offset = 0
+		if self.size == 0:
+			magic, self.generation = self.header.unpack_from(data, 0)
+			if magic != self.MAGIC:
+				raise IOError('Malformed segment index {0}'.format(self.indexfileName))
+			offset = self.header.size
+
+		# a record still being appended is picked up next time
+		end = offset + (len(data) - offset) / self.record.size * self.record.size
+		for o in range(offset, end, self.record.size):
+			index, suffix, start, length, mtime = self.record.unpack_from(data, o)
+			key = (index, suffix.rstrip('\0'))
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.live -= old[1]
+			if length >= 0:
+				self.entries[key] = (start, length, mtime)
+				self.live += length
+		self.size += end
+
+	def exists(self):
+		with self.lock:
+			self.load()
+			return self.inode is not None
+
+	def find(self, index, suffix):
+		''' (offset, length, mtime) of an artifact, None if the segment does not hold it '''
+
+		with self.lock:
+			self.load()
+			return self.entries.get((index, suffix))
+
+	def open(self, offset, length):
+		'''
+			Return a TLSegmentReader of the data at offset, None if the segment
+			has been rewritten since it was last loaded
+		'''
+
+		with self.lock:
+			datafileName = self.datafileName()
+		try:
+			f = open(datafileName, 'rb')
+		except IOError:
+			return None
+		return TLSegmentReader(f, offset, length)
+
+	def add(self, artifacts):
+		'''
+			Append artifacts, (index, suffix, file name holding the data, mtime),
+			must hold the lock of the segments of the source
+		'''
+
+		with self.lock:
+			self.load()
+			if self.inode is None:
+				self.create()
+
+			records = []
+			datafile = open(self.datafileName(), 'ab')
+			try:
+				offset = os.fstat(datafile.fileno()).st_size
+				for index, suffix, fileName, mtime in artifacts:
+					length = 0
+					f = open(fileName, 'rb')
+					try:
+						while True:
+							data = f.read(TL_SEGMENT_BUFFER)
+							if not data:
+								break
+							datafile.write(data)
+							length += len(data)
+					finally:
+						f.close()
+					records.append(self.record.pack(index, suffix, offset, length, mtime))
+					offset += length
+				datafile.flush()
+				os.fsync(datafile.fileno())
+			finally:
+				datafile.close()
+
+			self.append(records)
+
+	def remove(self, index, suffix):
+		''' forget an artifact, must hold the lock of the segments of the source '''
+
+		with self.lock:
+			self.load()
+			if (index, suffix) in self.entries:
+				self.append([self.record.pack(index, suffix, 0, -1, 0)])
+
+	def append(self, records):
+		f = open(self.indexfileName, 'ab')
+		try:
+			f.write(''.join(records))
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		self.load()
+
+	def create(self):
+		''' write an empty segment, must hold self.lock '''
+
+		if not os.path.isdir(self.dirName):
+			os.makedirs(self.dirName)
+		open(self.datafileName(0), 'wb').close()
+		self.writeIndex(0, [])
+		self.load()
+
+	def writeIndex(self, generation, records):
+		f = open(self.indexfileName + '.tmp', 'wb')
+		try:
+			f.write(self.header.pack(self.MAGIC, generation))
+			f.write(''.join(records))
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(self.indexfileName + '.tmp', self.indexfileName)
+
+	def garbage(self):
+		''' share of the data no longer used '''
+
+		with self.lock:
+			self.load()
+			try:
+				size = os.stat(self.datafileName()).st_size
+			except OSError:
+				return 0
+			return 1 - float(self.live) / size if size > 0 else 0
+
+	def rewrite(self):
+		''' write the artifacts still used as the next generation, must hold the lock of the segments of the source '''
+
+		with self.lock:
+			self.load()
+			generation = self.generation + 1
+			records = []
+			datafile = open(self.datafileName(generation), 'wb')
+			f = open(self.datafileName(), 'rb')
+			try:
+				offset = 0
+				for (index, suffix), (start, length, mtime) in sorted(self.entries.items(), key=packOrder):
+					f.seek(start)
+					remaining = length
+					while remaining > 0:
+						data = f.read(min(remaining, TL_SEGMENT_BUFFER))
+						datafile.write(data)
+						remaining -= len(data)
+					records.append(self.record.pack(index, suffix, offset, length, mtime))
+					offset += length
+				datafile.flush()
+				os.fsync(datafile.fileno())
+			finally:
+				f.close()
+				datafile.close()
+
+			old = self.datafileName()
+			self.writeIndex(generation, records)
+			# readers still having the old generation open read on from it,
+			# others reload the index and retry
+			os.remove(old)
+			self.load()
+
+		logger.info("Rewrote segment {0}".format(self.indexfileName))
+
+def packOrder(item):
+	''' sort key of (index, suffix) entries, artifacts of the same kind together '''
+
+	(index, suffix), entry = item
+	kind = suffix[:-3] if suffix.endswith('.gz') else suffix
+	return (PACKED.index(kind) if kind in PACKED else len(PACKED), suffix, index)
+
+# (base dir, first index) -> TLSegment, least recently used first
+segments = OrderedDict()
+segmentsLock = threading.Lock()
+
+artifactpattern = re.compile(r'^(.*)/([0-9]+)((\.[a-z]+)*)$')
+
+def getSegment(baseDirName, index):
+	''' the TLSegment holding snapshot index of the source in baseDirName '''
+
+	key = (baseDirName, index - index % TL_SEGMENT_SIZE)
+	with segmentsLock:
+		segment = segments.pop(key, None)
+		if segment is None:
+			segment = TLSegment(*key)
+		segments[key] = segment
+		while len(segments) > TL_SEGMENT_CACHE:
+			segments.popitem(last=False)
+	return segment
+
+def findPacked(fileName):
+	'''
+		Return (segment, index, suffix, (offset, length, mtime)) of an artifact
+		packed into a segment, plain or compressed, None if it is not packed
+	'''
+
+	m = artifactpattern.match(fileName)
+	if m is None or not os.path.isdir(m.group(1) + '/.segments'):
+		return None
+	index = int(m.group(2))
+	segment = getSegment(m.group(1), index)
+	for suffix in (m.group(3), m.group(3) + '.gz'):
+		entry = segment.find(index, suffix)
+		if entry is not None:
+			return (segment, index, suffix, entry)
+	return None
+
+def openPacked(fileName):
+	''' TLSegmentReader of an artifact packed into a segment, None if it is not packed '''
+
+	for attempt in range(3):
+		found = findPacked(fileName)
+		if found is None:
+			return None
+		segment, index, suffix, (offset, length, mtime) = found
+		f = segment.open(offset, length)
+		if f is not None:
+			f.compressed = suffix.endswith('.gz')
+			return f
+		# the segment has just been rewritten, its records are reloaded
+	return None
+
+def lockSegments(baseDirName):
+	''' return a descriptor holding the lock of the segments of a source, close it to release the lock '''
+
+	dirName = baseDirName + '/.segments'
+	if not os.path.isdir(dirName):
+		try:
+			os.makedirs(dirName)
+		except OSError:
+			# another process may have created it in the meantime
+			if not os.path.isdir(dirName):
+				raise
+	fd = os.open(dirName + '/.lock', os.O_RDWR | os.O_CREAT, 0644)
+	fcntl.flock(fd, fcntl.LOCK_EX)
+	return fd
+
+def addPacked(tmpfileName, fileName):
+	'''
+		Add the data in tmpfileName to the segment of artifact fileName, if
+		that snapshot has been packed, and remove it. Return False if it has not.
+	'''
+
+	m = artifactpattern.match(fileName)
+	if m is None or not os.path.isdir(m.group(1) + '/.segments'):
+		return False
+	if (m.group(3)[:-3] if m.group(3).endswith('.gz') else m.group(3)) not in PACKED:
+		return False
+	index = int(m.group(2))
+	segment = getSegment(m.group(1), index)
+	if not segment.exists():
+		return False
+
+	fd = lockSegments(m.group(1))
+	try:
+		segment.add([(index, m.group(3), tmpfileName, os.stat(tmpfileName).st_mtime)])
+	finally:
+		os.close(fd)
+	os.remove(tmpfileName)
+	# an older copy left behind would shadow it
+	if os.path.isfile(fileName):
+		os.remove(fileName)
+	return True
+
+def removePacked(fileName):
+	''' forget an artifact packed into a segment, if it is '''
+
+	m = artifactpattern.match(fileName)
+	if m is None or not os.path.isdir(m.group(1) + '/.segments'):
+		return
+	index = int(m.group(2))
+	segment = getSegment(m.group(1), index)
+	if segment.find(index, m.group(3)) is None:
+		return
+
+	fd = lockSegments(m.group(1))
+	try:
+		segment.remove(index, m.group(3))
+	finally:
+		os.close(fd)
+
+def iterArtifacts(baseDirName, suffix, indexes):
+	'''
+		Yield (index, file object) of the artifacts of snapshots indexes of a
+		source with a suffix, e.g. '.json', skipping snapshots without one.
+		Those packed into the same segment are read through one open file,
+		TL_SEGMENT_BUFFER bytes at a time, so each file object has to be read
+		before the next one is asked for.
+	'''
+
+	segment = None
+	f = None
+	try:
+		for index in indexes:
+			fileName = baseDirName + '/' + str(index) + suffix
+			if os.path.isfile(fileName) or os.path.isfile(fileName + '.gz'):
+				yield (index, openArtifact(fileName))
+				continue
+
+			found = findPacked(fileName)
+			if found is None:
+				continue
+			if found[0] is not segment:
+				if f is not None:
+					f.close()
+					f = None
+				segment = found[0]
+				try:
+					f = io.open(segment.datafileName(), 'rb', buffering=TL_SEGMENT_BUFFER)
+				except IOError:
+					# just rewritten
+					segment = None
+					yield (index, openArtifact(fileName))
+					continue
+
+			offset, length, mtime = found[3]
+			reader = TLSegmentReader(f, offset, length, shared=True)
+			if found[2].endswith('.gz'):
+				reader = TLArtifactReader(reader)
+			yield (index, reader)
+	finally:
+		if f is not None:
+			f.close()
+
+class TLSegmentWriter:
+	'''
+		Packs the artifacts of the snapshots of a source into segments (see
+		TLSegment), once every snapshot of a segment has been ingested, and
+		rewrites segments with more than TL_SEGMENT_GARBAGE of their data no
+		longer used
+	'''
+
+	namepattern = re.compile(r'^([0-9]+)((\.[a-z]+)*)$')
+
+	def write(self, baseDatafileName):
+		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1)
+		# the snapshot before this one is still read by the next one's stages
+		limit = int(m.group(2)) - 1
+
+		try:
+			# first index of a segment -> [(index, suffix, file name)]
+			loose = {}
+			for name in os.listdir(baseDirName):
+				n = self.namepattern.match(name)
+				if n is None:
+					continue
+				suffix = n.group(2)
+				if (suffix[:-3] if suffix.endswith('.gz') else suffix) not in PACKED:
+					# .tmp files among them
+					continue
+				index = int(n.group(1))
+				first = index - index % TL_SEGMENT_SIZE
+				if index >= limit:
+					continue
+				if first + TL_SEGMENT_SIZE > limit and not getSegment(baseDirName, index).exists():
+					# snapshots of it are still being ingested
+					continue
+				loose.setdefault(first, []).append((index, suffix, baseDirName + '/' + name))
+
+			if len(loose) == 0 and not os.path.isdir(baseDirName + '/.segments'):
+				return True
+
+			fd = lockSegments(baseDirName)
+			try:
+				for first, artifacts in sorted(loose.items()):
+					self.pack(baseDirName, first, artifacts)
+
+				for name in os.listdir(baseDirName + '/.segments'):
+					if name.endswith('.idx'):
+						segment = getSegment(baseDirName, int(name[:-4]))
+						if segment.garbage() > TL_SEGMENT_GARBAGE:
+							segment.rewrite()
+			finally:
+				os.close(fd)
 
-	def incrementIndex(self):
-		try:
-			baseDirName = TL_DATA_DIR + '/' + self.namespace + '/' + self.source
-			metafileName = baseDirName + '/' + '.metafile'
-			metafile = open(metafileName, 'r+')
-			index = int(metafile.read())
-			baseDatafileName = baseDirName + '/' + str(index)
-			metafile.seek(0)
-			metafile.truncate()
-			metafile.write(str(index+1))
-			metafile.close()
 		except:
 			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def pack(self, baseDirName, first, artifacts):
+		''' move loose artifacts into the segment starting at first, must hold the lock of the segments '''
+
+		stats = []
+		for index, suffix, fileName in artifacts:
+			try:
+				stats.append((index, suffix, fileName, os.stat(fileName)))
+			except OSError:
+				# replaced or removed in the meantime
+				continue
+		stats.sort(key=lambda s: packOrder(((s[0], s[1]), None)))
+
+		getSegment(baseDirName, first).add([(index, suffix, fileName, st.st_mtime) for index, suffix, fileName, st in stats])
 
+		for index, suffix, fileName, st in stats:
+			try:
+				# unless it has been written again since
+				if os.stat(fileName).st_ino == st.st_ino:
+					os.remove(fileName)
+			except OSError:
+				pass
+
+		logger.info("Packed {0} artifacts into segment {1} of {2}".format(len(stats), first, baseDirName))
 
 class TLRawData:
 	'''
 		Writing raw data collected by TL agent to disk
 	'''
 
-	def write(self, baseDatafileName, data, compressed=False):
+	def write(self, baseDatafileName, body, length=None, compressed=False):
+		'''
+			Stream the request body to disk in TL_CHUNK_SIZE pieces, gunzipping
+			on the fly if needed, so memory use does not depend on snapshot size
+		'''
 
+		datafile = None
 		try:
 			if compressed:
-				data_sio = StringIO.StringIO(data)
-				with gzip.GzipFile(fileobj=data_sio, mode="rb") as f:
-					data = f.read()
-				f.close()
+				# 16 + MAX_WBITS tells zlib to expect a gzip header
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+			# make sure the data survives a crash before it is acknowledged
+			datafile = createArtifact(baseDatafileName, sync=True)
+			remaining = length
+			while remaining is None or remaining > 0:
+				size = TL_CHUNK_SIZE
+				if remaining is not None:
+					size = min(size, remaining)
+				chunk = body.read(size)
+				if not chunk:
+					break
+				if remaining is not None:
+					remaining -= len(chunk)
+
+				if compressed:
+					while chunk:
+						datafile.write(decompressor.decompress(chunk))
+						# gzip allows several members back to back
+						chunk = decompressor.unused_data
+						if chunk:
+							datafile.write(decompressor.flush())
+							decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+				else:
+					datafile.write(chunk)
+
+			if compressed:
+				datafile.write(decompressor.flush())
 
-			datafile = open(baseDatafileName, 'w')
 			# adding newline at the end to prevent 'diff' from complaining
-			datafile.write(data+'\n') 
+			datafile.write('\n')
 			datafile.close()
 
 		except:
 			logger.error(traceback.format_exc().split('\n'))
+			if datafile is not None:
+				datafile.abort()
+			return False
 
 		logger.info("Creating raw file {0}".format(baseDatafileName))
+		return True
 
 
 class TLRawDataIndex:
@@ -103,35 +843,713 @@ class TLRawDataIndex:
 		Output file can be used to feed into Solr
 	'''
 
-	def write(self, baseDatafileName, data, compressed=False):
+	def write(self, baseDatafileName):
 
 		datafileName = baseDatafileName + '.index'
 
+		datafile = None
 		try:
-			if compressed:
-				data_sio = StringIO.StringIO(data)
-				with gzip.GzipFile(fileobj=data_sio, mode="rb") as f:
-					data = f.read()
-				f.close()
-
-			files = []
-			j = json.loads(data)
-			hostname = j['hostname_s']
-			collectionTime = j['collection_dt']
-			for file in j['files']:
-				file['id'] = file['name_s'] + ':' + collectionTime
-				file['hostname_s'] = hostname
-				file['collection_dt'] = collectionTime
-				files.append(file)
-
-			datafile = open(datafileName, 'w')
-			json.dump(files, datafile, indent=2)
-			# adding newline at the end to prevent 'diff' from complaining
-			datafile.write('\n') 
-			datafile.close()
+			# raw data has already been decompressed by TLRawData
+			reader = TLReader.TLSnapshotReader(openSnapshot(baseDatafileName))
+			try:
+				datafile = createArtifact(datafileName)
+				TLReader.writeList(datafile, self.iterFiles(reader), indent=2)
+				datafile.close()
+			finally:
+				reader.close()
 
 		except:
 			logger.error(traceback.format_exc().split('\n'))
+			if datafile is not None:
+				datafile.abort()
 
 		logger.info("Creating raw index file {0}".format(datafileName))
 		return
+
+	def iterFiles(self, reader):
+		''' yield the file entries of raw data, along with the header fields and an id '''
+
+		for file in reader.records():
+			# the header comes before the first entry
+			file['id'] = file['name_s'] + ':' + reader.collectionTime
+			file['hostname_s'] = reader.hostname
+			file['collection_dt'] = reader.collectionTime
+			yield file
+
+class TLRawDataHash:
+	'''
+		Hash the file entries of raw data, as a whole and per subtree, so an
+		agent can tell whether anything changed since its last upload
+
+		Each entry line is hashed with surrounding whitespace and its trailing
+		',' removed, which is what agent.sh computes with sed and sha1sum.
+		Header lines (hostname_s, collection_dt) are left out, since they
+		change with every collection.
+	'''
+
+	# (namespace,source) -> (index, hashes) of the latest snapshot
+	latest = {}
+	latestLock = threading.Lock()
+
+	def write(self, baseDatafileName):
+
+		datafileName = baseDatafileName + '.hash'
+
+		datafile = None
+		try:
+			hashes = self.compute(baseDatafileName)
+
+			datafile = createArtifact(datafileName)
+			datafile.write(json.dumps(hashes))
+			datafile.close()
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			if datafile is not None:
+				datafile.abort()
+			return False
+
+		logger.info("Creating raw hash file {0}".format(datafileName))
+		return True
+
+	def compute(self, baseDatafileName):
+		whole = hashlib.sha1()
+		subtrees = {}
+
+		reader = TLReader.TLSnapshotReader(openSnapshot(baseDatafileName))
+		try:
+			for name, line in reader.entries():
+				line += '\n'
+				whole.update(line)
+
+				if name is None:
+					continue
+				subtree = self.subtree(name)
+				if subtree not in subtrees:
+					subtrees[subtree] = hashlib.sha1()
+				subtrees[subtree].update(line)
+		finally:
+			reader.close()
+
+		result = { 'hash': whole.hexdigest(), 'subtrees': {} }
+		for subtree, h in subtrees.items():
+			result['subtrees'][subtree] = h.hexdigest()
+		return result
+
+	def subtree(self, name):
+		''' /usr/lib64/libc.so -> /usr with TL_HASH_DEPTH of 1 '''
+		return '/' + '/'.join(name.split('/')[1:TL_HASH_DEPTH+1])
+
+	def getLatest(self, namespace, source):
+		'''
+			Return (index, hashes) of the latest snapshot of a source, hashes
+			is None if that snapshot has not been hashed yet
+		'''
+
+		tli = TLIndex(namespace, source)
+		baseDatafileName = tli.getBaseDatafileName()
+		if baseDatafileName is None:
+			# the catalog could not be read, nothing to compare with
+			return (None, None)
+		index = int(os.path.basename(baseDatafileName)) - 1
+		if index < 0:
+			return (None, None)
+
+		with TLRawDataHash.latestLock:
+			cached = TLRawDataHash.latest.get((namespace, source))
+		if cached is not None and cached[0] == index:
+			return cached
+
+		try:
+			f = openArtifact(tli.baseDirName + '/' + str(index) + '.hash')
+			try:
+				hashes = json.loads(f.read())
+			finally:
+				f.close()
+		except IOError:
+			# still being uploaded or hashed
+			return (index, None)
+
+		with TLRawDataHash.latestLock:
+			TLRawDataHash.latest[(namespace, source)] = (index, hashes)
+		return (index, hashes)
+
+class TLSnapshot:
+	'''
+		Raw data of a snapshot parsed into a compact form: the header fields,
+		and each file entry line as read by TLReader.TLSnapshotReader, in file
+		order and by file name
+	'''
+
+	namepattern = TLReader.TLSnapshotReader.namepattern
+
+	# rough bytes of Python objects and dict slots kept per entry, on top
+	# of the characters of its line and name
+	entryOverhead = 160
+
+	def __init__(self, datafileName):
+		self.hostname = None
+		self.collectionTime = None	# as written by the agent, e.g. 2014-09-24T10:43:00Z
+		self.lines = []			# entry lines in file order
+		self.names = {}			# file name -> entry line
+		self.size = 0			# approximate bytes in memory
+
+		reader = TLReader.TLSnapshotReader(openSnapshot(datafileName))
+		try:
+			for name, line in reader.entries():
+				self.lines.append(line)
+				self.size += len(line) + self.entryOverhead
+				if name is not None:
+					self.names[name] = line
+					self.size += len(name)
+		finally:
+			reader.close()
+		self.hostname = reader.hostname
+		self.collectionTime = reader.collectionTime
+
+	def iterEntries(self):
+		''' yield (file name, entry line) in file order, name is None if it has none '''
+
+		for line in self.lines:
+			m = self.namepattern.match(line)
+			yield (m.group(1) if m is not None else None, line)
+
+def readSnapshot(baseDatafileName):
+	'''
+		Return the TLSnapshot of a raw data file, parsing the file only if
+		snapshotCache does not hold it yet
+	'''
+
+	if snapshotCache is None:
+		return TLSnapshot(baseDatafileName)
+
+	key = snapshotKey(baseDatafileName)
+	snapshot = snapshotCache.get(key)
+	if snapshot is None:
+		snapshot = TLSnapshot(baseDatafileName)
+		snapshotCache.put(key, snapshot, snapshot.size)
+	return snapshot
+
+def snapshotKey(baseDatafileName):
+	''' (namespace,source,index) of a snapshot, as snapshotCache is keyed by '''
+
+	m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+	return (m.group(2), m.group(3), int(m.group(4)))
+
+def snapshotExists(baseDatafileName):
+	''' True if the raw data of a snapshot is stored, in full or as a delta '''
+
+	return artifactExists(baseDatafileName) or artifactExists(baseDatafileName + '.delta')
+
+def statSnapshot(baseDatafileName):
+	''' os.stat() of the file holding the raw data of a snapshot, in full or as a delta '''
+
+	try:
+		return statArtifact(baseDatafileName)
+	except OSError:
+		return statArtifact(baseDatafileName + '.delta')
+
+def openSnapshot(baseDatafileName):
+	'''
+		Return a file object reading the raw data of a snapshot, rebuilding it
+		if it is stored as a delta. Raises IOError if there is no such snapshot.
+	'''
+
+	try:
+		return openArtifact(baseDatafileName)
+	except IOError:
+		if not artifactExists(baseDatafileName + '.delta'):
+			raise
+	return StringIO.StringIO(TLSnapshotDelta().read(baseDatafileName))
+
+class TLSnapshotBase:
+	'''
+		Bases shared by the snapshots of all sources of a namespace
+
+		Hosts built from the same image have most of their file entries in
+		common. With shared storage, snapshots are kept as deltas against the
+		base of their namespace they have the most lines in common with, so
+		entries found on every host are stored once per namespace rather
+		than once per source. Bases live in TL_DATA_DIR/<namespace>/.base,
+		named by the sha1 of their content, and never change once written.
+	'''
+
+	def __init__(self, namespaceDirName):
+		self.dirName = namespaceDirName + '/.base'
+
+	def fileName(self, name):
+		return self.dirName + '/' + name
+
+	def candidates(self):
+		''' names of the bases, most recently used first '''
+
+		try:
+			fileNames = [n for n in os.listdir(self.dirName) if not n.startswith('.') and not n.endswith('.tmp')]
+		except OSError:
+			return []
+
+		entries = []
+		for n in fileNames:
+			try:
+				entries.append((os.stat(self.dirName + '/' + n).st_mtime, n))
+			except OSError:
+				continue
+		entries.sort(reverse=True)
+		return [n[:-3] if n.endswith('.gz') else n for mtime, n in entries]
+
+	def read(self, name):
+		f = openArtifact(self.fileName(name))
+		try:
+			return f.read().split('\n')
+		finally:
+			f.close()
+
+	def find(self, lines):
+		'''
+			Return (name, lines) of the base having the fewest of lines
+			missing, None if every base misses more than TL_BASE_MISMATCH
+		'''
+
+		best = None
+		for name in self.candidates()[:TL_BASE_CANDIDATES]:
+			baseLines = self.read(name)
+			present = set(baseLines)
+			missing = 0
+			for line in lines:
+				if line not in present:
+					missing += 1
+			if best is None or missing < best[0]:
+				best = (missing, name, baseLines)
+
+		if best is None or best[0] > TL_BASE_MISMATCH * len(lines):
+			return None
+
+		# tried first next time
+		try:
+			os.utime(artifactFileName(self.fileName(best[1])), None)
+		except OSError:
+			pass
+		return best[1:]
+
+	def add(self, lines):
+		''' store lines as a base, return its name '''
+
+		data = '\n'.join(lines)
+		name = hashlib.sha1(data).hexdigest()
+
+		if not os.path.isdir(self.dirName):
+			try:
+				os.makedirs(self.dirName)
+			except OSError:
+				# another process may have created it in the meantime
+				if not os.path.isdir(self.dirName):
+					raise
+
+		# sources of the namespace ingested at the same time may add the same base
+		fd = os.open(self.dirName + '/.lock', os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			if not artifactExists(self.fileName(name)):
+				datafile = createArtifact(self.fileName(name), sync=True)
+				try:
+					datafile.write(data)
+					datafile.close()
+				except:
+					datafile.abort()
+					raise
+				logger.info("Created base {0}".format(self.fileName(name)))
+		finally:
+			os.close(fd)
+
+		return name
+
+class TLSnapshotDelta:
+	'''
+		Stores the raw data of a snapshot as its differences to the next
+		snapshot of the same source (a reverse delta)
+
+		The latest snapshot is always kept in full, so ingest and reads of
+		recent data are unaffected. Once the next snapshot has been diffed
+		against it, a snapshot is replaced by <n>.delta, unless its index is
+		a multiple of TL_KEYFRAME_INTERVAL. Rebuilding a snapshot thus takes
+		at most TL_KEYFRAME_INTERVAL-1 deltas, applied backwards from the
+		next full snapshot.
+
+		With shared set, the snapshots otherwise kept in full, keyframes and
+		the latest one, are instead stored as deltas against a base shared by
+		the whole namespace (see TLSnapshotBase), once every stage of their
+		own job is done reading them.
+
+		A delta is a header line 'TLDELTA <index of next snapshot>', or
+		'TLDELTA @<name of base>', followed by one line per operation on the
+		lines of that snapshot or base:
+			c <start> <count>	copy count lines starting at line start
+			+<line>			insert a line
+	'''
+
+	def __init__(self, shared=False):
+		self.shared = shared
+
+	def write(self, baseDatafileName):
+		'''
+			Replace the snapshot before this one with a delta against this
+			one, and with shared storage this one with a delta against a base
+		'''
+
+		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1)
+		index = int(m.group(2))
+
+		try:
+			baseLines = None
+			previous = index - 1
+			if previous >= 0 and previous % TL_KEYFRAME_INTERVAL != 0:
+				datafileName = baseDirName + '/' + str(previous)
+				header = self.header(datafileName)
+				# never uploaded, or already a delta against this one
+				if header is not None and header != str(index):
+					lines = self.read(datafileName).split('\n')
+					baseLines = self.read(baseDatafileName).split('\n')
+					self.replace(datafileName, str(index), self.encode(lines, baseLines))
+
+			if self.shared and self.header(baseDatafileName) == '':
+				if baseLines is None:
+					baseLines = self.read(baseDatafileName).split('\n')
+				bases = TLSnapshotBase(os.path.dirname(baseDirName))
+				found = bases.find(baseLines)
+				if found is None:
+					name = bases.add(baseLines)
+					found = (name, baseLines)
+				self.replace(baseDatafileName, '@' + found[0], self.encode(baseLines, found[1]))
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def header(self, datafileName):
+		''' what a snapshot is stored against, '' if stored in full, None if not stored '''
+
+		if artifactExists(datafileName):
+			return ''
+		try:
+			f = openArtifact(datafileName + '.delta')
+		except IOError:
+			return None
+		try:
+			header = f.readline().split()
+		finally:
+			f.close()
+		if len(header) != 2 or header[0] != 'TLDELTA':
+			raise IOError('Malformed delta {0}'.format(datafileName + '.delta'))
+		return header[1]
+
+	def replace(self, datafileName, against, ops):
+		''' store a snapshot as the delta ops against another snapshot or a base '''
+
+		deltafileName = datafileName + '.delta'
+		st = statSnapshot(datafileName)
+
+		datafile = createArtifact(deltafileName, sync=True)
+		try:
+			datafile.write('TLDELTA {0}\n'.format(against))
+			for op in ops:
+				datafile.write(op)
+			# keep Last-Modified of the snapshot as it was
+			datafile.close(st.st_mtime)
+		except:
+			datafile.abort()
+			raise
+		removeArtifact(datafileName)
+
+		logger.info("Stored raw file {0} as a delta against {1}".format(datafileName, against))
+
+	def depth(self, datafileName):
+		''' number of deltas applied to rebuild a snapshot '''
+
+		baseDirName = os.path.dirname(datafileName)
+		depth = 0
+		header = self.header(datafileName)
+		while header:
+			depth += 1
+			if header.startswith('@'):
+				break
+			header = self.header(baseDirName + '/' + header)
+		return depth
+
+	def rebase(self, datafileName, nextfileName):
+		'''
+			Store a snapshot kept as a delta against one about to be removed
+			(see TLRetention) as a delta against the next snapshot kept instead,
+			or in full if rebuilding it would then take TL_KEYFRAME_INTERVAL
+			deltas or more
+		'''
+
+		lines = self.read(datafileName).split('\n')
+		if self.depth(nextfileName) + 1 < TL_KEYFRAME_INTERVAL:
+			nextLines = self.read(nextfileName).split('\n')
+			self.replace(datafileName, os.path.basename(nextfileName), self.encode(lines, nextLines))
+			return
+
+		st = statSnapshot(datafileName)
+		datafile = createArtifact(datafileName, sync=True)
+		try:
+			datafile.write('\n'.join(lines))
+			datafile.close(st.st_mtime)
+		except:
+			datafile.abort()
+			raise
+		removeArtifact(datafileName + '.delta')
+
+		logger.info("Stored raw file {0} in full".format(datafileName))
+
+	def encode(self, lines, baseLines):
+		''' yield the operations building lines out of baseLines '''
+
+		# first position of every line of the base
+		positions = {}
+		for i in range(len(baseLines) - 1, -1, -1):
+			positions[baseLines[i]] = i
+
+		start = None	# base position of the run of copied lines
+		count = 0
+		for line in lines:
+			if start is not None and start + count < len(baseLines) and baseLines[start + count] == line:
+				count += 1
+				continue
+			if start is not None:
+				yield 'c {0} {1}\n'.format(start, count)
+				start = None
+			i = positions.get(line)
+			if i is not None:
+				start = i
+				count = 1
+			else:
+				yield '+' + line + '\n'
+		if start is not None:
+			yield 'c {0} {1}\n'.format(start, count)
+
+	def read(self, baseDatafileName):
+		''' return the raw data of a snapshot stored as a delta '''
+
+		baseDirName = os.path.dirname(baseDatafileName)
+
+		# follow the deltas up to the next snapshot kept in full, or a base
+		deltas = []
+		datafileName = baseDatafileName
+		while True:
+			try:
+				f = openArtifact(datafileName)
+				break
+			except IOError:
+				if len(deltas) > 0 and deltas[-1][1].startswith('@'):
+					raise
+				f = openArtifact(datafileName + '.delta')
+				header = f.readline().split()
+				if len(header) != 2 or header[0] != 'TLDELTA':
+					f.close()
+					raise IOError('Malformed delta {0}'.format(datafileName + '.delta'))
+				deltas.append((f, header[1]))
+				if header[1].startswith('@'):
+					datafileName = TLSnapshotBase(os.path.dirname(baseDirName)).fileName(header[1][1:])
+				else:
+					datafileName = baseDirName + '/' + header[1]
+
+		try:
+			lines = f.read().split('\n')
+		finally:
+			f.close()
+
+		while deltas:
+			f, against = deltas.pop()
+			try:
+				result = []
+				for op in f:
+					if op[0] == '+':
+						result.append(op[1:-1])
+					else:
+						c, start, count = op.split()
+						start = int(start)
+						result.extend(lines[start:start + int(count)])
+				lines = result
+			finally:
+				f.close()
+
+		return '\n'.join(lines)
+
+def parseTime(value):
+	''' seconds since epoch of a collection time, given as 2014-09-24T10:43:00Z or in seconds '''
+
+	if re.match(r'^[0-9]+$', value):
+		return int(value)
+	return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+def formatTime(seconds):
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+class TLTimeIndex:
+	'''
+		Maps collection times of a source to snapshot indexes
+
+		Entries are appended to the .timeindex file of the source as fixed size
+		(collection time, index) records, in whatever order snapshots finish.
+		Each server process keeps them sorted in memory and only reads the
+		records appended since it last looked, so a lookup is a binary search.
+		remove() replaces the file, which readers notice by its new inode.
+	'''
+
+	record = struct.Struct('!qq')
+
+	# (namespace,source) -> [bytes of .timeindex read so far, sorted list of (time, index), inode of .timeindex]
+	cache = {}
+	cacheLock = threading.RLock()
+
+	def write(self, baseDatafileName):
+		''' add a snapshot to the index of its source '''
+
+		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1)
+		index = int(m.group(2))
+
+		try:
+			# the header comes first, the entries are not read
+			reader = TLReader.TLSnapshotReader(openSnapshot(baseDatafileName))
+			try:
+				collectionTime = reader.readHeader()[1]
+			finally:
+				reader.close()
+			if collectionTime is None:
+				logger.error("No collection_dt in {0}".format(baseDatafileName))
+				return False
+			collectionTime = parseTime(collectionTime)
+
+			indexfileName = baseDirName + '/.timeindex'
+			while True:
+				fd = os.open(indexfileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+				fcntl.flock(fd, fcntl.LOCK_EX)
+				if os.fstat(fd).st_ino == os.stat(indexfileName).st_ino:
+					break
+				# rewritten by remove() while we were waiting
+				os.close(fd)
+
+			try:
+				if os.fstat(fd).st_size == 0 and index > 0:
+					# first snapshot indexed, pick up the ones ingested before
+					for i in range(index):
+						t = self.readCollectionTime(baseDirName + '/' + str(i))
+						if t is not None:
+							os.write(fd, self.record.pack(t, i))
+				os.write(fd, self.record.pack(collectionTime, index))
+			finally:
+				os.close(fd)
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def readCollectionTime(self, datafileName):
+		''' collection time from the header of raw data, None if there is none '''
+
+		try:
+			f = openSnapshot(datafileName)
+		except IOError:
+			return None
+
+		reader = TLReader.TLSnapshotReader(f)
+		try:
+			collectionTime = reader.readHeader()[1]
+		finally:
+			reader.close()
+
+		if collectionTime is None:
+			return None
+		return parseTime(collectionTime)
+
+	def remove(self, baseDirName, indexes):
+		''' rewrite the index of a source without the snapshots indexes '''
+
+		indexfileName = baseDirName + '/.timeindex'
+		tmpfileName = indexfileName + '.tmp'
+
+		fd = os.open(indexfileName, os.O_RDWR)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			f = open(indexfileName, 'rb')
+			try:
+				data = f.read()
+			finally:
+				f.close()
+
+			indexes = set(indexes)
+			f = open(tmpfileName, 'wb')
+			try:
+				size = len(data) - len(data) % self.record.size
+				for offset in range(0, size, self.record.size):
+					t, index = self.record.unpack_from(data, offset)
+					if index not in indexes:
+						f.write(data[offset:offset + self.record.size])
+				f.flush()
+				os.fsync(f.fileno())
+			finally:
+				f.close()
+			# writers waiting for the lock notice the file has been replaced
+			os.rename(tmpfileName, indexfileName)
+		finally:
+			os.close(fd)
+
+	def load(self, namespace, source):
+		''' return the sorted (time, index) entries of a source '''
+
+		indexfileName = TL_DATA_DIR + '/' + namespace + '/' + source + '/.timeindex'
+
+		with TLTimeIndex.cacheLock:
+			entry = TLTimeIndex.cache.get((namespace, source))
+			if entry is None:
+				entry = [0, [], None]
+				TLTimeIndex.cache[(namespace, source)] = entry
+
+			try:
+				f = open(indexfileName, 'rb')
+			except IOError:
+				return entry[1]
+
+			try:
+				st = os.fstat(f.fileno())
+				if st.st_ino != entry[2] or st.st_size < entry[0]:
+					# index has been rebuilt, start over
+					entry[0] = 0
+					del entry[1][:]
+					entry[2] = st.st_ino
+				f.seek(entry[0])
+				data = f.read()
+			finally:
+				f.close()
+
+			# a record still being appended is picked up next time
+			size = len(data) - len(data) % self.record.size
+			for offset in range(0, size, self.record.size):
+				bisect.insort(entry[1], self.record.unpack_from(data, offset))
+			entry[0] += size
+
+			return entry[1]
+
+	def find(self, namespace, source, t=None):
+		'''
+			Return (time, index) of the latest snapshot collected at or before
+			time t, or of the latest snapshot if t is None
+		'''
+
+		with TLTimeIndex.cacheLock:
+			entries = self.load(namespace, source)
+			if len(entries) == 0:
+				return None
+			if t is None:
+				return entries[-1]
+
+			i = bisect.bisect_right(entries, (t, sys.maxint)) - 1
+			if i < 0:
+				return None
+			return entries[i]
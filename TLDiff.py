@@ -8,19 +8,364 @@ import multiprocessing
 import bottle
 import re
 import subprocess
+import signal
 import gzip
 import StringIO
+import time
+import threading
+import itertools
+import TLData
+import TLReader
+import TLCatalog
+import TLPipeline
 
 try: import simplejson as json
 except ImportError: import json
 
 TL_DATA_DIR	=	'./data'
+TL_RAW_STALE	=	60	# seconds without progress after which an upload is given up on
+TL_DIFF_BATCH	=	1000	# changed entries turned into records at a time
+TL_WRITE_BATCH	=	1000	# lines joined into one write
+TL_SORT_MEMORY	=	64 * 1024 * 1024	# bytes of raw data sort(1) takes in at a time, more are spilled to temporary files
+
+# rough bytes of Python objects kept per line of a snapshot in
+# TLData.snapshotCache, on top of its characters
+LINE_OVERHEAD = 48
 
 logger = logging.getLogger(__name__)
 
+def readChanges(baseDatafileName):
+	'''
+		Return an iterator over the change records of a snapshot from its
+		.json file (see TLReader.iterRecords), raises IOError if there is none
+	'''
+
+	return TLReader.iterRecords(TLData.openArtifact(baseDatafileName + '.json'))
+
+def readBatches(f):
+	'''
+		Yield the lines of f without their '\\n' in lists, of those read
+		TL_READ_CHUNK bytes at a time
+	'''
+
+	rest = ''
+	while True:
+		data = f.read(TLReader.TL_READ_CHUNK)
+		if not data:
+			break
+		lines = (rest + data).split('\n')
+		rest = lines.pop()
+		if len(lines) > 0:
+			yield lines
+	if rest:
+		yield [rest]
+
+def checkOrder(batches, side):
+	'''
+		Yield the lists of lines of raw data of batches, raising
+		TLDiffOrderError(side) as soon as its file entries turn out not to be
+		in the order sort(1) puts them in (see TLSnapshotLines), or not all
+		alike up to their file name. The lines before the first entry of a
+		list and after its last one, such as the header fields, are not
+		looked at.
+	'''
+
+	last = None
+	prefix = None
+	for lines in batches:
+		i = 0
+		j = len(lines)
+		while i < j and not isEntry(lines[i]):
+			i += 1
+		while j > i and not isEntry(lines[j - 1]):
+			j -= 1
+		entries = lines[i:j] if i > 0 or j < len(lines) else lines
+
+		if len(entries) > 0:
+			if prefix is None:
+				prefix = entryPrefix(entries[0])
+			# once sorted, the lines between the first and the last start
+			# like them, so they compare as they would stripped; sorting a
+			# sorted list only compares each line with the next
+			if prefix is None or not entries[0].startswith(prefix) or not entries[-1].startswith(prefix) or \
+					(last is not None and entries[0] < last) or sorted(entries) != entries:
+				raise TLDiffOrderError(side)
+			last = entries[-1]
+		yield lines
+
+def isEntry(line):
+	return line.lstrip().startswith('{"')
+
+def entryPrefix(line):
+	''' the part of an entry line before its file name, None if it has none '''
+
+	m = TLReader.TLSnapshotReader.namepattern.match(line.lstrip())
+	if m is None:
+		return None
+	return line[:len(line) - len(line.lstrip()) + m.start(1)]
+
+def entryLine(line):
+	''' an entry line of raw data stripped of whitespace and its trailing ',' (see TLReader.TLSnapshotReader) '''
+
+	line = line.strip()
+	if line[-1:] == ',':
+		return line[:-1]
+	return line
+
+def entryKey(line):
+	'''
+		File name of an entry line, stripped or not, with the '"' closing it,
+		which entry lines are in the order of once sorted; None if it has none
+	'''
+
+	m = TLReader.TLSnapshotReader.namepattern.match(line.lstrip())
+	if m is None:
+		return None
+	return m.group(1) + '"'
+
+def writeLines(f, lines):
+	''' write lines to f, TL_WRITE_BATCH at a time '''
+
+	lines = iter(lines)
+	while True:
+		batch = list(itertools.islice(lines, TL_WRITE_BATCH))
+		if len(batch) == 0:
+			break
+		batch.append('')
+		f.write('\n'.join(batch))
+
+def mergeChanges(batches1, batches2):
+	'''
+		Merge-join the lines of raw data of two snapshots, both given in
+		lists (see readBatches()) with their file entries in order (see
+		entryKey()), yield (file name, entry line in the first, entry line in
+		the second) of every file whose entry differs, a line is None if the
+		file is missing from that side. A file listed twice counts once.
+		Runs of equal lines are files unchanged, skipped without looking at
+		them, only the lines that differ are stripped (see entryLine()).
+		Lines other than file entries are left out. Raises
+		TLDiffOrderError(0 or 1) on a file entry found out of order.
+	'''
+
+	lines1 = next(batches1, None)
+	lines2 = next(batches2, None)
+	i1 = i2 = 0
+
+	# last lines taken from each side, and their keys once looked at
+	last1 = last2 = None
+	lastKey1 = lastKey2 = None
+
+	while True:
+		if lines1 is not None and i1 == len(lines1):
+			lines1 = next(batches1, None)
+			i1 = 0
+			continue
+		if lines2 is not None and i2 == len(lines2):
+			lines2 = next(batches2, None)
+			i2 = 0
+			continue
+
+		line1 = lines1[i1] if lines1 is not None else None
+		line2 = lines2[i2] if lines2 is not None else None
+		if line1 is None and line2 is None:
+			break
+
+		if line1 == line2:
+			n1 = len(lines1)
+			n2 = len(lines2)
+			i1 += 1
+			i2 += 1
+			while i1 < n1 and i2 < n2 and lines1[i1] == lines2[i2]:
+				i1 += 1
+				i2 += 1
+			last1 = last2 = lines1[i1 - 1]
+			lastKey1 = lastKey2 = None
+			continue
+
+		key1 = None
+		if line1 is not None:
+			key1 = entryKey(line1)
+			if key1 is None:
+				i1 += 1
+				continue
+			if last1 is not None:
+				if lastKey1 is None:
+					lastKey1 = entryKey(last1)
+				if lastKey1 is not None and key1 < lastKey1:
+					raise TLDiffOrderError(0)
+				if key1 == lastKey1:
+					i1 += 1
+					continue
+
+		key2 = None
+		if line2 is not None:
+			key2 = entryKey(line2)
+			if key2 is None:
+				i2 += 1
+				continue
+			if last2 is not None:
+				if lastKey2 is None:
+					lastKey2 = entryKey(last2)
+				if lastKey2 is not None and key2 < lastKey2:
+					raise TLDiffOrderError(1)
+				if key2 == lastKey2:
+					i2 += 1
+					continue
+
+		if line2 is None or (line1 is not None and key1 < key2):
+			yield (key1[:-1], entryLine(line1), None)
+			last1, lastKey1 = line1, key1
+			i1 += 1
+		elif line1 is None or key2 < key1:
+			yield (key2[:-1], None, entryLine(line2))
+			last2, lastKey2 = line2, key2
+			i2 += 1
+		else:
+			line1 = entryLine(line1)
+			line2 = entryLine(line2)
+			if line1 != line2:
+				# not only the whitespace or trailing ',' differs
+				yield (key1[:-1], line1, line2)
+			last1, lastKey1 = line1, key1
+			last2, lastKey2 = line2, key2
+			i1 += 1
+			i2 += 1
+
+class TLDiffOrderError(Exception):
+	'''
+		Raised on raw data not in order, with the side of the diff it is on,
+		0 or 1
+	'''
+
+class TLSnapshotLines:
+	'''
+		Reads the lines of the raw data of a snapshot as listed, or sorted by
+		sort(1) in the C locale ignoring leading blanks
+
+		Raw data stored as plain text is read by sort itself, otherwise a
+		thread feeds it to sort through a pipe. The header fields come out
+		of sort among the entries, they are read from the raw data before.
+	'''
+
+	def __init__(self, datafileName, sort, lines=None):
+		self.p = None
+		self.thread = None
+		self.error = None
+		self.lines = lines
+
+		if lines is not None:
+			# kept in order by an earlier diff, see TLDiffData.writeDiff()
+			self.datafile = None
+			self.hostname = self.collectionTime = None
+			return
+
+		self.datafile = TLData.openSnapshot(datafileName)
+		self.data = self.datafile.read(TLReader.TL_READ_CHUNK)
+		self.hostname, self.collectionTime = TLReader.TLSnapshotReader(StringIO.StringIO(self.data)).readHeader()
+		if not sort:
+			return
+
+		args = ['sort', '-b', '-S', '{0}b'.format(TL_SORT_MEMORY), '-T', os.path.dirname(datafileName)]
+		if os.path.isfile(datafileName):
+			self.datafile.close()
+			args.append(datafileName)
+			stdin = None
+		else:
+			stdin = subprocess.PIPE
+		self.p = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, env=dict(os.environ, LC_ALL='C'), close_fds=True, preexec_fn=restoreSignals)
+
+		if stdin is not None:
+			self.thread = threading.Thread(target=self.feed)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def read(self, size):
+		''' read the raw data, of which the first chunk is read already '''
+
+		if self.data:
+			data = self.data
+			self.data = ''
+			return data
+		return self.datafile.read(size)
+
+	def batches(self):
+		''' the lines in lists, see readBatches() '''
+
+		if self.lines is not None:
+			return iter(self.lines)
+		if self.p is None:
+			return readBatches(self)
+		return readBatches(self.p.stdout)
+
+	def feed(self):
+		''' write the raw data to sort, then close its input '''
+
+		try:
+			while True:
+				data = self.read(TLData.TL_CHUNK_SIZE)
+				if not data:
+					break
+				self.p.stdin.write(data)
+		except (IOError, OSError):
+			# sort gave up early, or the data cannot be read, see close()
+			self.error = traceback.format_exc().split('\n')
+		finally:
+			self.datafile.close()
+			try:
+				self.p.stdin.close()
+			except IOError:
+				pass
+
+	def close(self):
+		'''
+			Wait for sort if sorting, raise IOError unless it and feeding it
+			went well, all the lines may not have been read otherwise
+		'''
+
+		if self.p is None:
+			if self.datafile is not None:
+				self.datafile.close()
+			return
+
+		self.p.stdout.close()
+		self.p.wait()
+		if self.thread is not None:
+			self.thread.join()
+		if self.error is not None:
+			logger.error(self.error)
+			raise IOError('Could not feed sort')
+		if self.p.returncode != 0:
+			raise IOError('sort exited with {0}'.format(self.p.returncode))
+
+	def abort(self):
+		''' close, stopping sort whatever state it is in '''
+
+		try:
+			self.close()
+		except IOError:
+			pass
+
+def restoreSignals():
+	# Python ignores SIGPIPE, sort is to die of it when its output is closed
+	signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
 class TLDiffData:
 	'''
-		Writing raw data collected by TL agent to disk
+		Finds the changes between a snapshot and the previous one
+
+		The entries of both are merge-joined by file name, each file is
+		compared once, in whatever order the agent listed them: raw data not
+		listed in order is sorted with sort(1) first. The lines of the
+		snapshot, in order, are kept in TLData.snapshotCache for diffing the
+		next one against without reading it again. The .diff written holds
+		the collection time of the snapshot, then one line per file that
+		differs, in file name order:
+
+			> "collection_dt": "2014-09-24T10:43:00Z"
+			< {"name_s": ...}	entry before, the file was deleted
+			> {"name_s": ...}	entry now, the file was added
+			< {"name_s": ...}	entry before and now, the file was modified
+			> {"name_s": ...}
 	'''
 
 	def write(self, baseDatafileName):
@@ -28,29 +373,218 @@ class TLDiffData:
 			Find differences between this datafile and the previous one 
 		'''
 
-		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
-		baseDirName = m.group(1)
-		index = int(m.group(2))
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1) + '/' + m.group(2) + '/' + m.group(3)
+		index = int(m.group(4))
 
 		if index == 0:
-			return	
+			return
+
+		# latest snapshot before, skipping those whose upload failed or that
+		# were dropped by TLRetention
+		catalog = TLCatalog.TLCatalog()
+		end = index
+		while True:
+			previous = catalog.find(m.group(2), m.group(3), 'raw', (TLPipeline.RUNNING, TLPipeline.DONE), end=end, reverse=True, limit=1)
+			if len(previous) == 0:
+				return
+			end = previous[0]
+			file = baseDirName + "/" + str(end)
+			self.waitForRaw(file)
+			if TLData.snapshotExists(file):
+				logger.info("Diffing {0} against {1}".format(baseDatafileName, file))
+				self.diff(file, baseDatafileName)
+				return
+
+	def diff(self, datafileName1, datafileName2):
+		''' write the .diff of two snapshots, sorting the raw data of those not listed in order '''
+
+		sort = [False, False]
+		while True:
+			try:
+				self.writeDiff((datafileName1, datafileName2), sort)
+				return
+			except TLDiffOrderError as e:
+				side = e.args[0]
+				if sort[side]:
+					raise
+				# e.g. listed by find in directory order
+				logger.info("{0} is not in order, sorting it".format((datafileName1, datafileName2)[side]))
+				sort[side] = True
+				if side == 0:
+					# most likely listed by the same agent as the one before
+					sort[1] = True
+
+	def writeDiff(self, datafileNames, sort):
+		''' diff() with the raw data of datafileNames sorted where sort says so '''
+
+		cache = TLData.snapshotCache
+		lines = None
+		if cache is not None:
+			lines = cache.get(self.cacheKey(datafileNames[0]))
+			kept = {'lines': [], 'size': 0}
+
+		snapshots = []
+		f = None
+		try:
+			snapshots.append(TLSnapshotLines(datafileNames[0], sort[0] and lines is None, lines))
+			snapshots.append(TLSnapshotLines(datafileNames[1], sort[1]))
+			batches = [snapshot.batches() if sort[side] or snapshot.lines is not None else checkOrder(snapshot.batches(), side) for side, snapshot in enumerate(snapshots)]
+			if cache is not None:
+				batches[1] = self.keepBatches(batches[1], kept, cache.capacity)
+
+			f = TLData.createArtifact(datafileNames[1] + '.diff')
+			if snapshots[1].collectionTime is not None:
+				f.write('> "collection_dt": "{0}"\n'.format(snapshots[1].collectionTime))
+			writeLines(f, self.diffLines(mergeChanges(batches[0], batches[1])))
+			for s in snapshots:
+				s.close()
+		except:
+			if f is not None:
+				f.abort()
+			for s in snapshots:
+				s.abort()
+			raise
+		f.close()
+
+		if cache is not None:
+			# only the next diff is to read them
+			cache.remove(self.cacheKey(datafileNames[0]))
+			if kept['lines'] is not None:
+				cache.put(self.cacheKey(datafileNames[1]), kept['lines'], kept['size'])
+
+	def cacheKey(self, datafileName):
+		''' key of the lines of a snapshot in TLData.snapshotCache, apart from its TLData.TLSnapshot '''
+
+		return TLData.snapshotKey(datafileName) + ('lines',)
+
+	def keepBatches(self, batches, kept, capacity):
+		'''
+			Yield the lists of lines of batches, appending them to
+			kept['lines'] and adding their size to kept['size'], until they
+			add up to more than capacity: kept['lines'] is None then
+		'''
+
+		for lines in batches:
+			if kept['lines'] is not None:
+				kept['size'] += sum(map(len, lines)) + len(lines) * LINE_OVERHEAD
+				if kept['size'] > capacity:
+					kept['lines'] = None
+				else:
+					kept['lines'].append(lines)
+			yield lines
+
+	def diffLines(self, changes):
+		''' yield the .diff lines of (file name, line before, line after) changes '''
+
+		for name, line1, line2 in changes:
+			if line1 is not None:
+				yield '< ' + line1
+			if line2 is not None:
+				yield '> ' + line2
+
+	def iterSnapshotChanges(self, snapshot1, snapshot2, indexer, prefix=None):
+		'''
+			Yield the change records between two parsed snapshots (see
+			TLData.TLSnapshot), matching entries up by file name instead of
+			running diff, formatted by indexer. With prefix, only files whose
+			name starts with it are looked at.
+		'''
+
+		file1 = {}
+		file2 = {}
 
-		for i in range(index-1, -1, -1):
-			file = baseDirName + "/" + str(i)
-			if os.path.isfile(file):
-				logger.info("Starting a new diffing process({0}) for {1} and {2}".format(os.getpid(),baseDatafileName,file))
+		for name, line in snapshot1.names.iteritems():
+			if prefix is not None and not name.startswith(prefix):
+				continue
+			other = snapshot2.names.get(name)
+			if other == line:
+				continue
+			file1[name] = line
+			if other is not None:
+				file2[name] = other
+
+			if len(file1) >= TL_DIFF_BATCH:
+				for r in indexer.findChanges(file1, file2, snapshot2.collectionTime):
+					yield r
+
+		for name, line in snapshot2.names.iteritems():
+			if name in snapshot1.names or (prefix is not None and not name.startswith(prefix)):
+				continue
+			file2[name] = line
+
+			if len(file2) >= TL_DIFF_BATCH:
+				for r in indexer.findChanges(file1, file2, snapshot2.collectionTime):
+					yield r
+
+		for r in indexer.findChanges(file1, file2, snapshot2.collectionTime):
+			yield r
+
+	def iterColumnarChanges(self, columns1, columns2, indexer, prefix=None):
+		'''
+			Yield the change records between two snapshots in columnar form
+			(see TLColumns.TLColumnarSnapshot), formatted by indexer,
+			optionally only of the files whose name starts with prefix
+		'''
+
+		file1 = {}
+		file2 = {}
+
+		for name, line1, line2 in columns1.iterChanges(columns2, prefix):
+			if line1 is not None:
+				file1[name] = line1
+			if line2 is not None:
+				file2[name] = line2
+
+			if len(file1) + len(file2) >= TL_DIFF_BATCH:
+				for r in indexer.findChanges(file1, file2, columns2.collectionTime):
+					yield r
+
+		for r in indexer.findChanges(file1, file2, columns2.collectionTime):
+			yield r
+
+	def iterDiffChanges(self, reader, indexer):
+		'''
+			Yield the change records of a .diff read by reader (see
+			TLReader.TLDiffReader), formatted by indexer
+		'''
+
+		file1 = {}
+		file2 = {}
+
+		for name, line1, line2 in reader:
+			if line1 is not None:
+				file1[name] = line1
+			if line2 is not None:
+				file2[name] = line2
+
+			if len(file1) + len(file2) >= TL_DIFF_BATCH:
+				for r in indexer.findChanges(file1, file2, reader.collectionTime):
+					yield r
+
+		for r in indexer.findChanges(file1, file2, reader.collectionTime):
+			yield r
+
+	def waitForRaw(self, file):
+		'''
+			Wait while the raw data of a snapshot is still being uploaded, which
+			may be done by another server process
+		'''
+
+		while True:
+			# written compressed or not, see TLData.TLArtifactWriter
+			mtimes = []
+			for tmpfileName in (file + '.tmp', file + '.gz.tmp'):
 				try:
-					output = subprocess.check_output(['diff', '-w', '-B', file, baseDatafileName])
-				except subprocess.CalledProcessError as e:
-					# diff will return 1 if files are different
-					output = e.output
-				finally:
-					f = open(baseDirName + '/' + str(index) + '.diff' , 'w')
-					f.write(output)
-					f.close()
-				break
-
-		return
+					mtimes.append(os.stat(tmpfileName).st_mtime)
+				except OSError:
+					pass
+			if len(mtimes) == 0:
+				return
+			if time.time() - max(mtimes) > TL_RAW_STALE:
+				# left behind by an upload that never finished
+				return
+			time.sleep(0.1)
 
 class TLDiffDataIndexSolr:
 	'''
@@ -66,13 +600,15 @@ class TLDiffDataIndexSolr:
 		if index == 0:
 			return
 
-		f = open(baseDatafileName + '.diff', "r")
-		data = f.read()
-		f.close()
-
-		result = self.diff2JSON(data)
-		f = open(baseDatafileName + '.json', 'w')
-		json.dump(result, f, indent=4)
+		reader = TLReader.TLDiffReader(TLData.openArtifact(baseDatafileName + '.diff'))
+		f = TLData.createArtifact(baseDatafileName + '.json')
+		try:
+			TLReader.writeList(f, TLDiffData().iterDiffChanges(reader, self), indent=4)
+		except:
+			f.abort()
+			raise
+		finally:
+			reader.close()
 		f.close()
 
 
@@ -108,120 +644,6 @@ class TLDiffDataIndexSolr:
 
 		return result
 
-	def diff2JSON(self, diff):
-		''' given a diff output, return it in JSON format
-
-			diff format:
-				[0-9]+(,[0-9]+)?c[0-9]+(,[0-9]+)?
-				<\s+.*
-				---
-				>\s+.*
-		'''
-
-		result = []
-		file1 = {}
-		file2 = {}
-		step = 1
-		collectionTime = ''
-
-		linepattern = re.compile(r'[0-9]+(,[0-9]+)?[a-zA-Z][0-9]+(,[0-9]+)?')
-		file1pattern = re.compile(r'^\<\s+(.*)$')
-		dividerpattern = re.compile(r'^---$')
-		file2pattern = re.compile(r'^\>\s+(.*)$')
-		collectiontimepattern = re.compile(r'^\>\s+\"collection_dt\":\s+\"(.*)\"')
-
-		for line in diff.split('\n'):
-
-			# handle eof
-			if len(line) == 0:	
-				break
-
-			# step 1: find line pattern
-			if step == 1:
-				m = linepattern.match(line)
-				if m is not None:
-					step = 2
-					continue
-				else:
-					return None
-
-			# step 2: find file1 pattern
-			if step == 2:
-				m = file1pattern.match(line)
-				if m is not None:
-					data = m.group(1)
-					if data[-1] == ',':
-						# remove the trailing ','
-						data = data[:-1]
-					try:
-						dj = json.loads(data)
-						file1[dj['name_s']] = data
-					except json.JSONDecodeError:
-						# if a line is not in json format, we skip it
-						m = collectiontimepattern.match(line)
-						if m is not None:
-							collectionTime = m.group(1)
-							continue
-						else:
-							logger.warn('line is not in JSON format: {0}'.format(line))
-
-					continue
-
-				m = dividerpattern.match(line)
-				if m is not None:
-					step = 3
-					continue
-
-				m = file2pattern.match(line)
-				if m is not None:
-					# this will continue to run the 'if step == 3' code
-					step = 3
-				else:
-					m = linepattern.match(line)
-					if m is not None:
-						ret = self.findChanges(file1, file2, collectionTime)
-						result.extend(ret)
-					else:
-						return None
-
-			# step 3: find file2 pattern
-			if step == 3:
-				m = file2pattern.match(line)
-				if m is not None:
-					data = m.group(1)
-					if data[-1] == ',':
-						# remove the trailing ','
-						data = data[:-1]
-					try:
-						dj = json.loads(data)
-						file2[dj['name_s']] = data
-					except json.JSONDecodeError:
-						# if a line is not in json format, we skip it
-						m = collectiontimepattern.match(line)
-						if m is not None:
-							collectionTime = m.group(1)
-							continue
-						else:
-							logger.warn('line is not in JSON format: {0}'.format(line))
-				
-					continue
-
-				m = linepattern.match(line)
-				if m is not None:
-					step = 2
-					ret = self.findChanges(file1, file2, collectionTime)
-					result.extend(ret)
-					continue
-
-				logger.warn('Abort, cannot parse line: {0}'.format(line))
-				return None
-
-		# to handle the last diff section in the file
-		ret = self.findChanges(file1, file2, collectionTime)
-		result.extend(ret)
-
-		return result
-
 class TLDiffDataIndexES:
 	'''
 		Format diff data so it is indexable by ElasticSearch
@@ -238,19 +660,21 @@ class TLDiffDataIndexES:
 		if index == 0:
 			return
 
-		f = open(baseDatafileName + '.diff', "r")
-		data = f.read()
-		f.close()
-
 		index = { 'index' : { '_index': namespace, '_type': source }}
 
-		f = open(baseDatafileName + '.json', 'w')
-		result = self.diff2JSON(data)
-		for r in result:
-			index['index']['_id'] = r['id']
-			del r['id']
-			str = json.dumps(index) + '\n' + json.dumps(r) + '\n'
-			f.write(str)
+		reader = TLReader.TLDiffReader(TLData.openArtifact(baseDatafileName + '.diff'))
+		f = TLData.createArtifact(baseDatafileName + '.json')
+		try:
+			for r in TLDiffData().iterDiffChanges(reader, self):
+				index['index']['_id'] = r['id']
+				del r['id']
+				str = json.dumps(index) + '\n' + json.dumps(r) + '\n'
+				f.write(str)
+		except:
+			f.abort()
+			raise
+		finally:
+			reader.close()
 		f.close()
 
 
@@ -284,117 +708,3 @@ class TLDiffDataIndexES:
 		file2.clear()
 
 		return result
-
-	def diff2JSON(self, diff):
-		''' given a diff output, return it in JSON format
-
-			diff format:
-				[0-9]+(,[0-9]+)?c[0-9]+(,[0-9]+)?
-				<\s+.*
-				---
-				>\s+.*
-		'''
-
-		result = []
-		file1 = {}
-		file2 = {}
-		step = 1
-		collectionTime = ''
-
-		linepattern = re.compile(r'[0-9]+(,[0-9]+)?[a-zA-Z][0-9]+(,[0-9]+)?')
-		file1pattern = re.compile(r'^\<\s+(.*)$')
-		dividerpattern = re.compile(r'^---$')
-		file2pattern = re.compile(r'^\>\s+(.*)$')
-		collectiontimepattern = re.compile(r'^\>\s+\"collection_dt\":\s+\"(.*)\"')
-
-		for line in diff.split('\n'):
-
-			# handle eof
-			if len(line) == 0:	
-				break
-
-			# step 1: find line pattern
-			if step == 1:
-				m = linepattern.match(line)
-				if m is not None:
-					step = 2
-					continue
-				else:
-					return None
-
-			# step 2: find file1 pattern
-			if step == 2:
-				m = file1pattern.match(line)
-				if m is not None:
-					data = m.group(1)
-					if data[-1] == ',':
-						# remove the trailing ','
-						data = data[:-1]
-					try:
-						dj = json.loads(data)
-						file1[dj['name_s']] = data
-					except json.JSONDecodeError:
-						# if a line is not in json format, we skip it
-						m = collectiontimepattern.match(line)
-						if m is not None:
-							collectionTime = m.group(1)
-							continue
-						else:
-							logger.warn('line is not in JSON format: {0}'.format(line))
-
-					continue
-
-				m = dividerpattern.match(line)
-				if m is not None:
-					step = 3
-					continue
-
-				m = file2pattern.match(line)
-				if m is not None:
-					# this will continue to run the 'if step == 3' code
-					step = 3
-				else:
-					m = linepattern.match(line)
-					if m is not None:
-						ret = self.findChanges(file1, file2, collectionTime)
-						result.extend(ret)
-					else:
-						return None
-
-			# step 3: find file2 pattern
-			if step == 3:
-				m = file2pattern.match(line)
-				if m is not None:
-					data = m.group(1)
-					if data[-1] == ',':
-						# remove the trailing ','
-						data = data[:-1]
-					try:
-						dj = json.loads(data)
-						file2[dj['name_s']] = data
-					except json.JSONDecodeError:
-						# if a line is not in json format, we skip it
-						m = collectiontimepattern.match(line)
-						if m is not None:
-							collectionTime = m.group(1)
-							continue
-						else:
-							logger.warn('line is not in JSON format: {0}'.format(line))
-				
-					continue
-
-				m = linepattern.match(line)
-				if m is not None:
-					step = 2
-					ret = self.findChanges(file1, file2, collectionTime)
-					result.extend(ret)
-					continue
-
-				logger.warn('Abort, cannot parse line: {0}'.format(line))
-				return None
-
-		# to handle the last diff section in the file
-		ret = self.findChanges(file1, file2, collectionTime)
-		result.extend(ret)
-
-		return result
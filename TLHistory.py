@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Per-file change history of a source, and of a whole namespace
+#
+# Change records of every snapshot are added to an SQLite table of the source,
+# keyed by file name, so the history of a file is an index lookup instead of a
+# scan of every <n>.json under TL_DATA_DIR/<namespace>/<source>. A second table
+# per namespace, keyed by file name and collection time, tells which sources
+# changed a file without looking at each source.
+#
+####################################################################################
+
+import os
+import re
+import traceback
+import logging
+import sqlite3
+import TLData
+import TLDiff
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_DATA_DIR	=	'./data'
+TL_DB_TIMEOUT	=	60	# seconds to wait for another writer of the same database
+
+logger = logging.getLogger(__name__)
+
+def connect(databaseName, schema):
+	''' open an SQLite database, creating its tables if needed '''
+
+	db = sqlite3.connect(databaseName, timeout=TL_DB_TIMEOUT)
+	# transactions are started explicitly with BEGIN IMMEDIATE
+	db.isolation_level = None
+	for statement in schema:
+		db.execute(statement)
+	return db
+
+def tempIndexes(db, indexes):
+	'''
+		Fill the temporary table indexes of db with snapshot indexes, for
+		statements of any number of them to use IN (SELECT idx FROM indexes)
+	'''
+
+	db.execute('CREATE TEMP TABLE IF NOT EXISTS indexes (idx INTEGER PRIMARY KEY)')
+	db.execute('DELETE FROM indexes')
+	db.executemany('INSERT OR IGNORE INTO indexes VALUES (?)', [(i,) for i in indexes])
+
+def collectionTime(record):
+	''' collection time of a change record in seconds, None if unknown '''
+
+	try:
+		return TLData.parseTime(record['collection_dt'])
+	except (KeyError, ValueError):
+		return None
+
+class TLHistory:
+	'''
+		Maps file names of a source to the snapshots that changed them
+	'''
+
+	schema = [
+		'''CREATE TABLE IF NOT EXISTS history (
+			name TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			collection INTEGER,
+			change TEXT,
+			modified TEXT,
+			size TEXT,
+			PRIMARY KEY (name, idx)
+		) WITHOUT ROWID''',
+	]
+
+	def write(self, baseDatafileName):
+		''' add the changes of a snapshot to the history of its source '''
+
+		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1)
+		index = int(m.group(2))
+
+		if index == 0:
+			return
+
+		try:
+			db = connect(baseDirName + '/.history.db', self.schema)
+			try:
+				db.execute('BEGIN IMMEDIATE')
+				if db.execute('PRAGMA user_version').fetchone()[0] == 0:
+					# first snapshot added, pick up the ones ingested before
+					for i in range(1, index):
+						self.add(db, baseDirName + '/' + str(i), i)
+					db.execute('PRAGMA user_version = 1')
+				self.add(db, baseDatafileName, index)
+				db.execute('COMMIT')
+			finally:
+				db.close()
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def add(self, db, baseDatafileName, index):
+		try:
+			records = TLDiff.readChanges(baseDatafileName)
+		except IOError:
+			# no changes recorded for this snapshot
+			return
+
+		rows = ((r['name_s'], index, collectionTime(r), r['change_s'], r.get('lastmodifiedtime_dt'), r.get('size_i')) for r in records)
+		db.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+	def compact(self, baseDirName, dropped, merged):
+		'''
+			Forget the changes of the snapshots dropped by TLRetention, and
+			re-add those of the snapshots whose change sets it merged
+		'''
+
+		if not os.path.isfile(baseDirName + '/.history.db'):
+			return
+
+		db = connect(baseDirName + '/.history.db', self.schema)
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			tempIndexes(db, dropped + merged)
+			db.execute('DELETE FROM history WHERE idx IN (SELECT idx FROM indexes)')
+			for i in merged:
+				self.add(db, baseDirName + '/' + str(i), i)
+			db.execute('COMMIT')
+		finally:
+			db.close()
+
+	def find(self, namespace, source, name, start=None, end=None):
+		'''
+			Yield the changes of a file, oldest first, optionally limited to
+			snapshots collected between start and end (in seconds)
+		'''
+
+		databaseName = TL_DATA_DIR + '/' + namespace + '/' + source + '/.history.db'
+		if not os.path.isfile(databaseName):
+			return
+
+		query = 'SELECT idx, collection, change, modified, size FROM history WHERE name = ?'
+		args = [name]
+		if start is not None:
+			query += ' AND collection >= ?'
+			args.append(start)
+		if end is not None:
+			query += ' AND collection <= ?'
+			args.append(end)
+		query += ' ORDER BY idx'
+
+		db = connect(databaseName, self.schema)
+		try:
+			for idx, collection, change, modified, size in db.execute(query, args):
+				yield {
+					'index': idx,
+					'collection_dt': TLData.formatTime(collection) if collection is not None else None,
+					'change_s': change,
+					'lastmodifiedtime_dt': modified,
+					'size_i': size,
+				}
+		finally:
+			db.close()
+
+class TLNamespaceHistory:
+	'''
+		Maps file names to the sources and snapshots of a namespace that
+		changed them, in order of collection time
+	'''
+
+	schema = [
+		'''CREATE TABLE IF NOT EXISTS changes (
+			name TEXT NOT NULL,
+			collection INTEGER NOT NULL,
+			source TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			change TEXT,
+			PRIMARY KEY (name, collection, source, idx)
+		) WITHOUT ROWID''',
+		# latest snapshot of each source added so far
+		'''CREATE TABLE IF NOT EXISTS sources (
+			source TEXT PRIMARY KEY,
+			idx INTEGER NOT NULL
+		)''',
+	]
+
+	def write(self, baseDatafileName):
+		''' add the changes of a snapshot to the history of its namespace '''
+
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		namespaceDirName = m.group(1) + '/' + m.group(2)
+		source = m.group(3)
+		index = int(m.group(4))
+
+		if index == 0:
+			return
+
+		try:
+			db = connect(namespaceDirName + '/.changes.db', self.schema)
+			try:
+				db.execute('BEGIN IMMEDIATE')
+				row = db.execute('SELECT idx FROM sources WHERE source = ?', (source,)).fetchone()
+				last = row[0] if row is not None else 0
+				# pick up snapshots ingested before, or whose stage ran elsewhere
+				for i in range(last + 1, index):
+					self.add(db, namespaceDirName + '/' + source + '/' + str(i), source, i)
+				self.add(db, baseDatafileName, source, index)
+				db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (source, max(last, index)))
+				db.execute('COMMIT')
+			finally:
+				db.close()
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def add(self, db, baseDatafileName, source, index):
+		try:
+			records = TLDiff.readChanges(baseDatafileName)
+		except IOError:
+			# no changes recorded for this snapshot
+			return
+
+		# unknown collection times sort first
+		rows = ((r['name_s'], collectionTime(r) or 0, source, index, r['change_s']) for r in records)
+		db.executemany('INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)', rows)
+
+	def compact(self, namespaceDirName, source, dropped, merged):
+		''' like TLHistory.compact(), for one source of the namespace '''
+
+		if not os.path.isfile(namespaceDirName + '/.changes.db'):
+			return
+
+		db = connect(namespaceDirName + '/.changes.db', self.schema)
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			tempIndexes(db, dropped + merged)
+			db.execute('DELETE FROM changes WHERE source = ? AND idx IN (SELECT idx FROM indexes)', (source,))
+			for i in merged:
+				self.add(db, namespaceDirName + '/' + source + '/' + str(i), source, i)
+			db.execute('COMMIT')
+		finally:
+			db.close()
+
+	def find(self, namespace, name, start=None, end=None):
+		'''
+			Yield the changes of a file across all sources of a namespace,
+			oldest first, optionally limited to snapshots collected between
+			start and end (in seconds)
+		'''
+
+		databaseName = TL_DATA_DIR + '/' + namespace + '/.changes.db'
+		if not os.path.isfile(databaseName):
+			return
+
+		query = 'SELECT collection, source, idx, change FROM changes WHERE name = ?'
+		args = [name]
+		if start is not None:
+			query += ' AND collection >= ?'
+			args.append(start)
+		if end is not None:
+			query += ' AND collection <= ?'
+			args.append(end)
+		query += ' ORDER BY collection, source, idx'
+
+		db = connect(databaseName, self.schema)
+		try:
+			for collection, source, idx, change in db.execute(query, args):
+				yield {
+					'source': source,
+					'index': idx,
+					'collection_dt': TLData.formatTime(collection) if collection else None,
+					'change_s': change,
+				}
+		finally:
+			db.close()
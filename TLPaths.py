@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Path dictionary of a namespace
+#
+# Maps every file name seen in the snapshots of a namespace to a small integer
+# id, so columnar snapshots (see TLColumns) store and compare 4 byte ids instead
+# of full paths. An id is never reassigned. The dictionary is one file of runs
+# of paths sorted by name and front-coded: each entry keeps only the part of
+# its path that differs from the entry before, and every TL_PATHS_BLOCK-th entry
+# is kept whole, so a lookup is a binary search over those and the decoding of
+# one block. Paths not seen before are appended as a new run; once there are
+# more than TL_PATHS_RUNS runs, they are merged into one. All paths under a
+# directory are a range of each run.
+#
+####################################################################################
+
+import os
+import struct
+import bisect
+import heapq
+import fcntl
+import threading
+import traceback
+import logging
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_PATHS_BLOCK	=	16	# entries per front-coded block, the first one kept whole
+TL_PATHS_RUNS	=	8	# runs appended before they are merged into one
+
+MAGIC		=	'TLPATHS1'
+RUN		=	struct.Struct('<4sIIII')	# 'RUN1', first id, entries, bytes of entries, blocks
+
+logger = logging.getLogger(__name__)
+
+def encodeVarint(n):
+	if n < 0x80:
+		return chr(n)
+	data = []
+	while n >= 0x80:
+		data.append(chr(n & 0x7f | 0x80))
+		n >>= 7
+	data.append(chr(n))
+	return ''.join(data)
+
+def decodeVarint(data, offset):
+	''' (value, offset after it) of the varint at offset '''
+
+	n = 0
+	shift = 0
+	while True:
+		b = ord(data[offset])
+		offset += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return (n, offset)
+		shift += 7
+
+def sharedLength(a, b):
+	''' length of the common prefix of a and b '''
+
+	# binary search, comparing slices is much faster than characters one by one
+	lo, hi = 0, min(len(a), len(b))
+	while lo < hi:
+		mid = (lo + hi + 1) / 2
+		if a[:mid] == b[:mid]:
+			lo = mid
+		else:
+			hi = mid - 1
+	return lo
+
+def encodeRun(entries, firstId):
+	'''
+		Bytes of a run of (path, id) entries sorted by path, whose ids are
+		firstId up to firstId + len(entries) - 1 in any order
+
+		Layout, little-endian:
+			header		'RUN1', first id, entries, bytes of entries, blocks
+			entries		varint bytes shared with the path before, varint
+					length of the rest, the rest, varint id
+			blocks		uint32 offset of each block in entries
+			positions	uint32 entry number of each id, from firstId on
+	'''
+
+	data = []
+	blocks = []
+	positions = [0] * len(entries)
+	size = 0
+	previous = ''
+	for position, (path, id) in enumerate(entries):
+		if position % TL_PATHS_BLOCK == 0:
+			blocks.append(size)
+			shared = 0
+		else:
+			shared = sharedLength(previous, path)
+		entry = encodeVarint(shared) + encodeVarint(len(path) - shared) + path[shared:] + encodeVarint(id)
+		data.append(entry)
+		size += len(entry)
+		positions[id - firstId] = position
+		previous = path
+
+	return RUN.pack('RUN1', firstId, len(entries), size, len(blocks)) + ''.join(data) + \
+		struct.pack('<{0}I'.format(len(blocks)), *blocks) + \
+		struct.pack('<{0}I'.format(len(positions)), *positions)
+
+def runLength(data, offset):
+	''' bytes of the run at offset, given its header '''
+
+	magic, firstId, count, size, blocks = RUN.unpack_from(data, offset)
+	return RUN.size + size + 4 * blocks + 4 * count
+
+class TLPathRun:
+	'''
+		One run of a path dictionary, decoded a block at a time
+	'''
+
+	def __init__(self, data, offset):
+		magic, self.firstId, self.count, size, blocks = RUN.unpack_from(data, offset)
+		if magic != 'RUN1':
+			raise IOError('Malformed path dictionary run at {0}'.format(offset))
+
+		self.data = data
+		self.entries = offset + RUN.size
+		self.blocks = struct.unpack_from('<{0}I'.format(blocks), data, self.entries + size)
+		self.positions = self.entries + size + 4 * blocks
+		self.end = self.positions + 4 * self.count
+
+		# first path of each block, for binary search
+		self.firstPaths = []
+		for start in self.blocks:
+			offset = decodeVarint(data, self.entries + start)[1]
+			length, offset = decodeVarint(data, offset)
+			self.firstPaths.append(data[offset:offset + length])
+
+		self.cached = (None, None)	# the block decoded last, and its entries
+
+	def block(self, b):
+		''' (path, id) entries of block b '''
+
+		cached = self.cached
+		if cached[0] == b:
+			return cached[1]
+
+		data = self.data
+		entries = []
+		offset = self.entries + self.blocks[b]
+		path = ''
+		for i in range(min(TL_PATHS_BLOCK, self.count - b * TL_PATHS_BLOCK)):
+			# lengths are mostly below 128, a single byte
+			shared = ord(data[offset])
+			if shared < 0x80:
+				offset += 1
+			else:
+				shared, offset = decodeVarint(data, offset)
+			length = ord(data[offset])
+			if length < 0x80:
+				offset += 1
+			else:
+				length, offset = decodeVarint(data, offset)
+			path = path[:shared] + data[offset:offset + length]
+			id, offset = decodeVarint(data, offset + length)
+			entries.append((path, id))
+
+		self.cached = (b, entries)
+		return entries
+
+	def lookup(self, path):
+		''' id of path, None if the run does not have it '''
+
+		b = bisect.bisect_right(self.firstPaths, path) - 1
+		if b < 0:
+			return None
+		for p, id in self.block(b):
+			if p == path:
+				return id
+		return None
+
+	def path(self, id):
+		position = struct.unpack_from('<I', self.data, self.positions + 4 * (id - self.firstId))[0]
+		return self.block(position / TL_PATHS_BLOCK)[position % TL_PATHS_BLOCK][0]
+
+	def iterFrom(self, path):
+		''' yield (path, id) of the entries from the first one not before path on '''
+
+		b = max(bisect.bisect_right(self.firstPaths, path) - 1, 0)
+		for b in range(b, len(self.blocks)):
+			for entry in self.block(b):
+				if entry[0] >= path:
+					yield entry
+
+class TLPathDictionary:
+	'''
+		Path to id dictionary of a namespace, kept in its .paths file
+
+		Each server process loads the file once and then only reads the runs
+		appended since it last looked, like TLData.TLTimeIndex does.
+	'''
+
+	def __init__(self, namespaceDirName):
+		self.fileName = namespaceDirName + '/.paths'
+		self.lock = threading.RLock()
+		self.runs = []
+		self.size = 0		# bytes of the file loaded
+		self.inode = None	# a merge writes a new file
+		self.count = 0		# ids assigned
+
+	def load(self):
+		''' pick up what other processes or threads have written, must hold self.lock '''
+
+		try:
+			f = open(self.fileName, 'rb')
+		except IOError:
+			return
+
+		try:
+			st = os.fstat(f.fileno())
+			if st.st_ino != self.inode or st.st_size < self.size:
+				# runs have been merged, start over
+				self.runs = []
+				self.size = 0
+				self.count = 0
+				self.inode = st.st_ino
+			if st.st_size == self.size:
+				return
+			f.seek(self.size)
+			data = f.read()
+		finally:
+			f.close()
+
+		offset = 0
+		if self.size == 0:
+			if data[:len(MAGIC)] != MAGIC:
+				raise IOError('Malformed path dictionary {0}'.format(self.fileName))
+			offset = len(MAGIC)
+
+		# a run still being appended is picked up next time
+		while offset + RUN.size <= len(data) and offset + runLength(data, offset) <= len(data):
+			run = TLPathRun(data, offset)
+			self.runs.append(run)
+			self.count = max(self.count, run.firstId + run.count)
+			offset = run.end
+		self.size += offset
+
+	def lookup(self, paths):
+		result = []
+		for path in paths:
+			id = None
+			for run in self.runs:
+				id = run.lookup(path)
+				if id is not None:
+					break
+			result.append(id)
+		return result
+
+	def ids(self, paths, add=False):
+		'''
+			Return the ids of paths, None for paths never seen unless add is
+			set, which gives them new ids. Sorted paths are looked up fastest.
+		'''
+
+		with self.lock:
+			self.load()
+			result = self.lookup(paths)
+			if not add or None not in result:
+				return result
+
+			# sources of the namespace ingested at the same time add paths too
+			fd = os.open(self.fileName + '.lock', os.O_RDWR | os.O_CREAT, 0644)
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX)
+				self.load()
+				result = self.lookup(paths)
+
+				missing = sorted(set(path for path, id in zip(paths, result) if id is None))
+				entries = [(path, self.count + i) for i, path in enumerate(missing)]
+				if len(entries) > 0:
+					self.append(encodeRun(entries, self.count))
+					self.load()
+					if len(self.runs) > TL_PATHS_RUNS:
+						self.merge()
+						self.load()
+			finally:
+				os.close(fd)
+
+			added = dict(entries)
+			return [id if id is not None else added[path] for path, id in zip(paths, result)]
+
+	def append(self, run):
+		f = open(self.fileName, 'ab')
+		try:
+			if f.tell() == 0:
+				f.write(MAGIC)
+			f.write(run)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+
+	def merge(self):
+		''' rewrite the dictionary as one run, must hold the file lock '''
+
+		entries = list(heapq.merge(*[run.iterFrom('') for run in self.runs]))
+
+		tmpfileName = self.fileName + '.tmp'
+		try:
+			f = open(tmpfileName, 'wb')
+			try:
+				f.write(MAGIC)
+				f.write(encodeRun(entries, 0))
+				f.flush()
+				os.fsync(f.fileno())
+			finally:
+				f.close()
+			os.rename(tmpfileName, self.fileName)
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			if os.path.isfile(tmpfileName):
+				os.remove(tmpfileName)
+			return
+
+		logger.info("Merged {0} runs of {1}".format(len(self.runs), self.fileName))
+
+	def path(self, id):
+		''' path of an id, None if there is no such id '''
+
+		with self.lock:
+			if id >= self.count:
+				# added by another process
+				self.load()
+			for run in self.runs:
+				if run.firstId <= id < run.firstId + run.count:
+					return run.path(id)
+		return None
+
+	def find(self, prefix):
+		''' yield (path, id) of every path starting with prefix, in path order '''
+
+		with self.lock:
+			self.load()
+			runs = list(self.runs)
+
+		for path, id in heapq.merge(*[run.iterFrom(prefix) for run in runs]):
+			if not path.startswith(prefix):
+				break
+			yield (path, id)
+
+# namespace directory -> TLPathDictionary
+dictionaries = {}
+dictionariesLock = threading.Lock()
+
+def getDictionary(namespaceDirName):
+	''' the TLPathDictionary of a namespace, shared by the threads of a process '''
+
+	with dictionariesLock:
+		dictionary = dictionaries.get(namespaceDirName)
+		if dictionary is None:
+			dictionary = TLPathDictionary(namespaceDirName)
+			dictionaries[namespaceDirName] = dictionary
+		return dictionary
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Runs the ingest stages of each snapshot (raw write -> diff -> index) on a
+# long-lived pool of worker threads
+#
+# Stages form a small dependency graph per snapshot. A stage may depend on other
+# stages of the same snapshot, and on stages of the previous snapshot of the same
+# (namespace,source), e.g. diffing snapshot n needs the raw data of n-1 on disk.
+# Stages whose dependencies are met run concurrently, bounded by the pool size.
+#
+####################################################################################
+
+import os
+import threading
+import traceback
+import logging
+import Queue
+
+from collections import OrderedDict
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_JOB_HISTORY	=	10000	# number of finished jobs kept around
+
+PENDING		=	'pending'
+RUNNING		=	'running'
+DONE		=	'done'
+FAILED		=	'failed'
+SKIPPED		=	'skipped'
+UNKNOWN		=	'unknown'
+
+FINISHED	=	(DONE, FAILED, SKIPPED)
+
+logger = logging.getLogger(__name__)
+
+class TLStage:
+	'''
+		A named pipeline step, run with the snapshot's base data file name
+	'''
+
+	def __init__(self, name, target, depends, previous):
+		self.name = name
+		self.target = target
+		self.depends = depends		# stages of the same snapshot
+		self.previous = previous	# stages of the previous snapshot of the same source
+
+class TLJob:
+	'''
+		Progress of all pipeline stages for one snapshot
+	'''
+
+	def __init__(self, namespace, source, baseDatafileName):
+		self.namespace = namespace
+		self.source = source
+		self.baseDatafileName = baseDatafileName
+		self.index = int(os.path.basename(baseDatafileName))
+		self.id = '{0}:{1}:{2}'.format(namespace, source, self.index)
+		self.stages = OrderedDict()	# stage name -> state
+		self.unmet = {}			# stage name -> set of (job, stage) it still waits for
+		self.dependents = {}		# stage name -> list of (job, stage) waiting for it
+
+	def finished(self):
+		for state in self.stages.values():
+			if state not in FINISHED:
+				return False
+		return True
+
+	def toDict(self):
+		return {
+			'job': self.id,
+			'namespace': self.namespace,
+			'source': self.source,
+			'index': self.index,
+			'stages': OrderedDict(self.stages),
+			'finished': self.finished(),
+		}
+
+class TLPipeline:
+	'''
+		Schedules pipeline stages of submitted snapshots onto worker threads
+
+		The 'raw' stage is performed by the caller (it owns the request body) and
+		reported back through complete() or fail(); every stage added with
+		addStage() is run by the pool once its dependencies have finished.
+		The state each stage finishes in is recorded in the catalog (see
+		TLCatalog), where other processes and tools find it.
+	'''
+
+	def __init__(self, workers, catalog):
+		self.catalog = catalog
+		self.stages = []
+		self.targets = {}		# stage name -> callable
+		self.jobs = OrderedDict()	# job id -> job
+		self.latest = {}		# (namespace,source) -> most recently submitted job
+		self.processed = {}		# (namespace,source) -> index of latest fully processed snapshot
+		self.cond = threading.Condition()
+		self.queue = Queue.Queue()
+
+		for i in range(workers):
+			t = threading.Thread(target=self.work, name='TLPipeline-{0}'.format(i))
+			t.daemon = True
+			t.start()
+
+		logger.info('Started pipeline with {0} workers'.format(workers))
+
+	def addStage(self, name, target, depends=[], previous=[]):
+		self.stages.append(TLStage(name, target, depends, previous))
+		self.targets[name] = target
+
+	def submit(self, namespace, source, baseDatafileName):
+		'''
+			Register a new snapshot whose raw data is being written by the caller
+		'''
+
+		job = TLJob(namespace, source, baseDatafileName)
+
+		with self.cond:
+			prev = self.latest.get((namespace, source))
+			job.stages['raw'] = RUNNING
+			job.dependents['raw'] = []
+
+			for stage in self.stages:
+				job.stages[stage.name] = PENDING
+				job.dependents[stage.name] = []
+				unmet = set()
+				# every stage works on the raw data of its own snapshot
+				for name in ['raw'] + stage.depends:
+					if job.stages[name] not in FINISHED:
+						unmet.add((job, name))
+						job.dependents[name].append((job, stage.name))
+				if prev is not None:
+					for name in stage.previous:
+						if prev.stages[name] not in FINISHED:
+							unmet.add((prev, name))
+							prev.dependents[name].append((job, stage.name))
+				job.unmet[stage.name] = unmet
+
+			self.jobs[job.id] = job
+			self.latest[(namespace, source)] = job
+
+			# forget about the oldest jobs once they are done
+			while len(self.jobs) > TL_JOB_HISTORY:
+				oldest = self.jobs.itervalues().next()
+				if not oldest.finished():
+					break
+				del self.jobs[oldest.id]
+
+		return job
+
+	def complete(self, job, stage):
+		self.record(job, stage, DONE)
+		with self.cond:
+			self.finish(job, stage, DONE)
+
+	def fail(self, job, stage):
+		self.record(job, stage, FAILED)
+		with self.cond:
+			self.finish(job, stage, FAILED)
+
+	def record(self, job, stage, state):
+		''' keep the state a stage finished in, a failure to do so fails no stage '''
+
+		try:
+			self.catalog.setStage(job.namespace, job.source, job.index, stage, state)
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+
+	def getJob(self, jobId):
+		with self.cond:
+			return self.jobs.get(jobId)
+
+	def getStatus(self, job):
+		with self.cond:
+			return job.toDict()
+
+	def getDiskStatus(self, namespace, source, baseDatafileName):
+		'''
+			Status of a snapshot this process knows nothing about, e.g. one that
+			was uploaded to another server process, as recorded in the catalog
+		'''
+
+		job = TLJob(namespace, source, baseDatafileName)
+		stages = self.catalog.getStages(namespace, source, job.index)
+		if 'raw' not in stages:
+			return None
+
+		# stages still running elsewhere are not recorded yet
+		job.stages['raw'] = stages['raw']
+		for stage in self.stages:
+			job.stages[stage.name] = stages.get(stage.name, UNKNOWN)
+
+		return job.toDict()
+
+	def getSourceStatus(self, namespace, source):
+		with self.cond:
+			latest = self.latest.get((namespace, source))
+			pending = []
+			for job in self.jobs.values():
+				if job.namespace == namespace and job.source == source and not job.finished():
+					pending.append(job.id)
+
+			return {
+				'namespace': namespace,
+				'source': source,
+				'latest': latest.index if latest is not None else None,
+				'processed': self.processed.get((namespace, source)),
+				'pending': pending,
+			}
+
+	def wait(self, job, stage):
+		'''
+			Block until the given stage of a job has finished, return its state
+		'''
+
+		with self.cond:
+			while job.stages[stage] not in FINISHED:
+				self.cond.wait()
+			return job.stages[stage]
+
+	def finish(self, job, stage, state):
+		''' must be called with self.cond held '''
+
+		job.stages[stage] = state
+		self.cond.notify_all()
+
+		if job.finished() and job.stages['raw'] == DONE:
+			key = (job.namespace, job.source)
+			if self.processed.get(key, -1) < job.index:
+				self.processed[key] = job.index
+
+		for (j, name) in job.dependents[stage]:
+			if j.stages[name] != PENDING:
+				continue
+			j.unmet[name].discard((job, stage))
+			if j is job and state != DONE:
+				# a stage of the same snapshot failed, nothing to work with;
+				# rare enough to record with self.cond held
+				self.record(j, name, SKIPPED)
+				self.finish(j, name, SKIPPED)
+			elif len(j.unmet[name]) == 0:
+				self.schedule(j, name)
+		job.dependents[stage] = []
+
+	def schedule(self, job, name):
+		''' must be called with self.cond held '''
+
+		job.stages[name] = RUNNING
+		self.queue.put((job, name))
+
+	def work(self):
+		while True:
+			job, name = self.queue.get()
+
+			state = DONE
+			try:
+				if self.targets[name](job.baseDatafileName) is False:
+					state = FAILED
+			except:
+				logger.error(traceback.format_exc().split('\n'))
+				state = FAILED
+
+			self.record(job, name, state)
+			with self.cond:
+				self.finish(job, name, state)
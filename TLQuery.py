@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Local query engine over the change records of a namespace
+#
+# Change records of every snapshot are added to an SQLite database of the
+# namespace, indexed by file name, change type, tag/category (as assigned by
+# lasertag.py) and collection time, so changes can be searched without shipping
+# the <n>.json files to Elasticsearch or Solr. Results are paged with a cursor
+# on (collection time, record id) rather than an offset, so fetching a page
+# deep into the results costs the same as fetching the first one.
+#
+####################################################################################
+
+import os
+import re
+import traceback
+import logging
+import TLData
+import TLDiff
+import TLHistory
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_DATA_DIR	=	'./data'
+TL_QUERY_LIMIT	=	1000	# most records returned per page
+
+logger = logging.getLogger(__name__)
+
+class TLQueryError(Exception):
+	'''
+		Raised on a malformed query, e.g. a bad cursor
+	'''
+
+def prefixRange(prefix):
+	''' [start, end) of the names starting with prefix, in SQLite's text order '''
+
+	if isinstance(prefix, str):
+		prefix = prefix.decode('utf-8')
+	return (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+
+class TLQuery:
+	'''
+		Indexes change records of a namespace and answers filtered, paged
+		queries on them
+	'''
+
+	schema = [
+		'''CREATE TABLE IF NOT EXISTS changes (
+			id INTEGER PRIMARY KEY,
+			source TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			name TEXT NOT NULL,
+			change TEXT NOT NULL,
+			collection INTEGER NOT NULL,
+			modified TEXT,
+			size TEXT,
+			UNIQUE (source, idx, name)
+		)''',
+		'CREATE INDEX IF NOT EXISTS changes_name ON changes (name, collection)',
+		'CREATE INDEX IF NOT EXISTS changes_change ON changes (change, collection)',
+		'CREATE INDEX IF NOT EXISTS changes_collection ON changes (collection)',
+		# tag_s and cat_s values of a record, kind is 'tag' or 'cat'
+		'''CREATE TABLE IF NOT EXISTS tags (
+			kind TEXT NOT NULL,
+			value TEXT NOT NULL,
+			change INTEGER NOT NULL,
+			PRIMARY KEY (kind, value, change)
+		) WITHOUT ROWID''',
+		'CREATE INDEX IF NOT EXISTS tags_change ON tags (change)',
+		# latest snapshot of each source added so far
+		'''CREATE TABLE IF NOT EXISTS sources (
+			source TEXT PRIMARY KEY,
+			idx INTEGER NOT NULL
+		)''',
+	]
+
+	def write(self, baseDatafileName):
+		''' add the changes of a snapshot to the query database of its namespace '''
+
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		namespaceDirName = m.group(1) + '/' + m.group(2)
+		source = m.group(3)
+		index = int(m.group(4))
+
+		if index == 0:
+			return
+
+		try:
+			db = TLHistory.connect(namespaceDirName + '/.query.db', self.schema)
+			try:
+				db.execute('BEGIN IMMEDIATE')
+				row = db.execute('SELECT idx FROM sources WHERE source = ?', (source,)).fetchone()
+				last = row[0] if row is not None else 0
+				# pick up snapshots ingested before, or whose stage ran elsewhere;
+				# one still being indexed adds itself when its own stage runs
+				for i in range(last + 1, index):
+					self.addChanges(db, namespaceDirName + '/' + source + '/' + str(i), source, i)
+				self.addChanges(db, baseDatafileName, source, index)
+				db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (source, max(last, index)))
+				db.execute('COMMIT')
+			finally:
+				db.close()
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def addChanges(self, db, baseDatafileName, source, index):
+		''' add the change records of a snapshot from its .json, if it has any '''
+
+		try:
+			records = TLDiff.readChanges(baseDatafileName)
+		except IOError:
+			# no changes recorded for this snapshot
+			return
+		self.add(db, source, index, records)
+
+	def update(self, namespace, source, index, records):
+		'''
+			Add change records of a snapshot that may carry tag_s and cat_s,
+			e.g. those written by lasertag.py to <index>.tag.json
+		'''
+
+		db = TLHistory.connect(TL_DATA_DIR + '/' + namespace + '/.query.db', self.schema)
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			self.add(db, source, index, records)
+			db.execute('COMMIT')
+		finally:
+			db.close()
+
+	def add(self, db, source, index, records):
+		for r in records:
+			# unknown collection times sort first
+			db.execute('INSERT OR IGNORE INTO changes (source, idx, name, change, collection, modified, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(source, index, r['name_s'], r['change_s'], TLHistory.collectionTime(r) or 0, r.get('lastmodifiedtime_dt'), r.get('size_i')))
+
+			if 'tag_s' not in r and 'cat_s' not in r:
+				continue
+			change = db.execute('SELECT id FROM changes WHERE source = ? AND idx = ? AND name = ?', (source, index, r['name_s'])).fetchone()[0]
+			for kind, field in (('tag', 'tag_s'), ('cat', 'cat_s')):
+				for value in r.get(field, []):
+					db.execute('INSERT OR IGNORE INTO tags VALUES (?, ?, ?)', (kind, value, change))
+
+	def compact(self, namespaceDirName, source, dropped, merged):
+		''' like TLHistory.TLHistory.compact(), for one source of the namespace '''
+
+		if not os.path.isfile(namespaceDirName + '/.query.db'):
+			return
+
+		db = TLHistory.connect(namespaceDirName + '/.query.db', self.schema)
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			TLHistory.tempIndexes(db, dropped + merged)
+			db.execute('DELETE FROM tags WHERE change IN (SELECT id FROM changes WHERE source = ? AND idx IN (SELECT idx FROM indexes))', (source,))
+			db.execute('DELETE FROM changes WHERE source = ? AND idx IN (SELECT idx FROM indexes)', (source,))
+			for i in merged:
+				try:
+					records = TLDiff.readChanges(namespaceDirName + '/' + source + '/' + str(i))
+				except IOError:
+					continue
+				self.add(db, source, i, records)
+			db.execute('COMMIT')
+		finally:
+			db.close()
+
+	def find(self, namespace, prefix=None, change=None, tag=None, cat=None, source=None, start=None, end=None, limit=TL_QUERY_LIMIT, after=None):
+		'''
+			Return (records, cursor) of the changes in a namespace matching all
+			given filters, oldest first, at most limit of them. Pass cursor as
+			after to get the next page, it is None after the last page.
+		'''
+
+		databaseName = TL_DATA_DIR + '/' + namespace + '/.query.db'
+		if not os.path.isfile(databaseName):
+			return ([], None)
+
+		query = 'SELECT id, source, idx, name, change, collection, modified, size FROM changes WHERE 1'
+		args = []
+		if prefix:
+			query += ' AND name >= ? AND name < ?'
+			args.extend(prefixRange(prefix))
+		if change is not None:
+			query += ' AND change = ?'
+			args.append(change)
+		if source is not None:
+			query += ' AND source = ?'
+			args.append(source)
+		if start is not None:
+			query += ' AND collection >= ?'
+			args.append(start)
+		if end is not None:
+			query += ' AND collection <= ?'
+			args.append(end)
+		for kind, value in (('tag', tag), ('cat', cat)):
+			if value is not None:
+				query += ' AND id IN (SELECT change FROM tags WHERE kind = ? AND value = ?)'
+				args.extend([kind, value])
+		if after is not None:
+			m = re.match(r'^([0-9]+):([0-9]+)$', after)
+			if m is None:
+				raise TLQueryError(after)
+			query += ' AND (collection > ? OR (collection = ? AND id > ?))'
+			args.extend([int(m.group(1)), int(m.group(1)), int(m.group(2))])
+		query += ' ORDER BY collection, id LIMIT ?'
+		args.append(min(limit, TL_QUERY_LIMIT))
+
+		db = TLHistory.connect(databaseName, self.schema)
+		try:
+			rows = db.execute(query, args).fetchall()
+
+			records = []
+			for id, source, idx, name, change, collection, modified, size in rows:
+				r = {
+					'source': source,
+					'index': idx,
+					'name_s': name,
+					'change_s': change,
+					'collection_dt': TLData.formatTime(collection) if collection else None,
+					'lastmodifiedtime_dt': modified,
+					'size_i': size,
+				}
+				tags = db.execute('SELECT kind, value FROM tags WHERE change = ?', (id,)).fetchall()
+				for kind, value in tags:
+					r.setdefault(kind + '_s', []).append(value)
+				records.append(r)
+		finally:
+			db.close()
+
+		cursor = None
+		if len(rows) == min(limit, TL_QUERY_LIMIT):
+			cursor = '{0}:{1}'.format(rows[-1][5], rows[-1][0])
+		return (records, cursor)
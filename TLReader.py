@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Incremental readers of raw data, .diff and change record files
+#
+# Every consumer of those files reads them through here a line, or a record, at
+# a time, so it holds one file entry in memory rather than the whole file and
+# the lists built from it, whatever the number of files on the host.
+#
+####################################################################################
+
+import re
+import itertools
+import logging
+
+from collections import OrderedDict
+
+try: import simplejson as json
+except ImportError: import json
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_READ_CHUNK	=	64 * 1024	# bytes of a JSON list read at a time
+
+logger = logging.getLogger(__name__)
+
+class TLSnapshotReader:
+	'''
+		Yields the file entry lines of raw data, stripped of whitespace and
+		their trailing ',' (the form agent.sh hashes), in file order
+
+		The header fields come before the entries in raw data, they are set
+		as hostname and collectionTime once read past.
+	'''
+
+	headerpattern = re.compile(r'^"(hostname_s|collection_dt)":\s*"(.*)"')
+	namepattern = re.compile(r'^\{"name_s":\s*"([^"]*)"')
+
+	def __init__(self, f):
+		self.f = f
+		self.hostname = None
+		self.collectionTime = None	# as written by the agent, e.g. 2014-09-24T10:43:00Z
+
+	def __iter__(self):
+		for lines in self.batches():
+			for line in lines:
+				yield line
+
+	def batches(self):
+		''' yield the entry lines in lists, of those read TL_READ_CHUNK bytes at a time '''
+
+		rest = ''
+		while rest is not None:
+			data = self.f.read(TL_READ_CHUNK)
+			lines = (rest + data).split('\n')
+			if data:
+				rest = lines.pop()
+			else:
+				rest = None
+
+			lines = [line.strip() for line in lines]
+			entries = [line[:-1] if line[-1] == ',' else line for line in lines if line.startswith('{"')]
+			if len(entries) < len(lines):
+				for line in lines:
+					if not line.startswith('{"'):
+						self.header(line)
+			if len(entries) > 0:
+				yield entries
+
+	def header(self, line):
+		''' set hostname or collectionTime if line is one of the header fields '''
+
+		m = self.headerpattern.match(line)
+		if m is not None:
+			if m.group(1) == 'hostname_s':
+				self.hostname = m.group(2)
+			else:
+				self.collectionTime = m.group(2)
+
+	def entries(self):
+		''' yield (file name, entry line), name is None if it has none '''
+
+		for line in self:
+			m = self.namepattern.match(line)
+			yield (m.group(1) if m is not None else None, line)
+
+	def records(self):
+		''' yield the file entries parsed '''
+
+		for line in self:
+			yield json.loads(line)
+
+	def readHeader(self):
+		''' read up to the first file entries, return (hostname, collection time) '''
+
+		for line in self:
+			break
+		return (self.hostname, self.collectionTime)
+
+	def close(self):
+		self.f.close()
+
+class TLDiffReader:
+	'''
+		Yields (file name, entry line before, entry line after) of every file
+		in a .diff (see TLDiff.TLDiffData), a line is None if the file is
+		missing from that snapshot
+
+		A '<' line followed by a '>' line of the same file is a modification.
+		The collection time of the later snapshot comes first, it is set as
+		collectionTime once read past. Hunks of GNU diff output, as written
+		before the diff engine, are paired up by file name one hunk at a time.
+	'''
+
+	hunkpattern = re.compile(r'^[0-9]+(,[0-9]+)?[acd][0-9]+(,[0-9]+)?$')
+
+	def __init__(self, f):
+		self.f = f
+		self.collectionTime = None
+
+	def __iter__(self):
+		pending = None	# (name, line) of a '<' line, until the next line tells whether it was modified
+		hunk = None	# (name -> line before, name -> line after) of a hunk of GNU diff output
+
+		for line in self.f:
+			line = line.rstrip('\r\n')
+			if self.hunkpattern.match(line):
+				if hunk is not None:
+					for change in self.pair(hunk):
+						yield change
+				hunk = (OrderedDict(), OrderedDict())
+				continue
+			if line[:2] not in ('< ', '> '):
+				# '---' between the sides of a hunk
+				continue
+
+			side = line[0]
+			line = line[2:].strip()
+			if line.endswith(','):
+				line = line[:-1]
+			m = TLSnapshotReader.headerpattern.match(line)
+			if m is not None:
+				if side == '>' and m.group(1) == 'collection_dt':
+					self.collectionTime = m.group(2)
+				continue
+			m = TLSnapshotReader.namepattern.match(line)
+			if m is None:
+				continue
+			name = m.group(1)
+
+			if hunk is not None:
+				hunk[side == '>'][name] = line
+			elif side == '<':
+				if pending is not None:
+					yield (pending[0], pending[1], None)
+				pending = (name, line)
+			elif pending is not None and pending[0] == name:
+				yield (name, pending[1], line)
+				pending = None
+			else:
+				if pending is not None:
+					yield (pending[0], pending[1], None)
+					pending = None
+				yield (name, None, line)
+
+		if pending is not None:
+			yield (pending[0], pending[1], None)
+		if hunk is not None:
+			for change in self.pair(hunk):
+				yield change
+
+	def pair(self, hunk):
+		before, after = hunk
+		for name, line in before.iteritems():
+			yield (name, line, after.pop(name, None))
+		for name, line in after.iteritems():
+			yield (name, None, line)
+
+	def close(self):
+		self.f.close()
+
+def iterList(f, data=''):
+	'''
+		Yield the objects of a JSON list one at a time, reading TL_READ_CHUNK
+		bytes at a time, data is what has been read of f already
+	'''
+
+	decoder = json.JSONDecoder()
+	offset = 0
+	eof = False
+
+	while True:
+		# skip the opening '[', and whitespace and ',' between objects
+		while offset < len(data) and data[offset] in ' \t\r\n,[':
+			offset += 1
+		if offset < len(data):
+			if data[offset] == ']':
+				return
+			try:
+				r, end = decoder.raw_decode(data, offset)
+			except ValueError:
+				# cut short by the end of what was read
+				if eof:
+					raise
+			else:
+				offset = end
+				yield r
+				continue
+		elif eof:
+			raise ValueError('JSON list cut short')
+
+		chunk = f.read(TL_READ_CHUNK)
+		eof = not chunk
+		data = data[offset:] + chunk
+		offset = 0
+
+def iterRecords(f):
+	'''
+		Yield the change records of an open .json file one at a time, in
+		either the Solr (JSON list) or the ElasticSearch (bulk lines) format,
+		and close it when done
+	'''
+
+	try:
+		first = f.readline()
+		if first.startswith('['):
+			for r in iterList(f, first):
+				yield r
+			return
+
+		action = None
+		for line in itertools.chain([first], f):
+			if not line:
+				break
+			# odd lines are bulk actions, even lines the records
+			if action is None:
+				action = json.loads(line)
+				continue
+			r = json.loads(line)
+			# the ElasticSearch indexer moved the id into the action
+			r['id'] = action['index']['_id']
+			action = None
+			yield r
+	finally:
+		f.close()
+
+def iterBulk(f):
+	''' yield (action, record) of an ElasticSearch bulk file, and close it when done '''
+
+	try:
+		while True:
+			action = f.readline()
+			data = f.readline()
+			if not data:
+				break
+			yield (json.loads(action), json.loads(data))
+	finally:
+		f.close()
+
+def writeList(f, records, indent=None):
+	''' write records to f as a JSON list, one at a time '''
+
+	separator = '['
+	for r in records:
+		f.write(separator + '\n')
+		data = json.dumps(r, indent=indent)
+		if indent is not None:
+			data = ' ' * indent + data.replace('\n', '\n' + ' ' * indent)
+		f.write(data)
+		separator = ','
+	if separator == '[':
+		f.write('[')
+	f.write('\n]\n')
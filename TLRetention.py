@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Retention and compaction of the snapshots of a source
+#
+# A retention policy lists (age, resolution) tiers, e.g. [(7 days, 1 hour),
+# (90 days, 1 day)]: snapshots collected more than age ago are only kept one per
+# resolution, the last one collected in each hour or day, and more recent ones
+# all of them. Snapshots past their retention are dropped along with all their
+# artifacts, and the change set of the next snapshot kept is replaced by the
+# changes since the snapshot kept before it, so diffs, history and the change
+# indexes stay consistent. Rollup buckets finer than the snapshots kept around
+# their time are dropped too.
+#
+# Compaction runs as the last pipeline stage of a snapshot, at most once every
+# TL_COMPACT_INTERVAL seconds per source, next to ingest of later snapshots. The
+# snapshots to drop are written to the .compact file of the source first, so a
+# compaction cut short is finished by the next one.
+#
+####################################################################################
+
+import os
+import re
+import time
+import fcntl
+import traceback
+import logging
+import TLData
+import TLCatalog
+import TLDiff
+import TLHistory
+import TLRollup
+import TLQuery
+
+try: import simplejson as json
+except ImportError: import json
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_COMPACT_INTERVAL	=	3600	# seconds between compactions of a source
+
+# every artifact of a snapshot, see TLData.removeArtifact
+ARTIFACTS	=	('', '.delta', '.hash', '.col', '.index', '.diff', '.json', '.tag.json')
+
+logger = logging.getLogger(__name__)
+
+def resolution(policy, age):
+	''' seconds between the snapshots kept at age (in seconds), 0 if all of them are kept '''
+
+	result = 0
+	for tierAge, tierResolution in sorted(policy):
+		if age >= tierAge:
+			result = tierResolution
+	return result
+
+def select(policy, entries, now, limit):
+	'''
+		Return the indexes of the snapshots to drop, given the sorted (time,
+		index) entries of a source. The first snapshot and those from limit on
+		are always kept.
+	'''
+
+	dropped = []
+	buckets = {}	# (resolution, bucket) -> index of the last snapshot collected in it
+	for t, index in entries:
+		if index == 0 or index >= limit:
+			continue
+		r = resolution(policy, now - t)
+		if r == 0:
+			continue
+		key = (r, t - t % r)
+		if key in buckets:
+			dropped.append(buckets[key])
+		buckets[key] = index
+	return sorted(set(dropped))
+
+def cutoffs(policy, now):
+	''' collection time of the oldest rollup bucket kept, per granularity '''
+
+	result = {}
+	for granularity, seconds in TLRollup.GRANULARITIES.items():
+		ages = [age for age, r in policy if r > seconds]
+		if len(ages) > 0:
+			result[granularity] = now - min(ages)
+	return result
+
+class TLCompactor:
+	'''
+		Drops the snapshots of a source past their retention, and merges the
+		change sets around them
+	'''
+
+	def __init__(self, policy, indexer):
+		self.policy = policy
+		self.indexer = indexer
+
+	def write(self, baseDatafileName):
+		''' compact the source of a snapshot, if it has not been lately '''
+
+		m = re.match(r'(^.*)/(.*)/(.*)/([0-9]+$)', baseDatafileName)
+		namespaceDirName = m.group(1) + '/' + m.group(2)
+		source = m.group(3)
+		baseDirName = namespaceDirName + '/' + source
+		index = int(m.group(4))
+
+		try:
+			fd = os.open(baseDirName + '/.compact.lock', os.O_RDWR | os.O_CREAT, 0644)
+			try:
+				try:
+					fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError:
+					# another process is at it
+					return True
+
+				now = int(time.time())
+				plan = self.readPlan(baseDirName)
+				if plan is None:
+					last = os.read(fd, 32)
+					if last and now - int(last) < TL_COMPACT_INTERVAL:
+						return True
+					plan = self.plan(m.group(2), source, baseDirName, now, index - 1)
+					if plan is None:
+						self.stamp(fd, now)
+						return True
+					self.writePlan(baseDirName, plan)
+
+				self.compact(namespaceDirName, source, plan, now)
+				os.remove(baseDirName + '/.compact')
+				self.stamp(fd, now)
+			finally:
+				os.close(fd)
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def plan(self, namespace, source, baseDirName, now, limit):
+		'''
+			Return {'dropped': indexes, 'merged': indexes, 'rebased': [[index,
+			next index], ...]}, None if nothing is to be dropped. The snapshot
+			before limit is still read by the next one's ingest stages.
+		'''
+
+		tlti = TLData.TLTimeIndex()
+		with TLData.TLTimeIndex.cacheLock:
+			entries = list(tlti.load(namespace, source))
+
+		dropped = select(self.policy, entries, now, limit)
+		if len(dropped) == 0:
+			return None
+
+		droppedSet = set(dropped)
+		kept = sorted(set(index for t, index in entries) - droppedSet)
+
+		merged = set()
+		rebased = []
+		for i, index in enumerate(kept[:-1]):
+			next = kept[i + 1]
+			if not any(j in droppedSet for j in range(index + 1, next)):
+				continue
+			# the change set of next has to be rebuilt against index
+			merged.add(next)
+			# a delta points to the snapshot stored after it
+			header = TLData.TLSnapshotDelta().header(baseDirName + '/' + str(index))
+			if header and not header.startswith('@') and int(header) in droppedSet:
+				rebased.append([index, next])
+
+		return { 'dropped': dropped, 'merged': sorted(merged), 'rebased': rebased }
+
+	def compact(self, namespaceDirName, source, plan, now):
+		namespace = os.path.basename(namespaceDirName)
+		baseDirName = namespaceDirName + '/' + source
+		dropped = plan['dropped']
+		merged = plan['merged']
+		droppedSet = set(dropped)
+
+		# every step can be done again, should the last compaction not have
+		# finished. Latest first, so each is rebased onto one already rebased.
+		delta = TLData.TLSnapshotDelta()
+		for index, next in sorted(plan['rebased'], reverse=True):
+			header = delta.header(baseDirName + '/' + str(index))
+			if header and not header.startswith('@') and int(header) in droppedSet:
+				delta.rebase(baseDirName + '/' + str(index), baseDirName + '/' + str(next))
+
+		# from here on /get, /diff and the diff stage no longer find the
+		# snapshots dropped
+		TLData.TLTimeIndex().remove(baseDirName, dropped)
+		catalog = TLCatalog.TLCatalog()
+		catalog.remove(namespace, source, dropped)
+
+		for index in dropped:
+			for suffix in ARTIFACTS:
+				TLData.removeArtifact(baseDirName + '/' + str(index) + suffix)
+
+		# the previous snapshot found by the diff stage is the one kept before
+		for index in merged:
+			baseDatafileName = baseDirName + '/' + str(index)
+			TLDiff.TLDiffData().write(baseDatafileName)
+			self.indexer.write(baseDatafileName)
+			# tags of the changes before, lasertag.py tags the new ones again
+			TLData.removeArtifact(baseDatafileName + '.tag.json')
+		catalog.clearStage(namespace, source, merged, 'tag')
+
+		TLHistory.TLHistory().compact(baseDirName, dropped, merged)
+		TLHistory.TLNamespaceHistory().compact(namespaceDirName, source, dropped, merged)
+		TLQuery.TLQuery().compact(namespaceDirName, source, dropped, merged)
+		TLRollup.TLRollup().compact(baseDirName, dropped, cutoffs(self.policy, now))
+
+		logger.info("Compacted {0}: dropped {1} snapshots, merged {2} change sets".format(baseDirName, len(dropped), len(merged)))
+
+	def readPlan(self, baseDirName):
+		''' plan of a compaction that has not finished, None if there is none '''
+
+		try:
+			f = open(baseDirName + '/.compact', 'r')
+		except IOError:
+			return None
+		try:
+			return json.load(f)
+		finally:
+			f.close()
+
+	def writePlan(self, baseDirName, plan):
+		planfileName = baseDirName + '/.compact'
+		f = open(planfileName + '.tmp', 'w')
+		try:
+			json.dump(plan, f)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(planfileName + '.tmp', planfileName)
+
+	def stamp(self, fd, now):
+		''' record when the source was last compacted in its .compact.lock '''
+
+		data = str(now)
+		os.lseek(fd, 0, os.SEEK_SET)
+		os.write(fd, data)
+		os.ftruncate(fd, len(data))
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Change counts of a source per directory and time bucket
+#
+# As snapshots are ingested, their added/modified/deleted records are counted
+# per directory prefix, up to TL_ROLLUP_DEPTH levels deep, and per minute, hour
+# and day of collection time, in an SQLite table of the source. Dashboards read
+# a few rows per bucket instead of aggregating every change record.
+#
+####################################################################################
+
+import os
+import re
+import traceback
+import logging
+import TLData
+import TLDiff
+import TLHistory
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_DATA_DIR	=	'./data'
+TL_ROLLUP_DEPTH	=	2	# directory levels counted, /usr/lib64/libc.so counts for /, /usr and /usr/lib64
+
+GRANULARITIES	=	{ 'minute': 60, 'hour': 3600, 'day': 86400 }
+CHANGES		=	('added', 'modified', 'deleted')
+
+logger = logging.getLogger(__name__)
+
+def prefixes(name, depth):
+	''' directories a file counts for: /usr/lib64/libc.so -> /, /usr, /usr/lib64 '''
+
+	result = ['/']
+	parts = name.split('/')[1:-1]
+	for i in range(1, min(depth, len(parts)) + 1):
+		result.append('/' + '/'.join(parts[:i]))
+	return result
+
+class TLRollup:
+	'''
+		Counts changes of a source per directory prefix and time bucket
+	'''
+
+	schema = [
+		'''CREATE TABLE IF NOT EXISTS rollup (
+			granularity TEXT NOT NULL,
+			bucket INTEGER NOT NULL,
+			prefix TEXT NOT NULL,
+			added INTEGER NOT NULL,
+			modified INTEGER NOT NULL,
+			deleted INTEGER NOT NULL,
+			PRIMARY KEY (granularity, prefix, bucket)
+		) WITHOUT ROWID''',
+		# snapshots already counted, so a stage run twice counts once
+		'''CREATE TABLE IF NOT EXISTS snapshots (
+			idx INTEGER PRIMARY KEY
+		)''',
+	]
+
+	def write(self, baseDatafileName):
+		''' add the changes of a snapshot to the rollups of its source '''
+
+		m = re.match(r'(^.*)/([0-9]+$)', baseDatafileName)
+		baseDirName = m.group(1)
+		index = int(m.group(2))
+
+		if index == 0:
+			return
+
+		try:
+			db = TLHistory.connect(baseDirName + '/.rollup.db', self.schema)
+			try:
+				db.execute('BEGIN IMMEDIATE')
+				if db.execute('PRAGMA user_version').fetchone()[0] == 0:
+					# first snapshot counted, pick up the ones ingested before
+					for i in range(1, index):
+						self.add(db, baseDirName + '/' + str(i), i)
+					db.execute('PRAGMA user_version = 1')
+				self.add(db, baseDatafileName, index)
+				db.execute('COMMIT')
+			finally:
+				db.close()
+
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			return False
+
+		return True
+
+	def add(self, db, baseDatafileName, index):
+		if db.execute('SELECT 1 FROM snapshots WHERE idx = ?', (index,)).fetchone() is not None:
+			return
+
+		try:
+			records = TLDiff.readChanges(baseDatafileName)
+		except IOError:
+			# no changes recorded for this snapshot
+			return
+
+		# (granularity, bucket, prefix) -> [added, modified, deleted]
+		counts = {}
+		for r in records:
+			t = TLHistory.collectionTime(r)
+			if t is None or r.get('change_s') not in CHANGES:
+				continue
+			column = CHANGES.index(r['change_s'])
+			for prefix in prefixes(r['name_s'], TL_ROLLUP_DEPTH):
+				for granularity, seconds in GRANULARITIES.items():
+					key = (granularity, t - t % seconds, prefix)
+					if key not in counts:
+						counts[key] = [0, 0, 0]
+					counts[key][column] += 1
+
+		for (granularity, bucket, prefix), (added, modified, deleted) in counts.items():
+			cursor = db.execute('UPDATE rollup SET added = added + ?, modified = modified + ?, deleted = deleted + ? WHERE granularity = ? AND prefix = ? AND bucket = ?',
+				(added, modified, deleted, granularity, prefix, bucket))
+			if cursor.rowcount == 0:
+				db.execute('INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?)', (granularity, bucket, prefix, added, modified, deleted))
+		db.execute('INSERT INTO snapshots VALUES (?)', (index,))
+
+	def compact(self, baseDirName, dropped, cutoffs):
+		'''
+			Forget the snapshots dropped by TLRetention, whose changes remain
+			counted, and the buckets of each granularity collected before its
+			cutoff time (in seconds), past which snapshots are kept too far
+			apart for them to tell anything
+		'''
+
+		if not os.path.isfile(baseDirName + '/.rollup.db'):
+			return
+
+		db = TLHistory.connect(baseDirName + '/.rollup.db', self.schema)
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			TLHistory.tempIndexes(db, dropped)
+			db.execute('DELETE FROM snapshots WHERE idx IN (SELECT idx FROM indexes)')
+			for granularity, cutoff in cutoffs.items():
+				db.execute('DELETE FROM rollup WHERE granularity = ? AND bucket < ?', (granularity, cutoff))
+			db.execute('COMMIT')
+		finally:
+			db.close()
+
+	def find(self, namespace, source, granularity, prefix='/', start=None, end=None):
+		'''
+			Yield the change counts under a directory per time bucket, oldest
+			first, optionally limited to buckets between start and end (in seconds)
+		'''
+
+		databaseName = TL_DATA_DIR + '/' + namespace + '/' + source + '/.rollup.db'
+		if not os.path.isfile(databaseName):
+			return
+
+		query = 'SELECT bucket, added, modified, deleted FROM rollup WHERE granularity = ? AND prefix = ?'
+		args = [granularity, prefix]
+		if start is not None:
+			# the bucket holding start
+			query += ' AND bucket >= ?'
+			args.append(start - start % GRANULARITIES[granularity])
+		if end is not None:
+			query += ' AND bucket <= ?'
+			args.append(end)
+		query += ' ORDER BY bucket'
+
+		db = TLHistory.connect(databaseName, self.schema)
+		try:
+			for bucket, added, modified, deleted in db.execute(query, args):
+				yield {
+					'bucket_dt': TLData.formatTime(bucket),
+					'prefix': prefix,
+					'added': added,
+					'modified': modified,
+					'deleted': deleted,
+				}
+		finally:
+			db.close()
@@ -0,0 +1,301 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Production HTTP server for the Time Line (TL) REST services
+#
+# Serves a bottle app from a fixed pool of worker threads, with HTTP/1.1
+# keep-alive and a bounded accept queue. Optionally several worker processes
+# are pre-forked, all accepting on the same listening socket.
+#
+####################################################################################
+
+import os
+import sys
+import signal
+import socket
+import threading
+import traceback
+import logging
+import Queue
+import BaseHTTPServer
+import bottle
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+####################################################################################
+#
+# Configurations
+#
+####################################################################################
+
+TL_THREADS	=	32	# worker threads per process
+TL_PROCESSES	=	1	# pre-forked worker processes, 1 means no forking
+TL_BACKLOG	=	128	# connections waiting to be accepted by the kernel
+TL_KEEPALIVE	=	30	# seconds an idle connection is kept open
+TL_DRAIN	=	64 * 1024	# unread request body drained to keep a connection alive
+
+logger = logging.getLogger(__name__)
+
+class TLInput:
+	'''
+		wsgi.input limited to the request body, so the application never
+		reads into the next request of a kept-alive connection
+	'''
+
+	def __init__(self, rfile, length):
+		self.rfile = rfile
+		self.remaining = length
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		if size == 0:
+			return ''
+		data = self.rfile.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def readline(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		if size == 0:
+			return ''
+		data = self.rfile.readline(size)
+		self.remaining -= len(data)
+		return data
+
+	def readlines(self, hint=None):
+		return list(self)
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+class TLServerHandler(ServerHandler):
+	'''
+		Runs the WSGI app for one request, answering in HTTP/1.1
+
+		Streamed responses, without a Content-Length, are sent with chunked
+		transfer encoding so the connection can be kept alive.
+	'''
+
+	http_version = '1.1'
+	chunked = False
+
+	def bodyless(self):
+		''' True if the response must not have a body at all '''
+
+		return self.status[:3] in ('204', '304')
+
+	def cleanup_headers(self):
+		ServerHandler.cleanup_headers(self)
+		if 'Content-Length' not in self.headers and not self.bodyless():
+			if self.request_handler.request_version == 'HTTP/1.1':
+				self.headers['Transfer-Encoding'] = 'chunked'
+				self.chunked = True
+			else:
+				# the end of the body can only be told by closing the connection
+				self.headers['Connection'] = 'close'
+				self.request_handler.close_connection = 1
+
+	def write(self, data):
+		if not self.headers_sent:
+			# decides whether the body is chunked, a single block of data
+			# is sent with its Content-Length instead
+			self.bytes_sent = len(data)
+			self.send_headers()
+		if self.chunked:
+			if not data:
+				# an empty chunk would end the body
+				return
+			data = '{0:x}\r\n{1}\r\n'.format(len(data), data)
+		ServerHandler.write(self, data)
+
+	def finish_content(self):
+		if not self.headers_sent and self.bodyless():
+			# neither a Content-Length nor a chunked body
+			self.send_headers()
+			return
+		ServerHandler.finish_content(self)
+		if self.chunked:
+			self._write('0\r\n\r\n')
+			self._flush()
+
+class TLRequestHandler(WSGIRequestHandler):
+	'''
+		Serves requests of one connection until the client or a timeout closes it
+	'''
+
+	protocol_version = 'HTTP/1.1'
+	timeout = TL_KEEPALIVE
+
+	def setup(self):
+		WSGIRequestHandler.setup(self)
+		# responses go out in several small writes
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def address_string(self):
+		# no reverse DNS lookup on every request
+		return self.client_address[0]
+
+	def log_message(self, format, *args):
+		logger.debug('{0} {1}'.format(self.client_address[0], format % args))
+
+	def handle(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+
+	def handle_one_request(self):
+		try:
+			self.raw_requestline = self.rfile.readline(65537)
+		except socket.timeout:
+			self.close_connection = 1
+			return
+
+		if not self.raw_requestline:
+			self.close_connection = 1
+			return
+
+		if len(self.raw_requestline) > 65536:
+			self.requestline = ''
+			self.request_version = ''
+			self.command = ''
+			self.send_error(414)
+			self.close_connection = 1
+			return
+
+		if not self.parse_request():
+			# An error code has been sent, just exit
+			self.close_connection = 1
+			return
+
+		environ = self.get_environ()
+		if 'chunked' in self.headers.getheader('transfer-encoding', '').lower():
+			# body length is not known up front, let the app read to the end
+			self.close_connection = 1
+			body = None
+			stdin = self.rfile
+		else:
+			try:
+				body = TLInput(self.rfile, int(environ.get('CONTENT_LENGTH') or 0))
+			except ValueError:
+				self.send_error(400, 'Bad Content-Length')
+				self.close_connection = 1
+				return
+			stdin = body
+
+		handler = TLServerHandler(stdin, self.wfile, self.get_stderr(), environ)
+		handler.request_handler = self
+		handler.run(self.server.get_app())
+
+		# skip whatever the app did not read, or give up on the connection
+		if body is not None and body.remaining > 0:
+			if body.remaining > TL_DRAIN:
+				self.close_connection = 1
+			else:
+				try:
+					body.read()
+				except socket.error:
+					self.close_connection = 1
+
+class TLThreadPoolServer(WSGIServer):
+	'''
+		WSGI server handing accepted connections to a fixed pool of threads
+
+		When every thread is busy, accepting stops and new connections wait in
+		the kernel's listen queue of request_queue_size entries.
+	'''
+
+	allow_reuse_address = True
+
+	def __init__(self, server_address, RequestHandlerClass, threads, backlog):
+		self.threads = threads
+		self.request_queue_size = backlog
+		self.requests = Queue.Queue(threads)
+		WSGIServer.__init__(self, server_address, RequestHandlerClass)
+
+	def serve_forever(self, poll_interval=0.5):
+		# threads are only started here so the server can be created before forking
+		for i in range(self.threads):
+			t = threading.Thread(target=self.serveRequests, name='TLServer-{0}'.format(i))
+			t.daemon = True
+			t.start()
+
+		logger.info('Process({0}) serving with {1} threads'.format(os.getpid(), self.threads))
+		WSGIServer.serve_forever(self, poll_interval)
+
+	def process_request(self, request, client_address):
+		self.requests.put((request, client_address))
+
+	def serveRequests(self):
+		while True:
+			request, client_address = self.requests.get()
+			try:
+				self.finish_request(request, client_address)
+			except:
+				logger.error(traceback.format_exc().split('\n'))
+			finally:
+				self.shutdown_request(request)
+
+class TLServerAdapter(bottle.ServerAdapter):
+	'''
+		bottle server adapter, pass it as app.run(server=TLServer.TLServerAdapter)
+
+		Options: threads, processes, backlog, keepalive, and init, a function
+		called in every serving process before it starts accepting requests
+	'''
+
+	def run(self, app):
+		threads = self.options.get('threads', TL_THREADS)
+		processes = self.options.get('processes', TL_PROCESSES)
+		backlog = self.options.get('backlog', TL_BACKLOG)
+		init = self.options.get('init', None)
+
+		class RequestHandler(TLRequestHandler):
+			timeout = self.options.get('keepalive', TL_KEEPALIVE)
+
+		server = TLThreadPoolServer((self.host, self.port), RequestHandler, threads, backlog)
+		server.set_app(app)
+
+		if processes <= 1:
+			if init is not None:
+				init()
+			server.serve_forever()
+		else:
+			self.prefork(server, processes, init)
+
+	def prefork(self, server, processes, init):
+		''' keep processes children serving on the listening socket of server '''
+
+		children = set()
+
+		def terminate(signum, frame):
+			sys.exit(0)
+		signal.signal(signal.SIGTERM, terminate)
+
+		try:
+			while True:
+				while len(children) < processes:
+					pid = os.fork()
+					if pid == 0:
+						signal.signal(signal.SIGTERM, signal.SIG_DFL)
+						try:
+							if init is not None:
+								init()
+							server.serve_forever()
+						except KeyboardInterrupt:
+							pass
+						except:
+							logger.error(traceback.format_exc().split('\n'))
+						os._exit(1)
+					children.add(pid)
+
+				pid, status = os.wait()
+				children.discard(pid)
+				logger.error('Worker process({0}) exited with status {1}, restarting'.format(pid, status))
+		finally:
+			for pid in children:
+				try:
+					os.kill(pid, signal.SIGTERM)
+				except OSError:
+					pass
+			server.server_close()
@@ -11,6 +11,8 @@
 #################################################
 
 compressed=1
+async=1		# return as soon as the data is stored, without waiting for it to be diffed
+check=1		# skip the upload if the server already has identical data
 timelineserver="localhost:10252"
 
 if [ -z "$1" ]
@@ -41,25 +43,45 @@ exec >$f
 
 # Collecing all files on the file system and put them into json format
 # /root /sys /proc directories are skipped
-# file name, last modified time, and file size are printed for each file
+# file name, last modified time, and file size are printed for each file,
+# sorted (in the C locale) so the server can diff them without sorting them
 echo "{"
 echo "	\"hostname_s\": " "\"`hostname`\","
 echo "	\"collection_dt\": " "\"`date +%Y-%m-%dT%H:%M:%SZ`\","
 echo "	\"files\": ["
-find $dir -mount \( -path /root -o -path /sys -o -path /proc \) -prune -o -printf "\t\t{\"name_s\": \"%p\", \"lastmodifiedtime_dt\": \"%CY-%Cm-%CdT%CH:%CM:00Z\", \"size_i\": \"%s\", \"permission_s\": \"%M\", \"type_s\": \"%Y\"},\n"
+find $dir -mount \( -path /root -o -path /sys -o -path /proc \) -prune -o -printf "\t\t{\"name_s\": \"%p\", \"lastmodifiedtime_dt\": \"%CY-%Cm-%CdT%CH:%CM:00Z\", \"size_i\": \"%s\", \"permission_s\": \"%M\", \"type_s\": \"%Y\"},\n" | LC_ALL=C sort
 echo "	]"
 echo "}"
 
 # Remove the last comma in the file to make it json-compatible
 sed -i ':a;N;$!ba;s/},\n\t\]/}\n\t\]/g' $f
 
+# Hash the file entries the same way the server does, and skip the upload
+# if they match the latest data the server has for us
+if [ $check == 1 ]
+then
+	hash=`grep '^[[:space:]]*{"' $f | sed -e 's/^[[:space:]]*//' -e 's/[[:space:]]*$//' -e 's/,$//' | sha1sum | cut -d' ' -f1`
+	curl -s -X POST --data "{\"hash\": \"${hash}\"}" "http://${timelineserver}/check/${namespace}/${origin}" > agent.log
+	if grep -q '"match": true' agent.log
+	then
+		rm -f $f
+		exit 0
+	fi
+fi
+
+query="async=false"
+if [ $async == 1 ]
+then
+	query="async=true"
+fi
+
 if [ $compressed == 1 ]
 then
 	gzip $f
-	curl -X POST --data-binary @$f.gz http://${timelineserver}/put/${namespace}/${origin}?compressed=true --header "Content-Type:application/json" > agent.log
+	curl -X POST --data-binary @$f.gz "http://${timelineserver}/put/${namespace}/${origin}?compressed=true&${query}" --header "Content-Type:application/json" > agent.log
 	rm -f $f.gz
 else
-	curl -X POST --data-binary @$f http://${timelineserver}/put/${namespace}/${origin} --header "Content-Type:application/json" > agent.log
+	curl -X POST --data-binary @$f "http://${timelineserver}/put/${namespace}/${origin}?${query}" --header "Content-Type:application/json" > agent.log
 	rm -f $f
 fi
 
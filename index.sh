@@ -6,5 +6,6 @@ then
 	exit 1
 fi
 
-curl -X POST --data-binary @$1 http://localhost:9200/_bulk
+# artifacts may be stored gzip compressed, zcat -f passes plain files through
+zcat -f "$1" | curl -X POST --data-binary @- http://localhost:9200/_bulk
 
@@ -6,6 +6,11 @@ import re
 import traceback
 import logging
 import getopt
+import TLData
+import TLReader
+import TLQuery
+import TLCatalog
+import TLPipeline
 
 try: import simplejson as json
 except ImportError: import json
@@ -35,11 +40,12 @@ def parseArgs(argv):
 	
 	namespace = ''
 	source = ''
+	retag = False
 
 	try:
-		opts, args = getopt.getopt(argv,'n:s:',['namespace=','source='])
+		opts, args = getopt.getopt(argv,'n:s:a',['namespace=','source=','all'])
 	except getopt.GetoptError:
-		print 'lasertag.py -n <namespace> -s <source>'
+		print 'lasertag.py -n <namespace> -s <source> [-a]'
 		sys.exit(2)
 
 	for opt, arg in opts:
@@ -47,11 +53,13 @@ def parseArgs(argv):
 			namespace = arg
 		elif opt in ("-s", "--source"):
 			source = arg
+		elif opt in ("-a", "--all"):
+			retag = True
 
 	if namespace != '' and source != '':
-		return (namespace, source)
+		return (namespace, source, retag)
 	else:
-		print 'lasertag.py -n <namespace> -s <source>'
+		print 'lasertag.py -n <namespace> -s <source> [-a]'
 		sys.exit(2)
 
 
@@ -120,44 +128,48 @@ def readTags():
 	logger.debug('Finished populating tags')
 	#logger.debug(json.dumps(tags, indent=2))
 
-def assignTags(namespace, source):
+def assignTags(namespace, source, retag=False):
 	'''
-		Assign tags to files
+		Assign tags to files of the snapshots not tagged yet, or of all of
+		them with retag, e.g. after the configs changed
 	'''
 
 	baseDirName = TL_DATA_DIR + '/' + namespace + '/' + source
-	f = open(baseDirName + '/.metafile', 'r')
-	index = int(f.read())
-	f.close()
 
-	if index <= 0:
-		return
+	# snapshots indexed since the last run, as recorded in the catalog
+	catalog = TLCatalog.TLCatalog()
+	indexes = catalog.find(namespace, source, 'index', start=1)
+	if not retag:
+		tagged = set(catalog.find(namespace, source, 'tag'))
+		indexes = [i for i in indexes if i not in tagged]
 
-	for i in range(1, index):
-		try:
-			f = open(baseDirName + '/' + str(i) + '.json', 'r')
+	# files package patterns look at, the only ones kept in memory
+	names = set(p['name_s'] for t in tags if t['cat'].lower() == 'package' for p in t.get('patterns', []))
 
-			count = 0
-			data = []	# All data
-			meta = []	# All meta data	
-			dataH = {}	# All data hashed by 'name_s'
+	# snapshots without changes are skipped
+	for i, f in TLData.iterArtifacts(baseDirName, '.json', indexes):
+		try:
+			baseDatafileName = baseDirName + '/' + str(i)
+			dataH = {}	# Data of those files hashed by 'name_s'
 			package = { 'include': [], 'exclude': [] }	# Found packages
-			for line in f:
-				count += 1
-				if count % 2 == 1:
-					meta.append(json.loads(line))
-				else:
-					j = json.loads(line)
-					data.append(j)
-					dataH[j['name_s']] = j
+			for m, d in TLReader.iterBulk(f):
+				if d['name_s'] in names:
+					dataH[d['name_s']] = d
+
+			# tag the changes a record at a time, reading them again
+			f = TLData.createArtifact(baseDatafileName + '.tag.json')
+			try:
+				for m, d in TLReader.iterBulk(TLData.openArtifact(baseDatafileName + '.json')):
+					tagFile(d, dataH, package)
+					f.write(json.dumps(m) + '\n' + json.dumps(d) + '\n')
+			except:
+				f.abort()
+				raise
 			f.close()
-			for m in data:
-				tagFile(m, dataH, package)
 
-			f = open(baseDirName + '/' + str(i) + '.tag.json', 'w')
-			for m,d in zip(meta, data):
-				f.write(json.dumps(m) + '\n' + json.dumps(d) + '\n')
-			f.close()
+			# make tags searchable through the timeline's /query
+			TLQuery.TLQuery().update(namespace, source, i, TLReader.iterRecords(TLData.openArtifact(baseDatafileName + '.tag.json')))
+			catalog.setStage(namespace, source, i, 'tag', TLPipeline.DONE)
 		except IOError:
 			# if file doesn't exist, we just keep going
 			pass
@@ -285,7 +297,7 @@ def tagFile(file, dataH, package):
 
 if __name__ == '__main__':
 
-	namespace, source = parseArgs(sys.argv[1:])
+	namespace, source, retag = parseArgs(sys.argv[1:])
 	print 'Starting Laser Tag process({0}) for namespace({1}) and source({2})'.format(os.getpid(),namespace,source)
 	print 'Log output will be stored in {0}'.format(LT_LOG)
 	logging.basicConfig(filename=LT_LOG, filemode='w', format='%(asctime)s %(levelname)s : %(message)s', level=logging.DEBUG)
@@ -293,4 +305,4 @@ if __name__ == '__main__':
 	logger.info('Started Laser Tag process({0})'.format(os.getpid()))
 	logger.info('Log output will be stored in {0}'.format(LT_LOG))
 	readTags()
-	assignTags(namespace, source)
+	assignTags(namespace, source, retag)
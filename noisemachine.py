@@ -16,6 +16,10 @@ import logging
 import re
 import StringIO
 import getopt
+import TLData
+import TLReader
+import TLCatalog
+import TLPipeline
 
 from datetime import datetime,timedelta
 
@@ -71,12 +75,7 @@ INCUBATION_FACTOR = 10
 def findNoise(namespace, source, output, freq):
 
 	baseDirName = TL_DATA_DIR + '/' + namespace + '/' + source
-	f = open(baseDirName + '/.metafile', 'r')
-	index = int(f.read())
-	f.close()
-
-	if index <= 0:
-		return
+	catalog = TLCatalog.TLCatalog()
 
 	# Example dataframe:
 	#
@@ -96,27 +95,21 @@ def findNoise(namespace, source, output, freq):
 
 	try:
 		f = open(baseDirName + '/.nm', 'r')
-		dataframe = json.loads(f.read())
+		try:
+			dataframe = json.loads(f.read())
+		finally:
+			f.close()
 	except:
 		dataframe = { 'index': 1, 'docs': 0, 'files': []}
-	finally:
-		f.close()
 
-	for i in range(dataframe['index'], index):
+	# snapshots indexed since the last run, as recorded in the catalog;
+	# those without changes are skipped
+	indexes = catalog.find(namespace, source, 'index', start=dataframe['index'])
+	for i, f in TLData.iterArtifacts(baseDirName, '.json', indexes):
 		try:
-			f = open(baseDirName + '/' + str(i) + '.json', 'r')
-			count = 0
-			j = []
-			for line in f:
-				# read only even lines
-				count += 1
-				if count % 2 == 1:
-					continue
-				j.append(json.loads(line))
-
 			if i == 1:
 				# Just load the data into dataframe
-				for m in j:
+				for m in TLReader.iterRecords(f):
 					# Skip non-modified files
 					if m['change_s'].lower() != 'modified'.lower():
 						continue
@@ -129,19 +122,22 @@ def findNoise(namespace, source, output, freq):
 					file['intervals'] = []
 					dataframe['files'].append(file)
 
-				dataframe['index'] += 1
+				dataframe['index'] = i + 1
 				dataframe['docs'] += 1
+				catalog.setStage(namespace, source, i, 'noise', TLPipeline.DONE)
 				continue
 
-			# hash by filename
+			# hash by filename, only the files looked at below
+			names = set(file['name_s'] for file in dataframe['files'])
 			j_h = {}
-			for m in j:
-				j_h[m['name_s']] = m
+			for m in TLReader.iterRecords(f):
+				if m['name_s'] in names or m['change_s'].lower() == 'modified':
+					j_h[m['name_s']] = m
 
 			# look through existing files
 			collectionTime = None
 			for file in dataframe['files']:
-				if not file['name_s'] in j_h.keys():
+				if not file['name_s'] in j_h:
 					# get rid of files that are not noise
 					if collectionTime != None:
 						time1 = datetime.strptime(file['collection_dt'], '%Y-%m-%dT%H:%M:%SZ')
@@ -189,8 +185,9 @@ def findNoise(namespace, source, output, freq):
 				file['intervals'] = []
 				dataframe['files'].append(file)
 
-			dataframe['index'] += 1
+			dataframe['index'] = i + 1
 			dataframe['docs'] += 1
+			catalog.setStage(namespace, source, i, 'noise', TLPipeline.DONE)
 
 		except:
 			# if file doesn't exist, we just keep going
@@ -6,5 +6,6 @@ then
 	exit 1
 fi
 
-curl -X POST --data-binary @$1 http://localhost:8983/solr/update?json.command=false\&commit=true -H "Content-Type: text/json"
+# artifacts may be stored gzip compressed, zcat -f passes plain files through
+zcat -f "$1" | curl -X POST --data-binary @- http://localhost:8983/solr/update?json.command=false\&commit=true -H "Content-Type: text/json"
 
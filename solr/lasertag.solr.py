@@ -7,6 +7,12 @@ import traceback
 import logging
 import getopt
 
+# the timeline modules are one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import TLData
+import TLCatalog
+import TLPipeline
+
 try: import simplejson as json
 except ImportError: import json
 
@@ -33,11 +39,12 @@ def parseArgs(argv):
 	
 	namespace = ''
 	source = ''
+	retag = False
 
 	try:
-		opts, args = getopt.getopt(argv,'n:s:',['namespace=','source='])
+		opts, args = getopt.getopt(argv,'n:s:a',['namespace=','source=','all'])
 	except getopt.GetoptError:
-		print 'lasertag.py -n <namespace> -s <source>'
+		print 'lasertag.py -n <namespace> -s <source> [-a]'
 		sys.exit(2)
 
 	for opt, arg in opts:
@@ -45,11 +52,13 @@ def parseArgs(argv):
 			namespace = arg
 		elif opt in ("-s", "--source"):
 			source = arg
+		elif opt in ("-a", "--all"):
+			retag = True
 
 	if namespace != '' and source != '':
-		return (namespace, source)
+		return (namespace, source, retag)
 	else:
-		print 'lasertag.py -n <namespace> -s <source>'
+		print 'lasertag.py -n <namespace> -s <source> [-a]'
 		sys.exit(2)
 
 
@@ -93,31 +102,34 @@ def readTags():
 	logger.debug('tags populated')
 	logger.debug(json.dumps(tags, indent=2))
 
-def assignTags(namespace, source):
+def assignTags(namespace, source, retag=False):
 	'''
-		Assign tags to files
+		Assign tags to files of the snapshots not tagged yet, or of all of
+		them with retag, e.g. after the configs changed
 	'''
 
 	baseDirName = TL_DATA_DIR + '/' + namespace + '/' + source
-	f = open(baseDirName + '/.metafile', 'r')
-	index = int(f.read())
-	f.close()
 
-	if index <= 0:
-		return
+	# snapshots indexed since the last run, as recorded in the catalog
+	catalog = TLCatalog.TLCatalog()
+	indexes = catalog.find(namespace, source, 'index', start=1)
+	if not retag:
+		tagged = set(catalog.find(namespace, source, 'tag'))
+		indexes = [i for i in indexes if i not in tagged]
 
-	for i in range(1, index):
+	# snapshots without changes are skipped
+	for i, f in TLData.iterArtifacts(baseDirName, '.json', indexes):
 		try:
-			f = open(baseDirName + '/' + str(i) + '.json', 'r')
 			data = f.read()
 			f.close()
 			j = json.loads(data)
 			for m in j:
 				tagFile(m)
 
-			f = open(baseDirName + '/' + str(i) + '.tag.json', 'w')
-			json.dump(j, f, indent=2)
+			f = TLData.createArtifact(baseDirName + '/' + str(i) + '.tag.json')
+			f.write(json.dumps(j, indent=2))
 			f.close()
+			catalog.setStage(namespace, source, i, 'tag', TLPipeline.DONE)
 		except IOError:
 			# if file doesn't exist, we just keep going
 			pass
@@ -162,7 +174,7 @@ def tagFile(file):
 
 if __name__ == '__main__':
 
-	namespace, source = parseArgs(sys.argv[1:])
+	namespace, source, retag = parseArgs(sys.argv[1:])
 	print 'Starting Laser Tag process({0}) for namespace({1}) and source({2})'.format(os.getpid(),namespace,source)
 	print 'Log output will be stored in {0}'.format(LT_LOG)
 	logging.basicConfig(filename=LT_LOG, filemode='w', format='%(asctime)s %(levelname)s : %(message)s', level=logging.DEBUG)
@@ -170,4 +182,4 @@ if __name__ == '__main__':
 	logger.info('Started Laser Tag process({0})'.format(os.getpid()))
 	logger.info('Log output will be stored in {0}'.format(LT_LOG))
 	readTags()
-	assignTags(namespace, source)
+	assignTags(namespace, source, retag)
@@ -17,6 +17,12 @@ import re
 import StringIO
 import getopt
 
+# the timeline modules are one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import TLData
+import TLCatalog
+import TLPipeline
+
 from datetime import datetime,timedelta
 
 try: import simplejson as json
@@ -71,12 +77,7 @@ INCUBATION_FACTOR = 10
 def findNoise(namespace, source, output, freq):
 
 	baseDirName = TL_DATA_DIR + '/' + namespace + '/' + source
-	f = open(baseDirName + '/.metafile', 'r')
-	index = int(f.read())
-	f.close()
-
-	if index <= 0:
-		return
+	catalog = TLCatalog.TLCatalog()
 
 	# Example dataframe:
 	#
@@ -96,15 +97,18 @@ def findNoise(namespace, source, output, freq):
 
 	try:
 		f = open(baseDirName + '/.nm', 'r')
-		dataframe = json.loads(f.read())
+		try:
+			dataframe = json.loads(f.read())
+		finally:
+			f.close()
 	except:
 		dataframe = { 'index': 1, 'docs': 0, 'files': []}
-	finally:
-		f.close()
 
-	for i in range(dataframe['index'], index):
+	# snapshots indexed since the last run, as recorded in the catalog;
+	# those without changes are skipped
+	indexes = catalog.find(namespace, source, 'index', start=dataframe['index'])
+	for i, f in TLData.iterArtifacts(baseDirName, '.json', indexes):
 		try:
-			f = open(baseDirName + '/' + str(i) + '.json', 'r')
 			data = f.read()
 			j = json.loads(data)
 
@@ -123,8 +127,9 @@ def findNoise(namespace, source, output, freq):
 					file['intervals'] = []
 					dataframe['files'].append(file)
 
-				dataframe['index'] += 1
+				dataframe['index'] = i + 1
 				dataframe['docs'] += 1
+				catalog.setStage(namespace, source, i, 'noise', TLPipeline.DONE)
 				continue
 
 			# hash by filename
@@ -183,8 +188,9 @@ def findNoise(namespace, source, output, freq):
 				file['intervals'] = []
 				dataframe['files'].append(file)
 
-			dataframe['index'] += 1
+			dataframe['index'] = i + 1
 			dataframe['docs'] += 1
+			catalog.setStage(namespace, source, i, 'noise', TLPipeline.DONE)
 
 		except:
 			# if file doesn't exist, we just keep going
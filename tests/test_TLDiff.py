@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Tests of the diff stage, run from the top directory with
+#
+#	python -m unittest discover tests
+#
+####################################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import TLData
+import TLDiff
+import TLCache
+
+ENTRY = '\t\t{{"name_s": "{0}", "lastmodifiedtime_dt": "2014-09-24T10:00:00Z", "size_i": "{1}", "permission_s": "-rw-r--r--", "type_s": "f"}}'
+
+class TLDiffCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dataDirName = tempfile.mkdtemp()
+		self.baseDirName = self.dataDirName + '/ns/h1'
+		os.makedirs(self.baseDirName)
+		self.snapshotCache = TLData.snapshotCache
+
+	def tearDown(self):
+		TLData.snapshotCache = self.snapshotCache
+		shutil.rmtree(self.dataDirName)
+
+	def writeSnapshot(self, index, files):
+		f = open(self.baseDirName + '/' + str(index), 'w')
+		f.write('{{\n\t"hostname_s":  "h1",\n\t"collection_dt":  "2014-09-24T10:0{0}:00Z",\n\t"files": [\n'.format(index))
+		f.write(',\n'.join(ENTRY.format(name, size) for name, size in files))
+		f.write('\n\t]\n}\n')
+		f.close()
+
+	def diffs(self):
+		''' the .diff of snapshots 1 to 3 diffed one after the other '''
+
+		result = []
+		for index in (1, 2, 3):
+			TLDiff.TLDiffData().diff(self.baseDirName + '/' + str(index - 1), self.baseDirName + '/' + str(index))
+			f = TLData.openArtifact(self.baseDirName + '/' + str(index) + '.diff')
+			result.append(f.read())
+			f.close()
+		return result
+
+	def testCachedLines(self):
+		''' diffing against the lines kept by the diff before gives the same changes '''
+
+		self.writeSnapshot(0, [('/a', 1), ('/b', 1), ('/c', 1)])
+		# listed out of order, sorted before being kept
+		self.writeSnapshot(1, [('/d', 1), ('/b', 2), ('/a', 1)])
+		self.writeSnapshot(2, [('/a', 1), ('/b', 3), ('/d', 1), ('/e', 1)])
+		self.writeSnapshot(3, [('/b', 3), ('/e', 2)])
+
+		TLData.snapshotCache = None
+		expected = self.diffs()
+		self.assertIn('< {"name_s": "/c"', expected[0])
+
+		TLData.snapshotCache = TLCache.TLCache('snapshot', 1024 * 1024)
+		self.assertEqual(self.diffs(), expected)
+		self.assertEqual(TLData.snapshotCache.stats()['hits'], 2)
+		self.assertEqual(TLData.snapshotCache.stats()['entries'], 1)
+
+if __name__ == '__main__':
+	unittest.main()
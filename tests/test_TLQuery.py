@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+####################################################################################
+#
+# Tests of the query stage, run from the top directory with
+#
+#	python -m unittest discover tests
+#
+####################################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import TLQuery
+
+try: import simplejson as json
+except ImportError: import json
+
+class TLQueryWriteTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dataDirName = tempfile.mkdtemp()
+		self.baseDirName = self.dataDirName + '/ns/h1'
+		os.makedirs(self.baseDirName)
+		self.dataDir = TLQuery.TL_DATA_DIR
+		TLQuery.TL_DATA_DIR = self.dataDirName
+
+	def tearDown(self):
+		TLQuery.TL_DATA_DIR = self.dataDir
+		shutil.rmtree(self.dataDirName)
+
+	def writeChanges(self, index, name):
+		f = open(self.baseDirName + '/' + str(index) + '.json', 'w')
+		json.dump([{'name_s': name, 'change_s': 'added', 'collection_dt': '2014-09-24T10:0{0}:00Z'.format(index)}], f)
+		f.close()
+
+	def names(self):
+		records, cursor = TLQuery.TLQuery().find('ns')
+		return sorted(r['name_s'] for r in records)
+
+	def testOutOfOrder(self):
+		''' a snapshot indexed after the next one has been queried is not lost '''
+
+		self.writeChanges(1, '/a')
+		self.assertTrue(TLQuery.TLQuery().write(self.baseDirName + '/1'))
+
+		# the query stage of 3 runs while the index stage of 2 is still running
+		self.writeChanges(3, '/c')
+		self.assertTrue(TLQuery.TLQuery().write(self.baseDirName + '/3'))
+		self.assertEqual(self.names(), ['/a', '/c'])
+
+		self.writeChanges(2, '/b')
+		self.assertTrue(TLQuery.TLQuery().write(self.baseDirName + '/2'))
+		self.assertEqual(self.names(), ['/a', '/b', '/c'])
+
+	def testBackfill(self):
+		''' snapshots ingested before the query stage existed are picked up '''
+
+		self.writeChanges(1, '/a')
+		self.writeChanges(2, '/b')
+		self.assertTrue(TLQuery.TLQuery().write(self.baseDirName + '/2'))
+		self.assertEqual(self.names(), ['/a', '/b'])
+
+if __name__ == '__main__':
+	unittest.main()
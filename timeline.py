@@ -10,14 +10,25 @@ import os
 import sys
 import traceback
 import logging
-import multiprocessing
 import bottle
 import re
 import subprocess
+import urllib
 import gzip
 import StringIO
 import TLData
 import TLDiff
+import TLReader
+import TLPipeline
+import TLServer
+import TLCache
+import TLHistory
+import TLRollup
+import TLQuery
+import TLColumns
+import TLRetention
+import TLCatalog
+import getopt
 
 try: import simplejson as json
 except ImportError: import json
@@ -30,31 +41,104 @@ except ImportError: import json
 
 app = bottle.Bottle()
 logger = None
+pipeline = None
+diffCache = None
 
 apihelp = '''
 TL REST calls
 -----------
 
-1. /put
+1. /put/<namespace>/<source>[?compressed=true][&async=true]
 
-   Put data into time line 
+   Put data into time line. With async=true, the call returns 202 and a job id
+   as soon as the data is stored, without waiting for it to be diffed
 
-2. /get[?time=time]
+2. /get/<namespace>/<source>[?time=time]
 
    Get data from time line specified by time parameter. If no time parameter
-   is given, the data from the latest time is returned  
+   is given, the data from the latest time is returned. Time is given as
+   2014-09-24T10:43:00Z or in seconds since the epoch, and the latest data
+   collected at or before it is returned
 
-3. /check
+   The ETag of the response names the snapshot returned. A request with
+   If-None-Match or If-Modified-Since is answered with 304 Not Modified if
+   the client already has that snapshot. /diff supports the same.
+
+   Snapshots are stored gzip compressed, and sent as they are, with
+   Content-Encoding: gzip, to a client sending Accept-Encoding: gzip
+
+3. /check/<namespace>/<source>
 
    Hash of raw data is sent via payload, and for each, we return whether or not
    hash values match those of the latest data. This avoids having to send data
    that has not changed since the last time point.
 
-4. /diff[?from=time1][&to=time2]
+   Payload: {"hash": <sha1>, "subtrees": {"/etc": <sha1>, ...}}, where each
+   hash is the sha1 of the file entry lines (stripped of whitespace and the
+   trailing ',') of the whole snapshot or of one top-level directory
+
+4. /diff/<namespace>/<source>[?from=time1][&to=time2][&prefix=path]
+
+   Return the differences between time1 and time2, as a list of records of
+   files added, modified or deleted. If no to time is given, the latest data
+   is used; if no from time is given, the data collected just before.
+   With prefix, only files whose name starts with it are returned. A time1
+   later than time2 is rejected with 400.
+   With format=ndjson, records are sent one per line instead of as a list
+
+5. /history/<namespace>/<source>?path=path[&from=time1][&to=time2]
+
+   Return the snapshots in which the file at path was added, modified or
+   deleted, optionally limited to those collected between time1 and time2.
+   Supports format=ndjson like /diff
+
+6. /changes/<namespace>?path=path[&from=time1][&to=time2]
+
+   Return the sources of a namespace, and their snapshots, in which the file
+   at path was added, modified or deleted, ordered by collection time and
+   optionally limited to those collected between time1 and time2. Supports
+   format=ndjson like /diff
+
+7. /rollup/<namespace>/<source>[?granularity=hour][&prefix=/][&from=time1][&to=time2]
+
+   Return the number of files added, modified and deleted under the directory
+   prefix per minute, hour or day of collection time, oldest first. Directories
+   up to TL_ROLLUP_DEPTH levels deep are counted. Supports format=ndjson like
+   /diff
+
+8. /snapshots/<namespace>/<source>[?from=time1][&to=time2]
+
+   Return the snapshots of a source, as recorded in the catalog of the data
+   root, oldest first, with their collection time, hostname, number of files,
+   bytes stored and the state of each of their stages, optionally limited to
+   those collected between time1 and time2. Supports format=ndjson like /diff
+
+9. /query/<namespace>[?prefix=path][&change=type][&tag=tag][&cat=category][&source=source][&from=time1][&to=time2][&limit=n][&after=cursor]
+
+   Return the changes in a namespace matching all given filters, oldest
+   first: files under a path prefix, of change type added, modified or
+   deleted, tagged or categorized by lasertag.py, of one source, collected
+   between time1 and time2. At most limit (default and maximum 1000) records
+   are returned, along with a cursor to pass as after for the next page, or
+   null after the last page
+
+10. /status/<job>
+
+   Show the state (pending, running, done, failed, skipped) of each pipeline
+   stage of an uploaded snapshot
+
+11. /status/<namespace>/<source>
+
+   Show the latest uploaded and latest fully processed snapshot of a source,
+   along with the jobs still in progress, 404 if nothing was ever uploaded
+   for it
 
-   Return the differences between time1 and time2
+12. /stats
 
-5. /help
+   Show size, entries, hits, misses and evictions of the in-memory caches
+   of the server process answering the request
+
+13. /help
    
    Show this API help
 '''
@@ -69,6 +153,19 @@ TL_HOST		=	'0.0.0.0'
 TL_PORT		=	10252
 TL_LOG		=	'logs/tl.log'
 INDEXER		=	'ElasticSearch'	#'Solr'
+TL_WORKERS	=	4	# threads running the diff/index stages of uploads
+TL_SERVER	=	'threaded'	# 'threaded' (see TLServer.py) or 'wsgiref'
+TL_THREADS	=	32	# threads serving requests in each server process
+TL_PROCESSES	=	1	# pre-forked server processes
+TL_BACKLOG	=	128	# connections waiting to be accepted
+TL_KEEPALIVE	=	30	# seconds an idle connection is kept open
+TL_DIFF_CACHE	=	64 * 1024 * 1024	# bytes of /diff results kept in memory
+TL_STREAM_CHUNK	=	64 * 1024	# bytes of a streamed response sent at a time
+TL_SNAPSHOT_CACHE	=	256 * 1024 * 1024	# bytes of parsed snapshots, and of the latest ones diffed, kept in memory
+TL_COLUMNS	=	False	# also write snapshots in columnar form (see TLColumns), diffed without parsing them
+TL_STORAGE	=	'full'	# 'full' copy of every snapshot, 'delta' (see TLData.TLSnapshotDelta), or 'shared' deltas plus namespace-wide bases (see TLData.TLSnapshotBase)
+TL_SEGMENTS	=	False	# pack the artifacts of older snapshots into segment files (see TLData.TLSegment)
+TL_RETENTION	=	[]	# (age, resolution) in seconds, e.g. [(7 * 86400, 3600), (90 * 86400, 86400)] keeps snapshots older than a week hourly and older than 90 days daily (see TLRetention), [] keeps all
 
 ####################################################################################
 #
@@ -84,84 +181,673 @@ def help():
 	bottle.response.content_type = 'text/plain'
 	return apihelp
 
-@app.route("/put/<namespace>/<source>", method="POST")
-def put(namespace, source):
-	''' save data '''
+def streamRecords(encoded, cache=None, key=None):
+	'''
+		Return a generator sending JSON encoded records as a JSON list or, with
+		format=ndjson, one record per line, in pieces of about TL_STREAM_CHUNK
+		bytes. If the records fit into cache, they are kept there under key.
+	'''
+
+	ndjson = bottle.request.query.get('format', None) == 'ndjson'
+	if ndjson:
+		bottle.response.content_type = 'application/x-ndjson'
+		begin, separator, end = '', '\n', '\n'
+	else:
+		bottle.response.content_type = 'text/json'
+		begin, separator, end = '[', ',\n', ']'
+
+	def generate():
+		kept = [] if cache is not None else None
+		keptSize = 0
+		pieces = [begin]
+		size = len(begin)
+		count = 0
+		sent = False
+
+		try:
+			for s in encoded:
+				if count > 0:
+					pieces.append(separator)
+				pieces.append(s)
+				size += len(s) + len(separator)
+				count += 1
+
+				if kept is not None:
+					kept.append(s)
+					keptSize += len(s)
+					if keptSize > cache.capacity:
+						kept = None
+
+				if size >= TL_STREAM_CHUNK:
+					yield ''.join(pieces)
+					sent = True
+					pieces = []
+					size = 0
+		except:
+			logger.error(traceback.format_exc().split('\n'))
+			if not sent:
+				# nothing sent yet, headers can still be changed
+				bottle.response.status = 500
+				bottle.response.content_type = 'text/json'
+				yield json.dumps({'success': False})
+			else:
+				# too late to change the status, cut the response short
+				yield ''.join(pieces)
+			return
 
-	bottle.response.content_type = 'text/json'
+		if count > 0 or not ndjson:
+			pieces.append(end)
+		yield ''.join(pieces)
+
+		if kept is not None:
+			cache.put(key, kept, keptSize)
+
+	return generate()
+
+def checkNames(namespace, source=None):
+	''' return an error response if namespace or source (if given) is malformed, None otherwise '''
 
 	namespaceInvalid = re.match('^[\w\-\.]+$', namespace) is None
 	if namespaceInvalid:
 		logger.error("Unexpected namespace: {0}".format(namespace))
 		return json.dumps({'success': False, 'stacktrace': traceback.format_exc().split('\n')}, indent=2)
 
-	sourceInvalid = re.match('^[\w-]+$', source) is None
+	sourceInvalid = source is not None and re.match('^[\w-]+$', source) is None
 	if sourceInvalid:
 		logger.error("Unexpected source: {0}".format(source))
 		return json.dumps({'success': False, 'stacktrace': traceback.format_exc().split('\n')}, indent=2)
 
-	# Check if data is compressed
-	compressed = False
-	if bottle.request.query:
-		value = bottle.request.query.get('compressed', None)
+	return None
+
+def queryFlag(name):
+	''' return True if query parameter name is set to true '''
+
+	value = bottle.request.query.get(name, None)
+	if value and value.lower() == 'true':
+		return True
+	return False
+
+def queryTimes(*names):
+	''' return ({name: seconds or None}, None), or (None, error response) if a time is malformed '''
+
+	times = {}
+	for name in names:
+		times[name] = None
+		value = bottle.request.query.get(name, None)
 		if value:
-			if value.lower() == 'true':
-				compressed = True
-			else:
-				compressed = False
+			try:
+				times[name] = TLData.parseTime(value)
+			except ValueError:
+				bottle.response.status = 400
+				return (None, json.dumps({'success': False, name: value}))
+	return (times, None)
+
+def notModified(etag, modified):
+	'''
+		Set the ETag and Last-Modified (seconds) validators of the response,
+		return True if the copy the client already has is still current
+	'''
+
+	bottle.response.set_header('ETag', etag)
+	bottle.response.set_header('Last-Modified', bottle.http_date(modified))
+
+	# If-None-Match takes precedence over If-Modified-Since
+	match = bottle.request.environ.get('HTTP_IF_NONE_MATCH')
+	if match is not None:
+		for tag in match.split(','):
+			tag = tag.strip()
+			if tag.startswith('W/'):
+				tag = tag[2:]
+			if tag == etag or tag == '*':
+				return True
+		return False
+
+	since = bottle.request.environ.get('HTTP_IF_MODIFIED_SINCE')
+	if since is not None:
+		since = bottle.parse_date(since.split(';')[0].strip())
+		if since is not None and since >= int(modified):
+			return True
+
+	return False
 
-	data = ''
-	dataSize = bottle.request.content_length
-	if (dataSize < bottle.request.MEMFILE_MAX):
-		# req.body in a string if its size is smaller than MEMFILE_MAX
-		data = bottle.request.body.getvalue()
+@app.route("/put/<namespace>/<source>", method="POST")
+def put(namespace, source):
+	''' save data '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	# Check if data is compressed
+	compressed = queryFlag('compressed')
+
+	# Check if the agent only wants to wait for its data to be stored
+	async = queryFlag('async')
+
+	# Read the body straight off the socket when its length is known, otherwise
+	# (chunked transfer encoding) let bottle spool it to a temporary file
+	if bottle.request.content_length >= 0:
+		body = bottle.request.environ['wsgi.input']
+		length = bottle.request.content_length
 	else:
-		# req.body in a file if its size is greater than MEMFLE_MAX
-		data = bottle.request.body.read()
+		body = bottle.request.body
+		length = None
 
-	# Find current index for (namespace,origin)
+	# Reserve the next index for (namespace,origin)
 	tli = TLData.TLIndex(namespace, source)
-	baseDatafileName = tli.getBaseDatafileName()
-	tli.incrementIndex()
+	baseDatafileName = tli.allocate()
+	if baseDatafileName is None:
+		return json.dumps({'success': False})
 
-	# Write out raw data collected by the agent
+	job = pipeline.submit(namespace, source, baseDatafileName)
+
+	# Write out raw data collected by the agent. The body is streamed to disk
+	# here, since a socket cannot be handed over to another process
 	tlrd = TLData.TLRawData()
-	p = multiprocessing.Process(target=tlrd.write, args=(baseDatafileName, data, compressed))
-	p.start()
-	p.join()
+	if not tlrd.write(baseDatafileName, body, length, compressed):
+		pipeline.fail(job, 'raw')
+		return json.dumps({'success': False})
+	pipeline.complete(job, 'raw')
+
+	if async:
+		# The raw data is safely on disk, progress of the remaining stages
+		# can be followed through /status/<job>
+		bottle.response.status = 202
+		return json.dumps({'success': True, 'job': job.id})
+
+	# Diffing and indexing run on the pipeline workers, wait for the diff
+	# to be written out before acknowledging the agent
+	pipeline.wait(job, 'diff')
+
+	return json.dumps({'success': True, 'job': job.id})
+
+@app.route("/get/<namespace>/<source>")
+def get(namespace, source):
+	''' return the snapshot of a source taken at or before the given time '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	times, error = queryTimes('time')
+	if error is not None:
+		return error
+
+	found = TLData.TLTimeIndex().find(namespace, source, times['time'])
+	if found is None:
+		bottle.response.status = 404
+		return json.dumps({'success': False})
+
+	collectionTime, index = found
+	datafileName = TLData.TLIndex(namespace, source).baseDirName + '/' + str(index)
+	try:
+		st = TLData.statSnapshot(datafileName)
+	except OSError:
+		bottle.response.status = 404
+		return json.dumps({'success': False, 'index': index})
+
+	bottle.response.set_header('X-TL-Index', str(index))
+	bottle.response.set_header('X-TL-Collection-Time', TLData.formatTime(collectionTime))
+	bottle.response.set_header('Vary', 'Accept-Encoding')
+
+	# stored gzip compressed, sent as it is to clients taking gzip
+	gzipped = 'gzip' in bottle.request.headers.get('Accept-Encoding', '') and \
+		TLData.artifactCompressed(datafileName)
+
+	# a snapshot never changes once written
+	etag = '"{0}:{1}:{2}{3}"'.format(namespace, source, index, ':gzip' if gzipped else '')
+	if notModified(etag, st.st_mtime):
+		bottle.response.status = 304
+		return ''
+
+	try:
+		if gzipped:
+			f = TLData.openArtifact(datafileName, decompress=False)
+			bottle.response.set_header('Content-Encoding', 'gzip')
+		else:
+			f = TLData.openSnapshot(datafileName)
+	except IOError:
+		bottle.response.status = 404
+		return json.dumps({'success': False, 'index': index})
+
+	if isinstance(f, file):
+		bottle.response.set_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+	elif isinstance(f, StringIO.StringIO):
+		# rebuilt from a delta
+		bottle.response.set_header('Content-Length', str(len(f.getvalue())))
+	elif isinstance(f, TLData.TLSegmentReader):
+		bottle.response.set_header('Content-Length', str(f.length))
+	# otherwise decompressed on the fly, sent chunked
+	return f
+
+@app.route("/diff/<namespace>/<source>")
+def diff(namespace, source):
+	''' return the changes between the snapshots taken at two times '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	tlti = TLData.TLTimeIndex()
+	to = tlti.find(namespace, source, times['to'])
+	if to is None:
+		bottle.response.status = 404
+		return json.dumps({'success': False})
+
+	# without a start time, diff against the snapshot before
+	if times['from'] is None:
+		times['from'] = to[0] - 1
+	frm = tlti.find(namespace, source, times['from'])
+	if frm is None:
+		bottle.response.status = 404
+		return json.dumps({'success': False})
+	if frm[1] > to[1]:
+		# would be the changes backwards
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'from': bottle.request.query.get('from'), 'to': bottle.request.query.get('to')})
+
+	bottle.response.set_header('X-TL-From-Index', str(frm[1]))
+	bottle.response.set_header('X-TL-To-Index', str(to[1]))
+
+	baseDirName = TLData.TLIndex(namespace, source).baseDirName
+	datafileName1 = baseDirName + '/' + str(frm[1])
+	datafileName2 = baseDirName + '/' + str(to[1])
+
+	try:
+		modified = max(TLData.statSnapshot(datafileName1).st_mtime, TLData.statSnapshot(datafileName2).st_mtime)
+	except OSError:
+		bottle.response.status = 404
+		return json.dumps({'success': False})
+
+	prefix = bottle.request.query.get('prefix', None) or None
+
+	# nor does the diff between two snapshots, only its encoding varies
+	etag = '{0}:{1}:{2}-{3}'.format(namespace, source, frm[1], to[1])
+	if prefix is not None:
+		etag += ':' + urllib.quote(prefix)
+	if bottle.request.query.get('format', None) == 'ndjson':
+		etag += ':ndjson'
+	if notModified('"' + etag + '"', modified):
+		bottle.response.status = 304
+		return ''
+
+	key = (namespace, source, frm[1], to[1], prefix)
+	encoded = diffCache.get(key)
+	if encoded is not None:
+		return streamRecords(encoded)
+
+	records = None
+	if frm[1] == to[1] - 1:
+		# consecutive snapshots have been diffed at ingest already
+		try:
+			records = TLReader.iterRecords(TLData.openArtifact(datafileName2 + '.json'))
+			if prefix is not None:
+				# names of change records are unicode
+				namePrefix = prefix.decode('utf-8', 'replace')
+				records = (r for r in records if r['name_s'].startswith(namePrefix))
+		except IOError:
+			pass
+	if records is None:
+		columns1 = TLColumns.openColumns(datafileName1)
+		columns2 = TLColumns.openColumns(datafileName2)
+		if columns1 is not None and columns2 is not None:
+			# no need to parse the raw data, files under prefix are a range of the path dictionary
+			records = TLDiff.TLDiffData().iterColumnarChanges(columns1, columns2, getIndexer(), prefix)
+	if records is None:
+		try:
+			snapshot1 = TLData.readSnapshot(datafileName1)
+			snapshot2 = TLData.readSnapshot(datafileName2)
+		except IOError:
+			bottle.response.status = 404
+			return json.dumps({'success': False})
+		records = TLDiff.TLDiffData().iterSnapshotChanges(snapshot1, snapshot2, getIndexer(), prefix)
+
+	return streamRecords((json.dumps(r) for r in records), diffCache, key)
+
+@app.route("/history/<namespace>/<source>")
+def history(namespace, source):
+	''' return the snapshots in which a file was added, modified or deleted '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	path = bottle.request.query.get('path', None)
+	if not path:
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'path': path})
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	records = TLHistory.TLHistory().find(namespace, source, path, times['from'], times['to'])
+	return streamRecords(json.dumps(r) for r in records)
+
+@app.route("/changes/<namespace>")
+def changes(namespace):
+	''' return the sources and snapshots of a namespace in which a file changed '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace)
+	if error is not None:
+		return error
+
+	path = bottle.request.query.get('path', None)
+	if not path:
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'path': path})
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	records = TLHistory.TLNamespaceHistory().find(namespace, path, times['from'], times['to'])
+	return streamRecords(json.dumps(r) for r in records)
+
+@app.route("/rollup/<namespace>/<source>")
+def rollup(namespace, source):
+	''' return the number of changes under a directory per time bucket '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	granularity = bottle.request.query.get('granularity', 'hour')
+	if granularity not in TLRollup.GRANULARITIES:
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'granularity': granularity})
+
+	prefix = bottle.request.query.get('prefix', '/').rstrip('/') or '/'
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	records = TLRollup.TLRollup().find(namespace, source, granularity, prefix, times['from'], times['to'])
+	return streamRecords(json.dumps(r) for r in records)
+
+@app.route("/snapshots/<namespace>/<source>")
+def snapshots(namespace, source):
+	''' return the snapshots of a source collected between two times, and their stages '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	records = TLCatalog.TLCatalog().snapshots(namespace, source, times['from'], times['to'])
+	return streamRecords(json.dumps(r) for r in records)
+
+@app.route("/query/<namespace>")
+def query(namespace):
+	''' return a page of the changes in a namespace matching the given filters '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace)
+	if error is not None:
+		return error
+
+	source = bottle.request.query.get('source', None)
+	if source is not None:
+		error = checkNames(namespace, source)
+		if error is not None:
+			return error
+
+	times, error = queryTimes('from', 'to')
+	if error is not None:
+		return error
+
+	try:
+		limit = int(bottle.request.query.get('limit', TLQuery.TL_QUERY_LIMIT))
+		if limit < 1:
+			raise ValueError(limit)
+	except ValueError:
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'limit': bottle.request.query.get('limit')})
+
+	q = bottle.request.query
+	try:
+		records, cursor = TLQuery.TLQuery().find(namespace, prefix=q.get('prefix', None), change=q.get('change', None),
+			tag=q.get('tag', None), cat=q.get('cat', None), source=source, start=times['from'], end=times['to'],
+			limit=limit, after=q.get('after', None))
+	except TLQuery.TLQueryError:
+		bottle.response.status = 400
+		return json.dumps({'success': False, 'after': q.get('after')})
+
+	return json.dumps({'success': True, 'records': records, 'next': cursor})
+
+@app.route("/check/<namespace>/<source>", method="POST")
+def check(namespace, source):
+	''' tell an agent which of its hashes match the latest data of its source '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	try:
+		hashes = json.loads(bottle.request.body.read())
+	except:
+		logger.error(traceback.format_exc().split('\n'))
+		return json.dumps({'success': False, 'stacktrace': traceback.format_exc().split('\n')}, indent=2)
+
+	index, latest = TLData.TLRawDataHash().getLatest(namespace, source)
+
+	# without hashes of the latest data, nothing can be said to match
+	if latest is None:
+		latest = { 'hash': None, 'subtrees': {} }
+
+	result = { 'success': True, 'index': index }
+	if 'hash' in hashes:
+		result['match'] = latest['hash'] is not None and hashes['hash'] == latest['hash']
+	if 'subtrees' in hashes:
+		result['subtrees'] = {}
+		for subtree, h in hashes['subtrees'].items():
+			result['subtrees'][subtree] = h is not None and latest['subtrees'].get(subtree) == h
+
+	return json.dumps(result)
+
+@app.route("/stats")
+def stats():
+	''' report hit and miss counters of the caches of this server process '''
+
+	bottle.response.content_type = 'text/json'
+
+	result = {
+		'success': True,
+		'pid': os.getpid(),
+		'caches': [diffCache.stats(), TLData.snapshotCache.stats()],
+	}
+	return json.dumps(result, indent=2)
+
+@app.route("/status/<job>")
+def status(job):
+	''' report progress of the pipeline stages of an uploaded snapshot '''
+
+	bottle.response.content_type = 'text/json'
+
+	j = pipeline.getJob(job)
+	if j is not None:
+		result = pipeline.getStatus(j)
+	else:
+		# uploaded to another server process, or before a restart
+		result = None
+		m = re.match(r'^(.*):(.*):([0-9]+)$', job)
+		if m is not None and checkNames(m.group(1), m.group(2)) is None:
+			tli = TLData.TLIndex(m.group(1), m.group(2))
+			result = pipeline.getDiskStatus(m.group(1), m.group(2), tli.baseDirName + '/' + m.group(3))
+
+	if result is None:
+		bottle.response.status = 404
+		return json.dumps({'success': False, 'job': job})
+
+	result['success'] = True
+	return json.dumps(result, indent=2)
+
+@app.route("/status/<namespace>/<source>")
+def sourceStatus(namespace, source):
+	''' report the latest uploaded and fully processed snapshots of a source '''
+
+	bottle.response.content_type = 'text/json'
+
+	error = checkNames(namespace, source)
+	if error is not None:
+		return error
+
+	# other server processes may have taken uploads since
+	index = TLCatalog.TLCatalog().getNext(namespace, source)
+	if index == 0:
+		# nothing was ever uploaded for this source
+		bottle.response.status = 404
+		return json.dumps({'success': False, 'namespace': namespace, 'source': source})
+
+	result = pipeline.getSourceStatus(namespace, source)
+	result['latest'] = index - 1
+
+	result['success'] = True
+	return json.dumps(result, indent=2)
+
+def startPipeline():
+	''' create the worker pool running the ingest stages of every /put '''
+
+	global pipeline
+	pipeline = TLPipeline.TLPipeline(TL_WORKERS, TLCatalog.TLCatalog())
 
 	# Flatten out raw data and write it out, which can be used as input to Solr
-	#tlrdi = TLData.TLRawDataIndex()
-	#p = multiprocessing.Process(target=tlrdi.write, args=(baseDatafileName, data, compressed))
-	#p.start()
-	#p.join()
+	#pipeline.addStage('rawindex', TLData.TLRawDataIndex().write)
+
+	# Index snapshots by collection time for /get
+	pipeline.addStage('time', TLData.TLTimeIndex().write)
+
+	# Record collection time, hostname and sizes in the catalog for /snapshots
+	pipeline.addStage('catalog', TLCatalog.TLCatalog().write)
+
+	# Hash raw data so agents can skip uploading unchanged data
+	pipeline.addStage('hash', TLData.TLRawDataHash().write)
+
+	# Write out diff of raw data against the previous snapshot
+	pipeline.addStage('diff', TLDiff.TLDiffData().write, previous=['raw'])
+
+	readers = ['time', 'catalog', 'hash', 'diff']
+
+	# Write out raw data in columnar form, for /diff between any two snapshots
+	if TL_COLUMNS:
+		pipeline.addStage('columns', TLColumns.TLColumnsWriter().write)
+		readers.append('columns')
 
-	# Write out diff of raw data
-	tld = TLDiff.TLDiffData()
-	p = multiprocessing.Process(target=tld.write, args=(baseDatafileName,))
-	p.start()
-	p.join()
+	# Replace the previous snapshot with a delta against this one, once
+	# nothing in the pipeline reads it anymore, and with shared storage this
+	# one with a delta against a base of its namespace
+	if TL_STORAGE in ('delta', 'shared'):
+		pipeline.addStage('delta', TLData.TLSnapshotDelta(shared=TL_STORAGE == 'shared').write,
+			depends=readers, previous=readers + ['delta'])
 
 	# Flatten out raw diff data and write it out, which can be used as input to Solr
-	if INDEXER == 'Solr':
-		tldi = TLDiff.TLDiffDataIndexSolr()
-		p = multiprocessing.Process(target=tldi.write, args=(baseDatafileName,))
-		p.daemon = True
-		p.start()
-	elif INDEXER == 'ElasticSearch':
-		tldi = TLDiff.TLDiffDataIndexES()
-		p = multiprocessing.Process(target=tldi.write, args=(baseDatafileName,))
-		p.daemon = True
-		p.start()
+	indexer = getIndexer()
+	if indexer is not None:
+		pipeline.addStage('index', indexer.write, depends=['diff'])
 	else:
 		logger.error('Indexer {0} not supported'.format(INDEXER))
 
-	return json.dumps({'success': True})
-	
+	# Record the changes per file for /history
+	pipeline.addStage('history', TLHistory.TLHistory().write, depends=['index'])
+
+	# Record the changes per file of the whole namespace for /changes
+	pipeline.addStage('changes', TLHistory.TLNamespaceHistory().write, depends=['index'])
+
+	# Count changes per directory and time bucket for /rollup
+	pipeline.addStage('rollup', TLRollup.TLRollup().write, depends=['index'])
+
+	# Index changes of the whole namespace for /query
+	pipeline.addStage('query', TLQuery.TLQuery().write, depends=['index'])
+
+	# Drop snapshots past their retention, once every other stage is done
+	# with this one, and compactions of the same source one at a time
+	if len(TL_RETENTION) > 0 and indexer is not None:
+		pipeline.addStage('compact', TLRetention.TLCompactor(TL_RETENTION, indexer).write,
+			depends=[stage.name for stage in pipeline.stages], previous=['compact'])
+
+	# Pack the artifacts of snapshots into segments of TLData.TL_SEGMENT_SIZE,
+	# once each of them has been ingested
+	if TL_SEGMENTS:
+		pipeline.addStage('pack', TLData.TLSegmentWriter().write,
+			depends=[stage.name for stage in pipeline.stages], previous=['pack'])
+
+def initProcess():
+	''' set up everything a serving process keeps in memory '''
+
+	global diffCache
+	diffCache = TLCache.TLCache('diff', TL_DIFF_CACHE)
+	TLData.snapshotCache = TLCache.TLCache('snapshot', TL_SNAPSHOT_CACHE)
+
+	startPipeline()
+
+def getIndexer():
+	''' return the formatter of diff output for the configured INDEXER '''
+
+	if INDEXER == 'Solr':
+		return TLDiff.TLDiffDataIndexSolr()
+	elif INDEXER == 'ElasticSearch':
+		return TLDiff.TLDiffDataIndexES()
+	return None
+
+def parseArgs(argv):
+
+	server = TL_SERVER
+	threads = TL_THREADS
+	processes = TL_PROCESSES
+	workers = TL_WORKERS
+
+	try:
+		opts, args = getopt.getopt(argv,'s:t:p:w:',['server=','threads=','processes=','workers='])
+	except getopt.GetoptError:
+		print 'timeline.py [-s <threaded|wsgiref> -t <threads> -p <processes> -w <workers>]'
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt in ("-s", "--server"):
+			server = arg
+		elif opt in ("-t", "--threads"):
+			threads = int(arg)
+		elif opt in ("-p", "--processes"):
+			processes = int(arg)
+		elif opt in ("-w", "--workers"):
+			workers = int(arg)
+
+	if server in ('threaded', 'wsgiref'):
+		return (server, threads, processes, workers)
+	else:
+		print 'timeline.py [-s <threaded|wsgiref> -t <threads> -p <processes> -w <workers>]'
+		sys.exit(2)
 
 # Main listen/exec loop
 
 if __name__ == '__main__':
+	TL_SERVER, TL_THREADS, TL_PROCESSES, TL_WORKERS = parseArgs(sys.argv[1:])
+
 	if not os.path.exists('logs'):
 		os.makedirs('logs')
 
@@ -171,4 +857,12 @@ if __name__ == '__main__':
 	logger = logging.getLogger(__name__)
 	logger.info('Started Time Line process({0})'.format(os.getpid()))
 	logger.info('Log output will be stored in {0}'.format(TL_LOG))
-	app.run(host=TL_HOST, port=TL_PORT, quiet=True)
+	if TL_SERVER == 'threaded':
+		# every serving process gets its own pipeline
+		app.run(server=TLServer.TLServerAdapter, host=TL_HOST, port=TL_PORT, quiet=True,
+			threads=TL_THREADS, processes=TL_PROCESSES, backlog=TL_BACKLOG,
+			keepalive=TL_KEEPALIVE, init=initProcess)
+	else:
+		# bottle's default single-threaded server
+		initProcess()
+		app.run(host=TL_HOST, port=TL_PORT, quiet=True)